@@ -4,6 +4,7 @@ from .rescale_references_gui import *
 from .reset_shifts_angles_gui import *
 from .angles_and_shifts_soothing_gui import *
 from .angles_and_shifts_correction_gui import *
+from .cutoff_sweep_gui import *
 from .rescale_mask_gui import *
 from .mask_generator_gui import *
 # from .microtubule_subtract_gui import *
@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 17/04/24
-Updated: 28/07/24
+Updated: 18/10/26
 
 Two GUI classes (master and frame) to unifi PHI/Rot (angle smoothing)
 Using SmoothAnglesOrShifts at angle_and_shifts_smoothing.py
@@ -9,7 +9,6 @@ Using SmoothAnglesOrShifts at angle_and_shifts_smoothing.py
 """
 from ..gui_base import LgFrameBase, LgMasterGui, check_parameters
 from ..methods import SmoothAnglesOrShifts
-from ..methods_base import ParticlesStarfile
 
 
 class SmoothingGui(LgMasterGui):
@@ -39,7 +38,7 @@ class SmoothingFrame(LgFrameBase):
         self.add_sub_job_name("Angle (PHI/Rot) or XY shifts smoothing")
 
         # Adding a dropdown menu (combobox) to choose a method (smooth angels or shifts)
-        options = ['angles', 'shifts']
+        options = ['angles', 'shifts', 'joint']
         self.method = self.add_method_combobox(row=1, options=options, on_method_change=True)
 
         # Creates an entry for run_it000_data.star file
@@ -75,9 +74,7 @@ class SmoothingFrame(LgFrameBase):
             print('No star file was chosen, please select a run_it0xx_data.star file')
         elif self.output.empty:
             print('Showing input only')
-            input_starfile = ParticlesStarfile(self.input_star_file.get())
-            self.input = input_starfile.particles_dataframe
-            self.show_input_angle_and_shifts_plot(int(self.result_number.get()))
+            self.show_input_angle_and_shifts_plot(int(self.result_number.get()), self.input_star_file.get())
         else:
             print('Showing input and output')
             self.show_angle_and_shifts_plot(int(self.result_number.get()))
@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 14/03/24
-Updated: 28/07/24
+Updated: 18/10/26
 
 Two GUI classes (master and frame) for class unification and extraction
 The method of class unification and extraction is located in LG_MiRP/methods/class_unifier_extractor.py
@@ -10,7 +10,7 @@ import tkinter as tk
 
 from ..gui_base import LgFrameBase, LgMasterGui, LGTopLevelBase, check_parameters
 from ..methods import ClassUnifierExtractor
-from ..methods_base import ParticlesStarfile
+from ..methods_base import ParticlesStarfile, ClassCountMatrix, MICROTUBULE_LABELS
 
 
 class ClassUnificationExtractionGui(LgMasterGui):
@@ -74,13 +74,13 @@ class ClassUnificationFrame(LgFrameBase):
         """
         Opening an additional window with class distribution in %
         """
-        # Generating a pie chart with percentages of MTs classified in each class
-        if self.output.empty:
-            input_file = ParticlesStarfile(self.input_star_file1)
-            self.input = input_file.particles_dataframe
-            fig = ClassUnifierExtractor.classes_distribution_fig(self.input)
-        else:
-            fig = ClassUnifierExtractor.classes_distribution_fig(self.output)
+        # Generating a pie chart with percentages of MTs classified in each class, of the unified classes once the
+        # method was run (self.output is an empty DataFrame before that)
+        class_counts = self.output
+        if not isinstance(class_counts, ClassCountMatrix):
+            input_file = ParticlesStarfile(self.input_star_file1.get(), columns=MICROTUBULE_LABELS + ['rlnClassNumber'])
+            class_counts = input_file.class_counts
+        fig = ClassUnifierExtractor.classes_distribution_fig(class_counts)
         # Generating a Tkinter Top level window
         pie_window = LGTopLevelBase(self)
         # Adding a title to the figure
@@ -0,0 +1,81 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Two GUI classes (master and frame) to evaluate the cutoffs of smoothing and class unification
+The method of the cutoff sweep is located in LG_MiRP/methods/cutoff_sweep.py
+"""
+from ..gui_base import LgFrameBase, LgMasterGui, LGTopLevelBase, check_parameters
+from ..methods import CutoffSweep
+
+
+class CutoffSweepGui(LgMasterGui):
+    """
+    Inherits from LgMasterGui
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        frame = CutoffSweepFrame(self)
+        frame.grid(row=1, column=0, sticky="NSEW")
+        self.mainloop()
+
+
+class CutoffSweepFrame(LgFrameBase):
+    """
+    Inherits from LgFrameBase
+    """
+
+    def __init__(self, master):
+        """
+        :param master: the master gui in which the frame will be displayed
+        """
+        super().__init__(master)
+
+        # Adding a title label
+        self.add_sub_job_name("Cutoff sweep of smoothing and class unification")
+
+        # Creates an entry for run_it0xx_data.star file
+        self.input_star_file = self.add_file_entry('star', 'Select a run_it0xx_data.star file', row=1)
+
+        # Creates an entry for output directory
+        self.output_directory = self.add_directory_entry('Select output directory', row=2)
+
+        # Adding a "Run" button that executes self.run_function
+        self.add_run_button(row=3)
+
+        # Adding a button to show the curves of the sweep
+        self.add_show_results_button(self.show_curves, row=3, text="Show curves")
+
+        # The CutoffSweep of the last run, with its curves
+        self.sweep = None
+
+        # Imports a themed image at the bottom
+        self.add_image(new_size=600, row=4)
+
+    @check_parameters(['input_star_file', 'output_directory'])
+    def run_function(self):
+        """
+        Setting up the class, checking if the parameters are all filled (prints in the terminal if something is missing)
+        and running the function with the parameters
+        """
+        function = CutoffSweep(self.input_star_file, self.output_directory)
+        function.cutoff_sweep()
+        self.sweep = function
+
+    def show_curves(self):
+        """
+        Opening an additional window with the percent of the MTs and segments retained at every cutoff
+        """
+        if self.sweep is None:
+            print('The cutoff sweep was not run yet, please run it first')
+            return
+
+        fig = self.sweep.sweep_curves_fig()
+        # Generating a Tkinter Top level window
+        curves_window = LGTopLevelBase(self)
+        # Adding a title to the figure
+        curves_window.title("Cutoff Sweep")
+        # Adding the curves to the window
+        curves_window.add_plot(fig)
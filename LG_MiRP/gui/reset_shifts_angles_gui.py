@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 15/04/24
-Updated: 28/07/24
+Updated: 18/10/26
 
 Two GUI classes (master and frame) for shifts and angle reset
 The method of shifts and angle reset is in and extraction is located in LG_MiRP/methods/reset_angles_shifts
@@ -11,7 +11,6 @@ angles: _rlnAnglePsi, _rlnAngleTilt are set to priors: _rlnAnglePsiPrior, _rlnAn
 """
 from ..gui_base import LgFrameBase, LgMasterGui, check_parameters
 from ..methods import ResetAnglesAndShifts
-from ..methods_base import ParticlesStarfile
 
 
 class ResetShiftsAnglesGui(LgMasterGui):
@@ -83,9 +82,7 @@ class ResetShiftsAnglesFrame(LgFrameBase):
             print('No star file was chosen, please select a run_it0xx_data.star file')
         elif self.output.empty:
             print('Showing input only')
-            input_starfile = ParticlesStarfile(self.input_star_file.get())
-            self.input = input_starfile.particles_dataframe
-            self.show_input_angle_and_shifts_plot(int(self.result_number.get()))
+            self.show_input_angle_and_shifts_plot(int(self.result_number.get()), self.input_star_file.get())
         else:
             print('Showing input and output')
             self.show_angle_and_shifts_plot(int(self.result_number.get()))
\ No newline at end of file
@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 26/02/24
-Updated: 28/07/24
+Updated: 18/10/26
 
 Class to generate ttk.Frames LG-style.
 """
@@ -15,7 +15,8 @@ from functools import wraps
 
 from .utils import *
 from .top_level_base import LGTopLevelBase
-from ..methods_base import groupby_micrograph_and_helical_id, plot_angles_and_shifts
+from ..methods_base import MicrotubuleIndex, ParticlesStarfile, plot_angles_and_shifts, ANGLES_AND_SHIFTS_LABELS, \
+    is_star_delta
 
 
 class LgFrameBase(ttk.Frame):
@@ -178,36 +179,24 @@ class LgFrameBase(ttk.Frame):
 
         :param n: number of MTs to display plots for
         """
-        # Assuming 'grouped_data' is the grouped data from a DataFrame
-        grouped_data_output = groupby_micrograph_and_helical_id(self.output)
+        # Finding the rows of every MT in the output and input data
+        output_index = MicrotubuleIndex.from_dataframe(self.output)
+        input_index = MicrotubuleIndex.from_dataframe(self.input)
+        output_keys = output_index.keys()
 
-        # Convert the grouped data into a list of tuples (key, grouped DataFrame)
-        grouped_data_list = list(grouped_data_output)
-        num_groups = len(grouped_data_list)
+        selected_indices = random.sample(range(len(output_index)), min(n, len(output_index)))
 
-        selected_indices = random.sample(range(num_groups), n)
-
-        # Iterate through the selected items in the grouped data list
+        # Iterate through the selected MTs
         for index in selected_indices:
-            # Unpack the key and the grouped DataFrame
-            (micrograph, MT), MT_dataframe = grouped_data_list[index]
+            micrograph, MT = output_keys[index]
 
             # Plot the output data
-            fig_output = plot_angles_and_shifts(MT_dataframe)
-
-            # Assuming 'grouped_data_input' is the grouped data from the input DataFrame
-            grouped_data_input = groupby_micrograph_and_helical_id(self.input)
-            grouped_data_list_input = list(grouped_data_input)
+            fig_output = plot_angles_and_shifts(self.output.iloc[output_index.rows(index)])
 
-            # Find the corresponding input DataFrame
-            input_dataframe = pd.DataFrame()
-            for (micrograph_input, MT_input), df in grouped_data_list_input:
-                if micrograph_input == micrograph and MT_input == MT:
-                    input_dataframe = df
-                    break
-
-            if not input_dataframe.empty:
-                fig_input = plot_angles_and_shifts(input_dataframe)
+            # Find the corresponding input MT
+            input_group = input_index.find(micrograph, MT)
+            if input_group is not None:
+                fig_input = plot_angles_and_shifts(self.input.iloc[input_index.rows(input_group)])
             else:
                 fig_input = None
 
@@ -222,52 +211,40 @@ class LgFrameBase(ttk.Frame):
                 plot_window.add_title(text='After smoothing/correcting', row=3)
             plot_window.add_plot(fig_output, row=4)
 
-    def show_input_angle_and_shifts_plot(self, n=10):
+    def show_input_angle_and_shifts_plot(self, n=10, star_file=None):
         """
         Generates a matplot lib fig with 4 subplots for rot, tilt, psi and X/Y shifts as a function of segment number
         for n random microtubules in the data set in new sub-windows (tk.TopLevel)
         Uses plot_angles_and_shifts method from plost_functions.py in methods folder
 
         :param n: number of MTs to display plots for
+        :param star_file: if given, the MTs are read directly from this STAR file instead of self.input, only the
+        sampled MTs are read (a delta file is read whole)
         """
-        # Assuming 'grouped_data' is the grouped data from a DataFrame
-        grouped_data = groupby_micrograph_and_helical_id(self.input)
-
-        # Convert the grouped data into a list of tuples (key, grouped DataFrame)
-        grouped_data_list = list(grouped_data)
-        num_groups = len(grouped_data_list)
-
-        selected_indices = random.sample(range(num_groups), n)
-
-        # Iterate through the selected items in the grouped data list
-        for index in selected_indices:
-            # Unpack the key and the grouped DataFrame
-            (micrograph, MT), MT_dataframe = grouped_data_list[index]
-
-            # Assuming 'grouped_data_input' is the grouped data from the input DataFrame
-            grouped_data_input = groupby_micrograph_and_helical_id(self.input)
-            grouped_data_list_input = list(grouped_data_input)
-
-            # Find the corresponding input DataFrame
-            input_dataframe = pd.DataFrame()
-            for (micrograph_input, MT_input), df in grouped_data_list_input:
-                if micrograph_input == micrograph and MT_input == MT:
-                    input_dataframe = df
-                    break
-
-            if not input_dataframe.empty:
-                fig_input = plot_angles_and_shifts(input_dataframe)
+        if star_file and not is_star_delta(star_file):
+            offsets = ParticlesStarfile(star_file, data_blocks=['optics']).microtubule_offsets
+            microtubules = offsets.sample(n, columns=ANGLES_AND_SHIFTS_LABELS)
+        else:
+            if star_file:
+                input_dataframe = ParticlesStarfile(star_file, columns=ANGLES_AND_SHIFTS_LABELS).particles_dataframe
             else:
-                fig_input = None
+                input_dataframe = self.input
+            input_index = MicrotubuleIndex.from_dataframe(input_dataframe)
+            keys = input_index.keys()
+            selected_indices = random.sample(range(len(input_index)), min(n, len(input_index)))
+            microtubules = [(keys[index], input_dataframe.iloc[input_index.rows(index)]) for index in selected_indices]
+
+        # Iterate through the selected MTs
+        for (micrograph, MT), input_dataframe in microtubules:
+            fig_input = plot_angles_and_shifts(input_dataframe)
 
             # Create a new window for each plot
             plot_window = LGTopLevelBase(self)
             plot_window.title("Plot of angles")
             plot_window.add_title(text=f"MT {MT} in {micrograph}")
 
-            if fig_input:
-                plot_window.add_title(text='Before smoothing/correcting', row=1)
-                plot_window.add_plot(fig_input, row=2)
+            plot_window.add_title(text='Before smoothing/correcting', row=1)
+            plot_window.add_plot(fig_input, row=2)
 
     def display_multiple_mrc_files(self, path, row, max_columns=6):
         """
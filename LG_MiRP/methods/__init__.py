@@ -7,3 +7,4 @@ from .angles_shifts_correction import *
 from .angles_and_shifts_smoothing import *
 from .mask_generator import *
 from .kinesin_mask_generator import *
+from .cutoff_sweep import *
@@ -1,17 +1,42 @@
 """
 Author: Alina Levitin
 Date: 01/05/24
-Updated: 08/07/24
+Updated: 18/10/26
 
 Methods for smoothing shifts (rlnOriginXAngst, rlnOriginYAngst) and angles (rlnAngleRot) used during initial seam
 assignment.
 
 """
+import io
 import os
-import starfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
 
 from ..methods_base.method_base import MethodBase, print_done_decorator
-from ..methods_base.particles_starfile import ParticlesStarfile, groupby_micrograph_and_helical_id
+from ..methods_base.particles_starfile import ParticlesStarfile, ANGLES_AND_SHIFTS_LABELS
+from ..methods_base.microtubule_index import MicrotubuleIndex, MICROTUBULE_LABELS
+from ..methods_base.angle_clustering import cluster_angles, unwrap_angles, wrap_angles, ROT_PERIOD
+from ..methods_base.ragged_array import RaggedArray
+from ..methods_base.microtubule_results import MicrotubuleResults
+from ..methods_base.star_writer import StarFileWriter, write_star_file
+from ..methods_base.star_compression import strip_star_extension, star_file_name
+from ..methods_base.star_delta import write_star_delta
+from ..methods_base.particles_schema import expand_dtypes
+
+# Method: the labels that are smoothed ('joint' smooths them together, see smooth_data_joint)
+SMOOTHED_LABELS = {'angles': ['rlnAngleRot'], 'shifts': ['rlnOriginXAngst', 'rlnOriginYAngst'],
+                   'joint': ['rlnAngleRot', 'rlnOriginXAngst', 'rlnOriginYAngst']}
+
+# Angles that can be smoothed: their period, None for tilt which is between 0 and 180 and never wraps around
+ANGLE_PERIODS = {'rlnAngleRot': ROT_PERIOD, 'rlnAnglePsi': ROT_PERIOD, 'rlnAngleTilt': None}
+SHIFT_LABELS = ['rlnOriginXAngst', 'rlnOriginYAngst']
+
+# Cutoffs of the clustering of the angles (degrees) and of the flattening factors of the shifts
+ANGLE_CUTOFF = 8
+SHIFTS_CUTOFF = 8
 
 
 class SmoothAnglesOrShifts(MethodBase):
@@ -20,11 +45,14 @@ class SmoothAnglesOrShifts(MethodBase):
         For angles = find the angels that are most common and applies them to all MT segments for each MT
         If there are no angles within the cutoff, the MT is omitted.
         For shifts = finds the flattest cluster and applies it to all MT segments for each MT
+        For joint = smooths angles and shifts (and optionally psi and tilt) in a single pass over the MTs and a single
+        output STAR file
 
     This method class is inheriting from MethodBase class and is using calculation methods written in method_base.py
     """
 
-    def __init__(self, star_file_input, output_path, method, cutoff=None):
+    def __init__(self, star_file_input, output_path, method, cutoff=None, chunk_size=None, compression=None,
+                 batched=False, workers=1, labels=None, incremental=False, delta=False):
         """
 
         The cutoff is referring to cutoff of number of segments meaning MTs with number of segments lower than the cutoff
@@ -32,14 +60,37 @@ class SmoothAnglesOrShifts(MethodBase):
 
         :param star_file_input: star files it00xx_data.star file
         :param output_path: path for the output star file location
-        :param method: 'angles' or 'shifts'
+        :param method: 'angles', 'shifts' or 'joint' (all the labels in a single pass)
         :param cutoff: minimal number of segments to include, if None, all MTs will be included
+        :param chunk_size: if set, the STAR file is read, smoothed and written in chunks of about chunk_size segments
+        (whole MTs) instead of loading it at once
+        :param compression: None for a plain STAR file (readable by RELION), 'gzip' or 'zstd' for a compressed one
+        :param batched: if True the shifts of all the MTs are clustered and fit at once and the angles are clustered MT
+        by MT and fit at once (see smooth_data_batched), only the discarded MTs are printed
+        :param workers: number of processes, the MTs are split between them by micrograph (see smooth_in_parallel)
+        :param labels: labels smoothed by the 'joint' method, rlnAngleRot, rlnOriginXAngst and rlnOriginYAngst if None
+        (rlnAnglePsi and rlnAngleTilt can be added)
+        :param incremental: if True the smoothed values of every MT are saved in the output directory, and MTs with the
+        same input values as in the previous run (e.g. on the previous iteration) are not smoothed again
+        :param delta: if True a delta file with only the smoothed columns is written instead of a complete STAR file
+        (see star_delta.py)
         """
         self.star_file_input = star_file_input.get()
         self.star_file_name = os.path.basename(self.star_file_input)
         self.output_path = output_path.get()
         self.method = method.get()
         self.cutoff = cutoff
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.batched = batched
+        self.workers = workers
+        self.labels = list(labels) if labels else SMOOTHED_LABELS['joint']
+        self.incremental = incremental
+        self.delta = delta
+        self.results = None
+        for label in self.labels:
+            if label not in ANGLE_PERIODS and label not in SHIFT_LABELS:
+                raise ValueError(f"Can't smooth {label}, use {list(ANGLE_PERIODS) + SHIFT_LABELS}")
 
     @print_done_decorator
     def smooth_angles_or_shifts(self):
@@ -48,44 +99,350 @@ class SmoothAnglesOrShifts(MethodBase):
 
         Returns:
         tuple: A tuple containing the original particles dataframe and the smoothed particles dataframe.
+        When reading in chunks both dataframes are empty since the data is never loaded at once.
         """
-        # Read data from the input STAR file
-        file = ParticlesStarfile(self.star_file_input)
+        if self.chunk_size:
+            return self.smooth_angles_or_shifts_in_chunks()
 
-        data = file.particles_dataframe
+        # Read data from the input STAR file, only the columns that are smoothed or plotted are loaded
+        file = ParticlesStarfile(self.star_file_input, columns=ANGLES_AND_SHIFTS_LABELS, workers=self.workers)
 
         # Filter microtubules by length if a cutoff is provided
-        if self.cutoff:
-            particles_dataframe = data.filter_microtubules_by_length(self.cutoff)
-        else:
-            particles_dataframe = data
+        particles_dataframe, microtubule_index = self.filter_by_cutoff(file.particles_dataframe,
+                                                                       file.microtubule_index)
 
         # Smooth the data based on the specified method
-        if self.method == 'angles':
-            particles_dataframe = self.smooth_data(particles_dataframe, id_label='rlnAngleRot')
-        elif self.method == 'shifts':
-            particles_dataframe = self.smooth_data(particles_dataframe, id_label='rlnOriginXAngst')
-            particles_dataframe = self.smooth_data(particles_dataframe, id_label='rlnOriginYAngst')
+        self.load_results()
+        particles_dataframe = self.smooth_by_method(particles_dataframe, microtubule_index)
+        self.save_results()
 
         # Create a dictionary with the updated optics and particles dataframes
         new_particles_star_file_data = {'optics': file.optics_dataframe, 'particles': particles_dataframe}
 
-        # Change to the output directory
-        os.chdir(self.output_path)
+        # Write the updated data to the output STAR file (or only the smoothed columns to a delta file)
+        output_file = self.output_file_name()
+        if self.delta:
+            write_star_delta(particles_dataframe, self.changed_labels(particles_dataframe),
+                             os.path.join(self.output_path, output_file), self.star_file_input)
+        else:
+            write_star_file(new_particles_star_file_data, os.path.join(self.output_path, output_file), file.sources)
+
+        print("=" * 50)
+        print(f"Updated STAR file saved as: {output_file} at {self.output_path}")
+
+        original_particles_dataframe = ParticlesStarfile(self.star_file_input,
+                                                         columns=ANGLES_AND_SHIFTS_LABELS).particles_dataframe
+        return original_particles_dataframe, particles_dataframe
+
+    def smooth_angles_or_shifts_in_chunks(self):
+        """
+        Same as smooth_angles_or_shifts, but the STAR file is read, smoothed and written in chunks of whole MTs so only
+        a single chunk is in memory at a time
 
-        # Generate the output file name
-        original_name = self.star_file_name.replace('.star', '')
-        output_file = f'{original_name}_smoothened_{self.method}.star'
+        Returns:
+        tuple: Two empty dataframes (the data is never loaded at once)
+        """
+        file = ParticlesStarfile(self.star_file_input, stream=True, columns=ANGLES_AND_SHIFTS_LABELS)
+        output_file = self.output_file_name()
+
+        if self.delta:
+            # Only the smoothed columns of the kept segments are kept until the delta file is written
+            self.load_results()
+            pieces = []
+            for particles_dataframe in file.iter_particles(self.chunk_size):
+                particles_dataframe = self.smooth_by_method(*self.filter_by_cutoff(particles_dataframe))
+                pieces.append(particles_dataframe[self.changed_labels(particles_dataframe)])
+            self.save_results()
+            smoothed = pd.concat(pieces) if pieces else pd.DataFrame(columns=self.smoothed_labels())
+            write_star_delta(smoothed, smoothed.columns, os.path.join(self.output_path, output_file),
+                             self.star_file_input)
 
-        # Write the updated data to the output STAR file
-        starfile.write(new_particles_star_file_data, output_file)
+        else:
+            self.write_chunks(file, output_file)
 
         print("=" * 50)
         print(f"Updated STAR file saved as: {output_file} at {self.output_path}")
 
-        return ParticlesStarfile(self.star_file_input).particles_dataframe, particles_dataframe
+        return pd.DataFrame(), pd.DataFrame()
+
+    def write_chunks(self, file, output_file):
+        """
+        Smooths the chunks of the STAR file and writes them to the output STAR file one after the other
+
+        :param file: ParticlesStarfile of the input STAR file, opened with stream=True
+        :param output_file: name of the output STAR file
+        """
+        with StarFileWriter(os.path.join(self.output_path, output_file)) as writer:
+            writer.write_loop_block('optics', file.optics_dataframe)
+            writer.start_loop_block('particles', file.blocks['particles'].labels)
+
+            self.load_results()
+            for particles_dataframe in file.iter_particles(self.chunk_size):
+                writer.write_rows(self.smooth_by_method(*self.filter_by_cutoff(particles_dataframe)))
+            self.save_results()
+
+    def filter_by_cutoff(self, particles_dataframe, microtubule_index=None):
+        """
+        Omits the MTs with less segments than the cutoff. The chunks of iter_particles hold whole MTs, so a chunk is
+        filtered the same way as the whole file.
+
+        :param particles_dataframe: The dataframe containing particle data.
+        :param microtubule_index: MicrotubuleIndex of particles_dataframe, built if not given
+        :return: The dataframe of the kept MTs and their MicrotubuleIndex
+        """
+        if microtubule_index is None:
+            microtubule_index = MicrotubuleIndex.from_dataframe(particles_dataframe)
+        if self.cutoff:
+            keep = microtubule_index.row_mask(microtubule_index.sizes >= self.cutoff)
+            particles_dataframe = particles_dataframe[keep]
+            microtubule_index = microtubule_index.select_rows(keep)
+        return particles_dataframe, microtubule_index
+
+    def smooth_by_method(self, particles_dataframe, microtubule_index=None):
+        """
+        Smooths rlnAngleRot for 'angles', rlnOriginXAngst and rlnOriginYAngst for 'shifts' or all the labels of the
+        'joint' method together
+
+        :param particles_dataframe: The dataframe containing particle data.
+        :param microtubule_index: MicrotubuleIndex of particles_dataframe, built if not given
+        :return: The dataframe with smoothed data.
+        """
+        if microtubule_index is None:
+            microtubule_index = MicrotubuleIndex.from_dataframe(particles_dataframe)
+        # The values are smoothed as parsed, not as their float32 approximation
+        expand_dtypes(particles_dataframe, self.smoothed_labels())
+        if self.results is not None:
+            return self.smooth_incrementally(particles_dataframe, microtubule_index)
+        return self.smooth_passes(particles_dataframe, microtubule_index)
+
+    def smooth_passes(self, particles_dataframe, microtubule_index):
+        """
+        Smooths the labels of the method, in a single pass for 'joint' or one label after the other
+
+        :param particles_dataframe: The dataframe containing particle data.
+        :param microtubule_index: MicrotubuleIndex of particles_dataframe
+        :return: The dataframe with smoothed data.
+        """
+        if self.workers > 1 and len(microtubule_index) > 1:
+            smooth_data = self.smooth_in_parallel
+        else:
+            smooth_data = self.smooth_microtubules
+
+        # The labels of the 'joint' method are smoothed in a single pass, the others one after the other
+        if self.method == 'joint':
+            label_passes = [self.labels]
+        else:
+            label_passes = [[label] for label in self.smoothed_labels()]
+
+        for id_labels in label_passes:
+            print('=' * 50)
+            print(f"Smoothing {', '.join(id_labels)}")
+            print('=' * 50)
+
+            total_mts = len(microtubule_index)
+            particles_dataframe, microtubule_index = smooth_data(particles_dataframe, id_labels, microtubule_index)
+
+            # MTs that can't be fit are omitted with all their segments
+            bad_mts = total_mts - len(microtubule_index)
+            if bad_mts:
+                print(f"{bad_mts} out of {total_mts} MTs were omitted")
+
+        return particles_dataframe
+
+    def load_results(self):
+        """
+        Loads the smoothed values of the previous run for incremental smoothing
+        """
+        if not self.incremental:
+            return
+        path = os.path.join(self.output_path, f'smoothing_results_{self.method}.npz')
+        parameters = {'method': self.method, 'labels': self.smoothed_labels(), 'angle_cutoff': ANGLE_CUTOFF,
+                      'shifts_cutoff': SHIFTS_CUTOFF, 'angle_periods': ANGLE_PERIODS, 'batched': self.batched}
+        self.results = MicrotubuleResults(path, parameters)
+
+    def save_results(self):
+        """
+        Saves the smoothed values of this run for incremental smoothing
+        """
+        if self.results is not None:
+            self.results.save()
+            print(f"Smoothed values of every MT saved to {self.results.path}")
+
+    def smooth_incrementally(self, particles_dataframe, microtubule_index):
+        """
+        Same as smooth_passes, but the MTs with the same input values as in the previous run get their smoothed values
+        from self.results and only the other MTs are smoothed. The results of all the MTs are added to self.results.
+
+        :param particles_dataframe: The dataframe containing particle data.
+        :param microtubule_index: MicrotubuleIndex of particles_dataframe
+        :return: The dataframe with smoothed data.
+        """
+        labels = self.smoothed_labels()
+        inputs = [RaggedArray.from_index(particles_dataframe[label].to_numpy(dtype=float), microtubule_index)
+                  for label in labels]
+        keys = microtubule_index.keys()
+        digests = MicrotubuleResults.input_digests(inputs)
+        entries = self.results.find(keys, digests)
+        reused = entries >= 0
+        print(f"{int(reused.sum())} out of {len(microtubule_index)} MTs didn't change since the previous run, their "
+              f"smoothed values are reused")
+
+        # Smoothing the changed MTs
+        changed_mask = microtubule_index.row_mask(~reused)
+        changed_rows = np.flatnonzero(changed_mask)
+        changed_dataframe = self.smooth_passes(particles_dataframe.iloc[changed_rows].reset_index(drop=True),
+                                               microtubule_index.select_rows(changed_mask))
+        kept_changed_rows = changed_rows[changed_dataframe.index.to_numpy()]
+
+        keep = ~changed_mask
+        keep[kept_changed_rows] = True
+        smoothed_values = {label: particles_dataframe[label].to_numpy(dtype=float, copy=True) for label in labels}
+        for label in labels:
+            smoothed_values[label][kept_changed_rows] = changed_dataframe[label].to_numpy()
+
+        # The reused MTs, the ones that were discarded in the previous run are discarded again
+        reused_kept = np.zeros(len(microtubule_index), dtype=bool)
+        reused_kept[reused] = self.results.kept[entries[reused]]
+        keep[microtubule_index.row_mask(reused & ~reused_kept)] = False
+        kept_groups = np.flatnonzero(reused_kept)
+        if len(kept_groups):
+            rows = RaggedArray.from_index(np.arange(len(particles_dataframe)), microtubule_index).take(kept_groups)
+            for label in labels:
+                smoothed_values[label][rows.values] = self.results.values[label].take(entries[kept_groups]).values
+        for label in labels:
+            particles_dataframe[label] = smoothed_values[label]
+
+        # Saving the results of all the MTs, all the segments of an MT are either kept or discarded
+        self.results.add(keys, digests, keep[microtubule_index.order[microtubule_index.starts]],
+                         {label: RaggedArray.from_index(smoothed_values[label], microtubule_index) for label in labels})
+
+        return particles_dataframe[keep]
+
+    def smoothed_labels(self):
+        """
+        :return: list of the labels smoothed by the method
+        """
+        if self.method == 'joint':
+            return self.labels
+        return SMOOTHED_LABELS.get(self.method, [])
+
+    def changed_labels(self, particles_dataframe):
+        """
+        :param particles_dataframe: the smoothed dataframe
+        :return: list of the labels changed by smoothing, the columns of a delta file
+        """
+        return [label for label in self.smoothed_labels() if label in particles_dataframe.columns]
+
+    def smooth_microtubules(self, particles_dataframe, id_labels, microtubule_index):
+        """
+        Smooths the labels of all the MTs in this process, with smooth_data_joint, smooth_data or smooth_data_batched
+
+        :param particles_dataframe: The dataframe containing particle data.
+        :param id_labels: list of the labels to smooth
+        :param microtubule_index: The index of the MTs in particles_dataframe.
+        :return: The dataframe with smoothed data and the index of the MTs in the returned dataframe.
+        """
+        if len(id_labels) > 1 and not self.batched:
+            return self.smooth_data_joint(particles_dataframe, id_labels, microtubule_index)
+
+        # The batched passes are vectorized over the MTs, so smoothing the labels one after the other shares the index
+        smooth_data = self.smooth_data_batched if self.batched else self.smooth_data
+        for id_label in id_labels:
+            particles_dataframe, microtubule_index = smooth_data(particles_dataframe, id_label, microtubule_index)
+        return particles_dataframe, microtubule_index
+
+    def smooth_in_parallel(self, particles_dataframe, id_labels, microtubule_index):
+        """
+        Same as smooth_microtubules, but the MTs are split by micrograph into a shard for every worker and smoothed on a
+        process pool. Every worker gets only the settings of the method and the columns of its shard, and the results
+        are written back in the order of the shards, so the output (and the printed messages) are the same as smoothing
+        in a single process.
+
+        :param particles_dataframe: The dataframe containing particle data.
+        :param id_labels: list of the labels to smooth
+        :param microtubule_index: The index of the MTs in particles_dataframe.
+        :return: The dataframe with smoothed data and the index of the MTs in the returned dataframe.
+        """
+        columns = {label: particles_dataframe[label].to_numpy() for label in MICROTUBULE_LABELS + list(id_labels)}
+        shard_rows = [microtubule_index.order[microtubule_index.starts[first]:microtubule_index.stops[end - 1]]
+                      for first, end in microtubule_index.split_by_micrograph(self.workers)]
+
+        with ProcessPoolExecutor(max_workers=len(shard_rows)) as pool:
+            futures = [pool.submit(_smooth_shard, self.worker_settings(), id_labels,
+                                   {label: values[rows] for label, values in columns.items()})
+                       for rows in shard_rows]
+            results = [future.result() for future in futures]
+
+        keep = np.ones(len(particles_dataframe), dtype=bool)
+        smoothed_values = {label: particles_dataframe[label].to_numpy(dtype=float, copy=True) for label in id_labels}
+        for rows, (kept, shard_values, output) in zip(shard_rows, results):
+            print(output, end='')
+            keep[rows] = False
+            keep[rows[kept]] = True
+            for label in id_labels:
+                smoothed_values[label][rows[kept]] = shard_values[label]
+
+        for label in id_labels:
+            particles_dataframe[label] = smoothed_values[label]
+        if not keep.all():
+            particles_dataframe = particles_dataframe[keep]
+            microtubule_index = microtubule_index.select_rows(keep)
+
+        return particles_dataframe, microtubule_index
+
+    def worker_settings(self):
+        """
+        :return: dictionary of the settings used by smooth_microtubules, sent to the workers of smooth_in_parallel
+        instead of the whole method (which holds the results of the previous run when smoothing incrementally)
+        """
+        return {'method': self.method, 'batched': self.batched, 'labels': self.labels, 'workers': 1, 'results': None}
+
+    @classmethod
+    def from_worker_settings(cls, settings):
+        """
+        :param settings: dictionary from worker_settings
+        :return: SmoothAnglesOrShifts without input and output files, used only to smooth the MTs of a shard
+        """
+        method = cls.__new__(cls)
+        vars(method).update(settings)
+        return method
+
+    def output_file_name(self):
+        """
+        :return: name of the output STAR file (or delta file) according to the input file name and the method
+        """
+        original_name = strip_star_extension(self.star_file_name)
+        return star_file_name(f'{original_name}_smoothened_{self.method}', self.compression, self.delta)
 
-    def smooth_data(self, particles_dataframe, id_label):
+    def cluster_values(self, values, id_label):
+        """
+        Clusters the angles or shifts of a single MT
+
+        :param values: numpy array of the values of id_label of the MT
+        :param id_label: an angle (rlnAngleRot, rlnAnglePsi, rlnAngleTilt) or a shift (rlnOriginXAngst, rlnOriginYAngst)
+        :return: top cluster and low weight cluster (None if the MT can't be fit)
+        """
+        if id_label in ANGLE_PERIODS:
+            return cluster_angles(values, ANGLE_CUTOFF, ANGLE_PERIODS[id_label])
+        elif id_label in SHIFT_LABELS:
+            return self.flatten_and_cluster_shifts(values, SHIFTS_CUTOFF)
+        else:
+            raise ValueError("Unsupported id_label")
+
+    def fit_values(self, values, top_cluster, id_label):
+        """
+        Fits the angles or shifts of a single MT to the line of its top cluster
+
+        :param values: numpy array of the values of id_label of the MT
+        :param top_cluster: top cluster from cluster_values
+        :param id_label: the label of the values
+        :return: fit values
+        """
+        if ANGLE_PERIODS.get(id_label) is not None:
+            return self.fit_angle_clusters(values, top_cluster, ANGLE_PERIODS[id_label])
+        return self.fit_clusters(values, top_cluster)
+
+    def smooth_data(self, particles_dataframe, id_label, microtubule_index):
         """
         Smooths data in the particles dataframe based on the specified ID label rlnAngleRot, rlnOriginXAngst,
         rlnOriginYAngst.
@@ -93,53 +450,151 @@ class SmoothAnglesOrShifts(MethodBase):
         Parameters:
         particles_dataframe (pd.DataFrame): The dataframe containing particle data.
         id_label (str): The label indicating which column to smooth (e.g., 'rlnAngleRot', 'rlnOriginXAngst').
+        microtubule_index (MicrotubuleIndex): The index of the MTs in particles_dataframe.
 
         Returns:
         pd.DataFrame: The dataframe with smoothed data.
+        MicrotubuleIndex: The index of the MTs in the returned dataframe.
 
         """
+        keep = np.ones(len(particles_dataframe), dtype=bool)
+        smoothed_values = particles_dataframe[id_label].to_numpy(dtype=float, copy=True)
 
-        print('=' * 50)
-        print(f'Smoothing {id_label}')
-        print('=' * 50)
+        for (micrograph, MT), rows in microtubule_index:
+            # The angles or shifts of a single MT
+            values = smoothed_values[rows]
 
-        bad_mts = [] # List to keep track of microtubules that cannot be fitted
-        grouped_data = groupby_micrograph_and_helical_id(particles_dataframe)
+            # Get top cluster
+            top_clstr, outliers = self.cluster_values(values, id_label)
+            if top_clstr:
+                print(f'Now fitting MT {MT} in micrograph {micrograph}')
+                smoothed_values[rows] = self.fit_values(values, top_clstr, id_label)
+            else:
+                print(f'MT {MT} in micrograph {micrograph}, {id_label} cannot be fit, and is discarded')
+                keep[rows] = False
 
-        for (micrograph, MT), MT_dataframe in grouped_data:
-            # Create masks for current micrograph and helical tube
-            mask1 = particles_dataframe['rlnMicrographName'] == micrograph
-            mask2 = particles_dataframe['rlnHelicalTubeID'] == MT
+        particles_dataframe[id_label] = smoothed_values
 
-            # Converting the angles or shifts of a single MT to numpy array
-            values = MT_dataframe[id_label].to_numpy()
+        # Omit bad MTs, all their segments are removed
+        if not keep.all():
+            particles_dataframe = particles_dataframe[keep]
+            microtubule_index = microtubule_index.select_rows(keep)
 
-            # Get top cluster
-            if id_label == 'rlnAngleRot':
-                angle_cutoff = 8
-                top_clstr, outliers = self.cluster_shallow_slopes(values, angle_cutoff)
-            elif id_label in ['rlnOriginXAngst', 'rlnOriginYAngst']:
-                shifts_cutoff = 8
-                top_clstr, outliers = self.flatten_and_cluster_shifts(values, shifts_cutoff)
+        return particles_dataframe, microtubule_index
+
+    def smooth_data_joint(self, particles_dataframe, id_labels, microtubule_index):
+        """
+        Same as smooth_data for several labels in a single pass over the MTs: every MT is fit for all the labels at once
+        and is discarded if any of them can't be fit.
+
+        :param particles_dataframe: The dataframe containing particle data.
+        :param id_labels: list of the labels to smooth (angles and shifts)
+        :param microtubule_index: The index of the MTs in particles_dataframe.
+        :return: The dataframe with smoothed data and the index of the MTs in the returned dataframe.
+        """
+        keep = np.ones(len(particles_dataframe), dtype=bool)
+        smoothed_values = {label: particles_dataframe[label].to_numpy(dtype=float, copy=True) for label in id_labels}
+
+        for (micrograph, MT), rows in microtubule_index:
+            fit_values = {}
+            for id_label in id_labels:
+                values = smoothed_values[id_label][rows]
+                top_clstr, outliers = self.cluster_values(values, id_label)
+                if not top_clstr:
+                    print(f'MT {MT} in micrograph {micrograph}, {id_label} cannot be fit, and is discarded')
+                    keep[rows] = False
+                    break
+                fit_values[id_label] = self.fit_values(values, top_clstr, id_label)
             else:
-                raise ValueError("Unsupported id_label")
-            if top_clstr:
                 print(f'Now fitting MT {MT} in micrograph {micrograph}')
-                MT_dataframe.reset_index(inplace=True)
+                for id_label, values in fit_values.items():
+                    smoothed_values[id_label][rows] = values
 
-                values = MT_dataframe.loc[:, id_label].to_numpy()
-                fitted_values = self.fit_clusters(values, top_clstr)
+        for id_label in id_labels:
+            particles_dataframe[id_label] = smoothed_values[id_label]
 
-                particles_dataframe.loc[mask1 & mask2, id_label] = fitted_values
-            else:
-                print(f'MT {MT} in micrograph {micrograph}, {id_label} cannot be fit, and is discarded')
-                matching_rows = particles_dataframe[mask1 & mask2]
-                index_numbers = matching_rows.index
-                bad_mts.append(index_numbers[0])
+        # Omit bad MTs, all their segments are removed
+        if not keep.all():
+            particles_dataframe = particles_dataframe[keep]
+            microtubule_index = microtubule_index.select_rows(keep)
 
-        # Omit bad MTs
-        if bad_mts:
-            particles_dataframe.drop(bad_mts, inplace=True)
-            print(f"{len(bad_mts)} out of {len(grouped_data)} MTs were omitted")
+        return particles_dataframe, microtubule_index
 
-        return particles_dataframe
+    def smooth_data_batched(self, particles_dataframe, id_label, microtubule_index):
+        """
+        Same as smooth_data, but the values of all the MTs are packed in a RaggedArray. The shifts of all the MTs are
+        flattened, clustered by their histogram bins and fit at once (see flatten_and_cluster_shifts_batched). The
+        clustering of the angles merges pairs of angles one after the other, so it is done MT by MT (with
+        cluster_angles) and only the fit of the angles is done for all the MTs at once.
+
+        :param particles_dataframe: The dataframe containing particle data.
+        :param id_label: The label of the column to smooth (rlnAngleRot, rlnOriginXAngst or rlnOriginYAngst).
+        :param microtubule_index: The index of the MTs in particles_dataframe.
+        :return: The dataframe with smoothed data and the index of the MTs in the returned dataframe.
+        """
+        ragged = RaggedArray.from_index(particles_dataframe[id_label].to_numpy(dtype=float), microtubule_index)
+        # Values of the top clusters, angles of top clusters that cross the wrap-around are unwrapped
+        cluster_values = ragged.values.copy()
+        unwrapped = np.zeros(len(ragged), dtype=bool)
+
+        if id_label in SHIFT_LABELS:
+            # Every MT has a top cluster of shifts
+            in_top_cluster = self.flatten_and_cluster_shifts_batched(ragged, SHIFTS_CUTOFF)
+            fitted = ragged.sizes > 0
+        else:
+            in_top_cluster = np.zeros(len(ragged.values), dtype=bool)
+            fitted = np.zeros(len(ragged), dtype=bool)
+            for group, (micrograph, MT) in enumerate(microtubule_index.keys()):
+                top_clstr, outliers = self.cluster_values(ragged[group], id_label)
+                if not top_clstr:
+                    print(f'MT {MT} in micrograph {micrograph}, {id_label} cannot be fit, and is discarded')
+                    continue
+
+                fitted[group] = True
+                top_cluster = ragged.offsets[group] + np.asarray(top_clstr)
+                in_top_cluster[top_cluster] = True
+                if ANGLE_PERIODS.get(id_label) is not None:
+                    top_angles = cluster_values[top_cluster]
+                    unwrapped_angles = unwrap_angles(top_angles, ANGLE_PERIODS[id_label])
+                    if unwrapped_angles is not top_angles:
+                        cluster_values[top_cluster] = unwrapped_angles
+                        unwrapped[group] = True
+
+        fit_values = ragged.fit_lines(in_top_cluster, cluster_values)
+        if unwrapped.any():
+            wrap = unwrapped[ragged.group_numbers()]
+            fit_values[wrap] = wrap_angles(fit_values[wrap], ANGLE_PERIODS[id_label])
+
+        smoothed_values = particles_dataframe[id_label].to_numpy(dtype=float, copy=True)
+        smoothed_values[microtubule_index.order] = fit_values
+        particles_dataframe[id_label] = smoothed_values
+
+        # Omit bad MTs, all their segments are removed
+        if not fitted.all():
+            keep = ~microtubule_index.row_mask(~fitted)
+            particles_dataframe = particles_dataframe[keep]
+            microtubule_index = microtubule_index.select_rows(keep)
+
+        return particles_dataframe, microtubule_index
+
+
+def _smooth_shard(settings, id_labels, columns):
+    """
+    Smooths the MTs of a shard in a worker process
+
+    :param settings: dictionary from SmoothAnglesOrShifts.worker_settings
+    :param id_labels: list of the labels to smooth
+    :param columns: dictionary of label: numpy array of the rows of the shard
+    :return: positions of the kept rows in the shard, dictionary of label: smoothed values of the kept rows and the
+    printed messages
+    """
+    particles_dataframe = pd.DataFrame(columns, copy=False)
+
+    method = SmoothAnglesOrShifts.from_worker_settings(settings)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        particles_dataframe, _ = method.smooth_microtubules(particles_dataframe, id_labels,
+                                                            MicrotubuleIndex.from_dataframe(particles_dataframe))
+
+    smoothed_values = {label: particles_dataframe[label].to_numpy() for label in id_labels}
+    return particles_dataframe.index.to_numpy(), smoothed_values, output.getvalue()
@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 15/04/24
-Updated: 15/04/24
+Updated: 18/10/26
 
 Methods for angles and shifts correction before high resolution reconstruction
 
@@ -9,11 +9,41 @@ Methods for angles and shifts correction before high resolution reconstruction
 
 import os
 import math
-import pandas as pd
-import starfile
+
+import numpy as np
 
 from ..methods_base.method_base import MethodBase, print_done_decorator
-from ..methods_base.particles_starfile import ParticlesStarfile
+from ..methods_base.particles_starfile import ParticlesStarfile, ANGLES_AND_SHIFTS_LABELS
+from ..methods_base.star_writer import write_star_file
+from ..methods_base.star_compression import strip_star_extension, star_file_name
+from ..methods_base.star_delta import write_star_delta
+from ..methods_base.particles_schema import expand_dtypes
+
+# Columns loaded from the input STAR file, the other columns are copied to the output untouched
+CORRECTION_LABELS = ANGLES_AND_SHIFTS_LABELS + ['rlnClassNumber']
+
+# Columns changed by the correction
+CORRECTED_LABELS = ['rlnOriginXAngst', 'rlnOriginYAngst', 'rlnAngleRot']
+
+# Corrections of the classes, see AnglesAndShiftsCorrection.class_corrections
+ROTATED_CLASS = 0
+SEAM_CLASS = 1
+OTHER_CLASS = 2
+
+
+def _math_elementwise(function, values):
+    """
+    Applies a function of the math module to every value. NumPy may compute sin and cos with a different rounding in
+    the last bit, this keeps the corrected values exactly those of the math module.
+    Every distinct value is computed once.
+
+    :param function: function of one float, e.g. math.cos
+    :param values: numpy array of float
+    :return: numpy array of the results
+    """
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    results = np.fromiter(map(function, unique_values.tolist()), dtype=float, count=len(unique_values))
+    return results[inverse]
 
 
 class AnglesAndShiftsCorrection(MethodBase):
@@ -21,7 +51,7 @@ class AnglesAndShiftsCorrection(MethodBase):
     Inherits from MethodBase class in method_base_py
     """
 
-    def __init__(self, star_file_input, pf_number, output_directory):
+    def __init__(self, star_file_input, pf_number, output_directory, compression=None, delta=False):
         """
         Reads the star_file_input then corrects the angles according to the pf_number and creates an output star file at
         the output_directory path
@@ -29,11 +59,35 @@ class AnglesAndShiftsCorrection(MethodBase):
         :param star_file_input: star file after 3D classification when checking the seam (seam_check)
         :param pf_number: number of protofilaments (used to calculate twist and rise)
         :param output_directory: output path for output star file
+        :param compression: None for a plain STAR file (readable by RELION), 'gzip' or 'zstd' for a compressed one
+        :param delta: if True a delta file with only the corrected columns is written instead of a complete STAR file
+        (see star_delta.py)
         """
         self.star_file_input = star_file_input.get()
         self.star_file_name = os.path.basename(self.star_file_input)
         self.pf_number = int(pf_number.get())
         self.output_directory = output_directory.get()
+        self.compression = compression
+        self.delta = delta
+
+    def class_corrections(self, classes):
+        """
+        Finds the correction of every segment in a lookup table of the corrections of the classes made from pf_number:
+        classes 1 to pf_number - 1 are ROTATED_CLASS, class pf_number is SEAM_CLASS and the other classes (including
+        classes that are not whole numbers) are OTHER_CLASS
+
+        :param classes: numpy array of the class (rlnClassNumber) of every segment
+        :return: numpy array of the correction of every segment
+        """
+        # Class number: correction
+        class_table = np.full(max(self.pf_number, int(np.nanmax(classes, initial=0))) + 1, OTHER_CLASS, dtype=np.int8)
+        class_table[1:self.pf_number] = ROTATED_CLASS
+        class_table[self.pf_number] = SEAM_CLASS
+
+        corrections = np.full(len(classes), OTHER_CLASS, dtype=np.int8)
+        in_table = (classes >= 0) & (classes == np.floor(classes))
+        corrections[in_table] = class_table[classes[in_table].astype(np.int64)]
+        return corrections
 
     @print_done_decorator
     def adjust_angles_and_translations(self):
@@ -45,9 +99,11 @@ class AnglesAndShiftsCorrection(MethodBase):
         """
 
         # Getting the optics and particles data blocks
-        file = ParticlesStarfile(self.star_file_input)
+        file = ParticlesStarfile(self.star_file_input, columns=CORRECTION_LABELS)
 
-        particles_dataframe = file.particles_dataframe
+        # The corrected values are computed from the values as parsed, so the corrected columns are kept in float64
+        particles_dataframe = expand_dtypes(file.particles_dataframe, ['rlnOriginXAngst', 'rlnOriginYAngst',
+                                                                       'rlnAngleRot', 'rlnAnglePsi'])
         data_optics_dataframe = file.optics_dataframe
 
         # Getting the pixel size from the optics data block
@@ -56,44 +112,64 @@ class AnglesAndShiftsCorrection(MethodBase):
         # Calculate helical twist and rise
         helical_twist = 360 / self.pf_number
         helical_rise = (3 * 41) / self.pf_number
-
-        # iterates over the rows in the particles data block
-        for index, row in particles_dataframe.iterrows():
-            # Skipped row that don't have rlnAnglePsi
-            if pd.isnull(row['rlnAnglePsi']):
-                print('No angels to correct!')
-                pass
-            else:
-                helical_shift = math.radians(row['rlnAnglePsi'])
-                helical_rise_pixels = helical_rise / pixel_size
-
-                if row['rlnClassNumber'] in range(1, 14):
-                    new_x = row['rlnOriginXAngst'] + math.cos(-helical_shift) * (row['rlnClassNumber'] * helical_rise_pixels)
-                    new_y = row['rlnOriginYAngst'] + math.sin(-helical_shift) * (row['rlnClassNumber'] * helical_rise_pixels)
-                    new_phi = row['rlnAngleRot'] + helical_twist
-
-                elif row['rlnClassNumber'] == 14:
-                    new_x = row['rlnOriginXAngst'] + -41 * math.cos(-helical_shift) * (row['rlnClassNumber'] * helical_rise_pixels)
-                    new_y = row['rlnOriginYAngst'] + -41 * math.sin(-helical_shift) * (row['rlnClassNumber'] * helical_rise_pixels)
-                    new_phi = row['rlnAngleRot']
-
-                else:
-                    new_x = row['rlnOriginXAngst'] + -41 * math.cos(-helical_shift) + math.cos(-helical_shift) * (row['rlnClassNumber'] * helical_rise_pixels)
-                    new_y = row['rlnOriginYAngst'] + -41 * math.sin(-helical_shift) + math.sin(-helical_shift) * (row['rlnClassNumber'] * helical_rise_pixels)
-                    new_phi = row['rlnAngleRot'] + helical_twist
-
-                # Update the DataFrame with adjusted coordinates
-                particles_dataframe.loc[index, 'rlnOriginXAngst'] = new_x
-                particles_dataframe.loc[index, 'rlnOriginYAngst'] = new_y
-                particles_dataframe.loc[index, 'rlnAngleRot'] = new_phi
-
-        # Write the modified DataFrame back to a new STAR file
+        helical_rise_pixels = helical_rise / pixel_size
+
+        psi = particles_dataframe['rlnAnglePsi'].to_numpy(dtype=float)
+        classes = particles_dataframe['rlnClassNumber'].to_numpy(dtype=float)
+
+        # Skipped rows that don't have rlnAnglePsi
+        corrected = ~np.isnan(psi)
+        if not corrected.all():
+            print(f'No angels to correct in {int(np.sum(~corrected))} segments!')
+
+        # The correction of every segment according to its class
+        corrections = self.class_corrections(classes[corrected])
+
+        # The cosine and sine of the helical shift, computed with math as a single segment would be
+        helical_shift = np.radians(psi[corrected])
+        cos_shift = _math_elementwise(math.cos, -helical_shift)
+        sin_shift = _math_elementwise(math.sin, -helical_shift)
+        rises = classes[corrected] * helical_rise_pixels
+
+        x = particles_dataframe['rlnOriginXAngst'].to_numpy(dtype=float, copy=True)
+        y = particles_dataframe['rlnOriginYAngst'].to_numpy(dtype=float, copy=True)
+        phi = particles_dataframe['rlnAngleRot'].to_numpy(dtype=float, copy=True)
+        old_x, old_y, old_phi = x[corrected], y[corrected], phi[corrected]
+
+        # Classes 1 to pf_number - 1 are shifted by their number of rises and turned by one twist
+        new_x = old_x + cos_shift * rises
+        new_y = old_y + sin_shift * rises
+        new_phi = old_phi + helical_twist
+
+        # The seam class (pf_number) is shifted back by 41 A times its number of rises and is not turned
+        seam = corrections == SEAM_CLASS
+        new_x[seam] = old_x[seam] + -41 * cos_shift[seam] * rises[seam]
+        new_y[seam] = old_y[seam] + -41 * sin_shift[seam] * rises[seam]
+        new_phi[seam] = old_phi[seam]
+
+        # The other classes are shifted back by 41 A and forward by their number of rises
+        other = corrections == OTHER_CLASS
+        new_x[other] = old_x[other] + -41 * cos_shift[other] + cos_shift[other] * rises[other]
+        new_y[other] = old_y[other] + -41 * sin_shift[other] + sin_shift[other] * rises[other]
+
+        # Update the DataFrame with adjusted coordinates
+        x[corrected], y[corrected], phi[corrected] = new_x, new_y, new_phi
+        particles_dataframe['rlnOriginXAngst'] = x
+        particles_dataframe['rlnOriginYAngst'] = y
+        particles_dataframe['rlnAngleRot'] = phi
+
+        # Write the modified DataFrame back to a new STAR file (or only the corrected columns to a delta file)
         os.makedirs(self.output_directory, exist_ok=True)
-        os.chdir(self.output_directory)
         new_particles_star_file_data = {'optics': data_optics_dataframe, 'particles': particles_dataframe}
-        new_star_file = self.star_file_name.replace('.star', '_angles_shifts_corrected.star')
-        starfile.write(new_particles_star_file_data, new_star_file)
+        new_star_file = star_file_name(f'{strip_star_extension(self.star_file_name)}_angles_shifts_corrected',
+                                       self.compression, self.delta)
+        if self.delta:
+            write_star_delta(particles_dataframe, CORRECTED_LABELS, os.path.join(self.output_directory, new_star_file),
+                             self.star_file_input)
+        else:
+            write_star_file(new_particles_star_file_data, os.path.join(self.output_directory, new_star_file),
+                            file.sources)
 
         print(f"Updated STAR file saved as: {new_star_file} at {self.output_directory}")
 
-        return ParticlesStarfile(self.star_file_input).particles_dataframe, particles_dataframe
+        return ParticlesStarfile(self.star_file_input, columns=CORRECTION_LABELS).particles_dataframe, particles_dataframe
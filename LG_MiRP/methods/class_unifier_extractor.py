@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 14/03/24
-Updated: 29/07/24
+Updated: 18/10/26
 
 Method to unify classes by protofilament numbers or location of seam after 3D-classification
 The method counts how many times each class was assigned to segments of the same MT and assign the most common class
@@ -14,11 +14,17 @@ therefore will reset the angles and shifts to prior
 import os
 import datetime
 
-import starfile
+import numpy as np
 import matplotlib.pyplot as plt
 
 from ..methods_base.method_base import MethodBase, print_done_decorator
-from ..methods_base.particles_starfile import ParticlesStarfile, groupby_micrograph_and_helical_id
+from ..methods_base.particles_starfile import ParticlesStarfile, MICROTUBULE_LABELS
+from ..methods_base.class_count_matrix import ClassCountMatrix
+from ..methods_base.star_writer import write_star_file, write_partitioned_star_files
+from ..methods_base.star_compression import strip_star_extension, star_file_name
+
+# Columns loaded from the input STAR files, the other columns of run_it000_data.star are copied to the output untouched
+CLASS_LABELS = MICROTUBULE_LABELS + ['rlnClassNumber']
 
 
 class ClassUnifierExtractor(MethodBase):
@@ -26,22 +32,60 @@ class ClassUnifierExtractor(MethodBase):
 
     """
 
-    def __init__(self, star_file_input0, star_file_input1, output_path, cutoff, step):
+    def __init__(self, star_file_input0, star_file_input1, output_path, cutoff, step, compression=None, log_mts=True):
+        """
+        :param star_file_input0: run_it000_data.star file
+        :param star_file_input1: run_it0xx_data.star file with the classes
+        :param output_path: output directory
+        :param cutoff: minimal proportion of the most common class of an MT, MTs below it are discarded
+        :param step: 'pf_number_check' or 'seam_check'
+        :param compression: None for plain output STAR files (readable by RELION), 'gzip' or 'zstd' for compressed ones
+        :param log_mts: if True the most common class of every MT is printed, which takes long for millions of MTs
+        """
         self.star_file_input0 = star_file_input0.get()
         self.star_file_input1 = star_file_input1.get()
-        # Read data from "run_it000_data.star" using starfile
-        data0 = ParticlesStarfile(self.star_file_input0)
+        # Read "run_it000_data.star" and then "run_it0xx_data.star", each one on all the CPUs. They are not read at the
+        # same time from two threads, forking the parsing processes while another thread holds a lock can deadlock.
+        workers = os.cpu_count() or 1
+        data0 = self.read_input_star_file(self.star_file_input0, workers)
+        data1 = self.read_input_star_file(self.star_file_input1, workers)
+
+        # Data from "run_it000_data.star"
         self.particles_dataframe0 = data0.particles_dataframe
+        self.microtubule_index0 = data0.microtubule_index
+        self.sources0 = data0.sources
 
-        # Read data from "run_it0xx_data.star" using starfile
-        data1 = ParticlesStarfile(self.star_file_input1)
+        # Data from "run_it0xx_data.star"
         self.particles_dataframe1 = data1.particles_dataframe
+        self.microtubule_index1 = data1.microtubule_index
+        self.class_counts1 = data1.class_counts
         self.data_optics_dataframe1 = data1.optics_dataframe
         self.star_file_name = os.path.basename(self.star_file_input1)
         self.output_path = output_path.get()
         self.cutoff = float(cutoff.get())
         self.bad_mts = 0
+        # (micrograph, MT, proportion) of the MTs that didn't meet the cutoff
+        self.rejected_mts = []
         self.step = step
+        # None for plain output STAR files (readable by RELION), 'gzip' or 'zstd' for compressed ones
+        self.compression = compression
+        self.log_mts = log_mts
+
+    @staticmethod
+    def read_input_star_file(star_file, workers):
+        """
+        Reads the columns needed for class unification from an input STAR file and builds (or loads) its microtubule
+        index and its MT x class count matrix
+
+        :param star_file: path of the STAR file
+        :param workers: number of processes used to parse the particles data block
+        :return: ParticlesStarfile
+        """
+        data = ParticlesStarfile(star_file, columns=CLASS_LABELS, workers=workers)
+        data.microtubule_index
+        if 'rlnClassNumber' in data.particles_dataframe.columns:
+            data.class_counts
+        return data
 
     @print_done_decorator
     def class_unifier_extractor(self):
@@ -49,7 +93,10 @@ class ClassUnifierExtractor(MethodBase):
         # Takes only the unique micrographs from the star file
         class_unified_particles_dataframe = self.unify_class_numbers()
 
-        original_data_star_name = self.star_file_name.replace('.star', '')
+        original_data_star_name = strip_star_extension(self.star_file_name)
+
+        # Counting the segments and MTs of every class once, for the printing and the report
+        self.segment_counts, self.mt_counts = self.count_classes(class_unified_particles_dataframe)
 
         if self.step == 'pf_number_check':
             # EXTRACTING THE SEGMENTS TO SEPARATE STAR FILES ACCORDING TO THEIR CLASS
@@ -57,37 +104,31 @@ class ClassUnifierExtractor(MethodBase):
 
             # Iterates over the number of classes
             for i in number_of_classes:
-
-                # Filtering the datarfame for the specific class i
-                mask_class = class_unified_particles_dataframe['rlnClassNumber'] == i
-                class_particles = class_unified_particles_dataframe.loc[mask_class]
-
-                total_MTs_of_class_i = len(groupby_micrograph_and_helical_id(class_particles))
-
-                print(f"There are {total_MTs_of_class_i} MTs of class {i}")
-
-                # Generating a new STAR file using the optics from run_it001_data.star and the new particles (segments)
-                # data with corrected classes after unification
-
-                new_particles_star_file_data = {'optics': self.data_optics_dataframe1, 'particles': class_particles}
-
-                os.chdir(self.output_path)
-                output_file = f'{original_data_star_name}_class_{i}.star'
-                try:
-                    starfile.write(new_particles_star_file_data, output_file)
-                    print(f'Saved STAR file {output_file} at {self.output_path}')
-                except NameError:
-                    print(f"File names {output_file} already exists, delete old file and try again")
-                    raise NameError("File already exists")
+                print(f"There are {self.mt_counts.get(i, 0)} MTs of class {i}")
+
+            # Generating a new STAR file for every class using the optics from run_it001_data.star and the new particles
+            # (segments) data with corrected classes after unification. All the files are written in a single pass
+            # over the segments, every segment goes to the file of its class
+            new_particles_star_file_data = {'optics': self.data_optics_dataframe1,
+                                            'particles': class_unified_particles_dataframe}
+
+            output_files = {i: star_file_name(f'{original_data_star_name}_class_{i}', self.compression)
+                            for i in number_of_classes}
+            write_partitioned_star_files(new_particles_star_file_data, 'particles', 'rlnClassNumber',
+                                         {i: os.path.join(self.output_path, output_file)
+                                          for i, output_file in output_files.items()},
+                                         self.sources0)
+            for output_file in output_files.values():
+                print(f'Saved STAR file {output_file} at {self.output_path}')
 
         elif self.step == 'seam_check':
             # EXTRACTING THE SEGMENTS TO A SINGLE STAR FILES WITH CORRECTED CLASSES
             new_particles_star_file_data = {'optics': self.data_optics_dataframe1, 'particles': class_unified_particles_dataframe}
 
-            os.chdir(self.output_path)
-            output_file = f'{original_data_star_name}_class_corrected.star'
+            output_file = star_file_name(f'{original_data_star_name}_class_corrected', self.compression)
             try:
-                starfile.write(new_particles_star_file_data, output_file)
+                write_star_file(new_particles_star_file_data, os.path.join(self.output_path, output_file),
+                                self.sources0)
                 print(f'Saved STAR file {output_file} at {self.output_path}')
             except NameError:
                 print(f"File names {output_file} already exists, delete old file and try again")
@@ -95,6 +136,8 @@ class ClassUnifierExtractor(MethodBase):
 
         self.generate_report(class_unified_particles_dataframe)
 
+        return self.unified_class_counts
+
     def unify_class_numbers(self):
         """
         Finds the most common class for each MT and assigns it to all MT segments.
@@ -103,51 +146,73 @@ class ClassUnifierExtractor(MethodBase):
 
         :return: updated particles dataframe with original angles and shifts
         """
-        # Group by 'rlnMicrographName' and 'rlnHelicalTubeID'
-        grouped_data = groupby_micrograph_and_helical_id(self.particles_dataframe1)
-
-        for (micrograph, MT), MT_dataframe in grouped_data:
-            # Get the most common class number in the current MT segment
-            most_common_class = MT_dataframe['rlnClassNumber'].mode().iloc[0]
-
-            # Log the information
-            number_of_appearances = MT_dataframe[MT_dataframe['rlnClassNumber'] == most_common_class].shape[0]
-            total_number = len(MT_dataframe)
-            proportion = number_of_appearances / total_number
-            print(f'MT {MT} in {micrograph}:')
-            print(f'The most common class is {most_common_class}')
-            print(f'It appears {number_of_appearances} out of {total_number} times')
-            print('=' * 100)
-
-            # Apply the most common class number to all segments of the MT in the original dataframe
-            if proportion >= self.cutoff:
-                # Apply the most common class number to all segments of the MT in the original dataframe
-                mask = (self.particles_dataframe0['rlnMicrographName'] == micrograph) & (
-                        self.particles_dataframe0['rlnHelicalTubeID'] == MT)
-                self.particles_dataframe0.loc[mask, 'rlnClassNumber'] = most_common_class
-            else:
-                # Discard the MT segments by removing them from the original dataframe
-                mask = (self.particles_dataframe0['rlnMicrographName'] == micrograph) & (
-                        self.particles_dataframe0['rlnHelicalTubeID'] == MT)
-                self.particles_dataframe0 = self.particles_dataframe0[~mask]
-                self.bad_mts += 1
-
-        print(f"{self.bad_mts} out of {len(grouped_data)} MTs were omitted since they didn't meet the cutoff requirement")
+        # The classes of run_it000_data.star
+        if 'rlnClassNumber' in self.particles_dataframe0.columns:
+            classes0 = self.particles_dataframe0['rlnClassNumber'].to_numpy(copy=True)
+        else:
+            classes0 = np.full(len(self.particles_dataframe0), np.nan)
+
+        # The most common class number of every MT, the number of its appearances and their proportion
+        most_common_classes, appearances, proportions = self.class_counts1.mode()
+        passed = proportions >= self.cutoff
+
+        keys1 = self.microtubule_index1.keys()
+        if self.log_mts:
+            for group, (micrograph, MT) in enumerate(keys1):
+                # Log the information
+                print(f'MT {MT} in {micrograph}:')
+                print(f'The most common class is {most_common_classes[group]}')
+                print(f'It appears {int(appearances[group])} out of {int(self.class_counts1.sizes[group])} times')
+                print('=' * 100)
+
+        # MTs that didn't meet the cutoff are discarded
+        rejected = np.flatnonzero(~passed)
+        self.bad_mts = len(rejected)
+        self.rejected_mts = [(*keys1[group], float(proportions[group])) for group in rejected.tolist()]
+
+        # The MT of every row of the original dataframe in run_it0xx_data.star (-1 for rows of MTs that are not there),
+        # all the MTs are matched at once with a hash index on the MT key
+        rows_groups1 = self.microtubule_index0.to_rows(self.microtubule_index0.match(self.microtubule_index1), fill=-1)
+        matched = rows_groups1 >= 0
+
+        # Apply the most common class number to all segments of the MT in the original dataframe, and discard the
+        # segments of the MTs that didn't meet the cutoff
+        unified = matched & passed[rows_groups1]
+        classes0[unified] = most_common_classes[rows_groups1[unified]]
+        keep0 = ~matched | unified
+
+        print(f"{self.bad_mts} out of {len(self.microtubule_index1)} MTs were omitted since they didn't meet the cutoff "
+              f"requirement")
+
+        self.particles_dataframe0['rlnClassNumber'] = classes0
+        self.particles_dataframe0 = self.particles_dataframe0[keep0]
+        self.unified_microtubule_index = self.microtubule_index0.select_rows(keep0)
 
         return self.particles_dataframe0
 
+    def count_classes(self, class_unified_particles_dataframe):
+        """
+        Counts the segments and the MTs of every class from the MT x class count matrix of the unified classes
+
+        :param class_unified_particles_dataframe: Dataframe with unified class numbers
+        :return: pandas.Series of the number of segments of every class (most common first) and dictionary of
+        class: number of MTs
+        """
+        self.unified_class_counts = ClassCountMatrix.from_index(
+            class_unified_particles_dataframe['rlnClassNumber'].to_numpy(), self.unified_microtubule_index)
+        return self.unified_class_counts.class_segment_counts(), self.unified_class_counts.class_mt_counts()
+
     @staticmethod
-    def classes_distribution_fig(input_particles_dataframe):
+    def classes_distribution_fig(class_counts):
         """
-        A method to generate a histogram from number of segments per MT
+        A method to generate a pie chart of the segments of every class
 
+        :param class_counts: ClassCountMatrix of the classes
         :return: matplotlib pie % fig
         """
 
-        # Access the 'rlnClassNumber' column and get unique values
-        classes_value_counts = input_particles_dataframe['rlnClassNumber'].value_counts()
-
         # The classes and the nuber of their appearances (values)
+        classes_value_counts = class_counts.class_segment_counts()
         classes = classes_value_counts.index
         values = classes_value_counts.values
 
@@ -172,8 +237,8 @@ class ClassUnifierExtractor(MethodBase):
         """
         report_path = os.path.join(self.output_path, 'class_unification_report.txt')
         total_segments = len(class_unified_particles_dataframe)
-        total_MTs = len(groupby_micrograph_and_helical_id(class_unified_particles_dataframe))
-        total_MTs_before_cutoff = len(groupby_micrograph_and_helical_id(self.particles_dataframe1))
+        total_MTs = len(self.unified_microtubule_index)
+        total_MTs_before_cutoff = len(self.microtubule_index1)
 
         with open(report_path, 'w') as report_file:
             report_file.write(f"Class Unification Report\n")
@@ -188,23 +253,15 @@ class ClassUnifierExtractor(MethodBase):
             report_file.write(f"Number of segments: {total_segments}\n")
             report_file.write(f"Optics Dataframe:\n{self.data_optics_dataframe1.to_string()}\n\n")
 
-            class_counts = class_unified_particles_dataframe['rlnClassNumber'].value_counts()
             report_file.write(f"Class Distribution:\n")
-            for class_number, count in class_counts.items():
-                mt_count = len(groupby_micrograph_and_helical_id(class_unified_particles_dataframe[
-                                                                     class_unified_particles_dataframe[
-                                                                         'rlnClassNumber'] == class_number]))
+            for class_number, count in self.segment_counts.items():
+                mt_count = self.mt_counts[class_number]
                 report_file.write(f"Class {class_number}: {count} segments, {mt_count}/{total_MTs} MTs "
                                   f"[({round((mt_count/total_MTs)*100, 2)}]%)\n")
 
             report_file.write(f"\n{self.bad_mts} MTs out of {total_MTs_before_cutoff} total MTs "
                               f"did not meet the cutoff ({self.cutoff}):\n")
-            for (micrograph, MT), MT_dataframe in groupby_micrograph_and_helical_id(self.particles_dataframe1):
-                most_common_class = MT_dataframe['rlnClassNumber'].mode().iloc[0]
-                number_of_appearances = MT_dataframe[MT_dataframe['rlnClassNumber'] == most_common_class].shape[0]
-                total_number = len(MT_dataframe)
-                proportion = number_of_appearances / total_number
-                if proportion < self.cutoff:
-                    report_file.write(f'MT {MT} in {micrograph} did not meet the cutoff with proportion {proportion}\n')
+            for micrograph, MT, proportion in self.rejected_mts:
+                report_file.write(f'MT {MT} in {micrograph} did not meet the cutoff with proportion {proportion}\n')
 
         print(f'Report generated at {report_path}')
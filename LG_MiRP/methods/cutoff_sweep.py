@@ -0,0 +1,215 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Method to choose the cutoffs of smoothing and class unification: the angle cutoff and the shift cutoff of
+SmoothAnglesOrShifts and the proportion cutoff of ClassUnifierExtractor are evaluated for a whole grid of values in one
+pass over the data, instead of rerunning the job with every cutoff.
+
+For every MT a statistic that decides its fate is computed once, for all the MTs at once:
+    angles - the smallest gap between two rot angles, the MT is kept when a pair is within the cutoff (cluster_angles)
+    proportion - the proportion of the most common class, the MT is kept when it reaches the cutoff
+The statistics are sorted once and the number of retained MTs and segments at every cutoff is found by binary search.
+Shifts never discard an MT, the shift cutoff is the range of the flattening factors, so for shifts the number of
+segments in the top clusters (the segments the line is fit to) and the number of MTs whose best flattening factor is at
+the edge of the range are reported. The flatness scores are computed once for all the factors of all the cutoffs and
+the top clusters of all the MTs are found at once for every cutoff (MethodBase.cluster_flattened_shifts_batched).
+
+"""
+import os
+import datetime
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from ..methods_base.method_base import MethodBase, print_done_decorator
+from ..methods_base.particles_starfile import ParticlesStarfile, MICROTUBULE_LABELS
+from ..methods_base.ragged_array import RaggedArray
+from ..methods_base.grouped_kernels import grouped_min_gap, grouped_mode
+from ..methods_base.particles_schema import expand_dtypes
+from .angles_and_shifts_smoothing import ANGLE_PERIODS, SHIFT_LABELS, ANGLE_CUTOFF, SHIFTS_CUTOFF
+
+# Columns loaded from the input STAR file
+SWEEP_LABELS = MICROTUBULE_LABELS + ['rlnAngleRot', 'rlnOriginXAngst', 'rlnOriginYAngst', 'rlnClassNumber']
+
+# Default grids of the cutoffs
+ANGLE_CUTOFFS = list(range(1, 21))
+SHIFTS_CUTOFFS = list(range(2, 17, 2))
+PROPORTION_CUTOFFS = [round(cutoff, 2) for cutoff in np.arange(0.3, 1.0001, 0.05)]
+
+
+def retained_curve(statistics, sizes, cutoffs, keep_below=True):
+    """
+    Number of MTs and segments retained at every cutoff, from a statistic of every MT sorted once
+
+    :param statistics: numpy array of the statistic of every MT
+    :param sizes: numpy array of the number of segments of every MT
+    :param cutoffs: list of the cutoffs
+    :param keep_below: if True an MT is retained when its statistic is at most the cutoff, otherwise when it is at
+    least the cutoff
+    :return: numpy arrays of the number of retained MTs and of retained segments at every cutoff
+    """
+    order = np.argsort(statistics, kind='stable')
+    sorted_statistics = statistics[order]
+    # Segments of the first n MTs in the sorted order
+    segments = np.append(0, np.cumsum(sizes[order]))
+
+    if keep_below:
+        counts = np.searchsorted(sorted_statistics, cutoffs, side='right')
+        return counts, segments[counts]
+    starts = np.searchsorted(sorted_statistics, cutoffs, side='left')
+    return len(statistics) - starts, segments[-1] - segments[starts]
+
+
+class CutoffSweep(MethodBase):
+    """
+    Method to evaluate grids of cutoffs of smoothing and class unification on a STAR file
+    """
+
+    def __init__(self, star_file_input, output_path, angle_cutoffs=None, shifts_cutoffs=None,
+                 proportion_cutoffs=None):
+        """
+        :param star_file_input: run_itxxx_data.star file (the proportion cutoff is evaluated only if it has
+        rlnClassNumber)
+        :param output_path: directory of the report and the figure
+        :param angle_cutoffs: list of the angle cutoffs in degrees, ANGLE_CUTOFFS if None
+        :param shifts_cutoffs: list of the shift cutoffs (range of the flattening factors), SHIFTS_CUTOFFS if None
+        :param proportion_cutoffs: list of the proportion cutoffs between 0 and 1, PROPORTION_CUTOFFS if None
+        """
+        self.star_file_input = star_file_input.get()
+        self.output_path = output_path.get()
+        self.angle_cutoffs = sorted(angle_cutoffs or ANGLE_CUTOFFS)
+        self.shifts_cutoffs = sorted(shifts_cutoffs or SHIFTS_CUTOFFS)
+        self.proportion_cutoffs = sorted(proportion_cutoffs or PROPORTION_CUTOFFS)
+        # Curves of every sweep (angles, a shift label or proportion): dictionary of column name: values at every cutoff
+        self.curves = {}
+
+    @print_done_decorator
+    def cutoff_sweep(self):
+        """
+        Evaluates all the cutoffs and saves the curves to cutoff_sweep_report.txt and cutoff_sweep.png
+        """
+        file = ParticlesStarfile(self.star_file_input, columns=SWEEP_LABELS)
+        particles_dataframe = file.particles_dataframe
+        microtubule_index = file.microtubule_index
+        # The cutoffs are evaluated on the values as parsed, as in smoothing
+        expand_dtypes(particles_dataframe, SWEEP_LABELS)
+        self.number_of_mts = len(microtubule_index)
+        self.number_of_segments = len(particles_dataframe)
+
+        if 'rlnAngleRot' in particles_dataframe.columns:
+            self.curves['angles'] = self.sweep_angles(particles_dataframe, microtubule_index, 'rlnAngleRot')
+        for label in SHIFT_LABELS:
+            if label in particles_dataframe.columns:
+                self.curves[label] = self.sweep_shifts(particles_dataframe, microtubule_index, label)
+        if 'rlnClassNumber' in particles_dataframe.columns:
+            self.curves['proportion'] = self.sweep_proportion(particles_dataframe, microtubule_index)
+
+        self.generate_report()
+        fig = self.sweep_curves_fig()
+        figure_path = os.path.join(self.output_path, 'cutoff_sweep.png')
+        fig.savefig(figure_path)
+        plt.close(fig)
+        print(f'Curves saved to {figure_path}')
+
+    def sweep_angles(self, particles_dataframe, microtubule_index, id_label):
+        """
+        :param particles_dataframe: The dataframe containing particle data.
+        :param microtubule_index: MicrotubuleIndex of particles_dataframe
+        :param id_label: the angle smoothed
+        :return: dictionary of the cutoffs, retained MTs and retained segments
+        """
+        ragged = RaggedArray.from_index(particles_dataframe[id_label].to_numpy(dtype=float), microtubule_index)
+        gaps = grouped_min_gap(ragged.values, ragged.offsets, ANGLE_PERIODS[id_label])
+        mts, segments = retained_curve(gaps, ragged.sizes, self.angle_cutoffs)
+        return {'cutoff': np.array(self.angle_cutoffs), 'retained_mts': mts, 'retained_segments': segments}
+
+    def sweep_shifts(self, particles_dataframe, microtubule_index, id_label):
+        """
+        :param particles_dataframe: The dataframe containing particle data.
+        :param microtubule_index: MicrotubuleIndex of particles_dataframe
+        :param id_label: the shift smoothed
+        :return: dictionary of the cutoffs, the MTs whose best flattening factor is at the edge of the range and the
+        segments in the top clusters
+        """
+        ragged = RaggedArray.from_index(particles_dataframe[id_label].to_numpy(dtype=float), microtubule_index)
+
+        # The factors of every cutoff are columns of the factors of all the cutoffs, in the same (increasing) order,
+        # so the best factor of every cutoff is found as in flatten_and_cluster_shifts
+        factors = {cutoff: np.arange(-cutoff, cutoff, 0.25) for cutoff in self.shifts_cutoffs}
+        all_factors = np.unique(np.concatenate(list(factors.values())))
+        flatness_scores = self.flatness_scores_batched(ragged, all_factors)
+
+        edge_mts = []
+        fit_segments = []
+        for cutoff in self.shifts_cutoffs:
+            columns = np.searchsorted(all_factors, factors[cutoff])
+            best = np.argmin(flatness_scores[:, columns], axis=1)
+            edge_mts.append(int(np.sum((best == 0) | (best == len(columns) - 1))))
+            fit_segments.append(int(np.sum(self.cluster_flattened_shifts_batched(ragged, factors[cutoff][best]))))
+
+        return {'cutoff': np.array(self.shifts_cutoffs), 'edge_mts': np.array(edge_mts),
+                'fit_segments': np.array(fit_segments)}
+
+    def sweep_proportion(self, particles_dataframe, microtubule_index):
+        """
+        :param particles_dataframe: The dataframe containing particle data.
+        :param microtubule_index: MicrotubuleIndex of particles_dataframe
+        :return: dictionary of the cutoffs, retained MTs and retained segments
+        """
+        ragged = RaggedArray.from_index(particles_dataframe['rlnClassNumber'].to_numpy(), microtubule_index)
+        _, _, proportions = grouped_mode(ragged.values, ragged.offsets)
+        mts, segments = retained_curve(proportions, ragged.sizes, self.proportion_cutoffs, keep_below=False)
+        return {'cutoff': np.array(self.proportion_cutoffs), 'retained_mts': mts, 'retained_segments': segments}
+
+    def generate_report(self):
+        """
+        Writes the curves of all the sweeps to cutoff_sweep_report.txt
+        """
+        report_path = os.path.join(self.output_path, 'cutoff_sweep_report.txt')
+        titles = {'angles': f'Angle cutoff (degrees, smoothing uses {ANGLE_CUTOFF})',
+                  'rlnOriginXAngst': f'Shift cutoff of rlnOriginXAngst (smoothing uses {SHIFTS_CUTOFF})',
+                  'rlnOriginYAngst': f'Shift cutoff of rlnOriginYAngst (smoothing uses {SHIFTS_CUTOFF})',
+                  'proportion': 'Proportion cutoff of class unification'}
+
+        with open(report_path, 'w') as report_file:
+            report_file.write(f"Cutoff Sweep Report\n")
+            report_file.write(f"Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            report_file.write(f"Input file: {self.star_file_input}\n")
+            report_file.write(f"Number of MTs: {self.number_of_mts}\n")
+            report_file.write(f"Number of segments: {self.number_of_segments}\n")
+
+            for name, curve in self.curves.items():
+                report_file.write(f"\n{titles[name]}:\n")
+                report_file.write('\t'.join(curve) + '\n')
+                for row in zip(*curve.values()):
+                    report_file.write('\t'.join(str(value.item()) for value in row) + '\n')
+
+        print(f'Report generated at {report_path}')
+
+    def sweep_curves_fig(self):
+        """
+        :return: matplotlib figure of the percent of the MTs and segments retained (or fit for shifts) at every cutoff
+        """
+        fig, axes = plt.subplots(1, max(len(self.curves), 1), figsize=(5 * max(len(self.curves), 1), 4), squeeze=False)
+
+        for ax, (name, curve) in zip(axes[0], self.curves.items()):
+            if 'retained_mts' in curve:
+                ax.plot(curve['cutoff'], curve['retained_mts'] / max(self.number_of_mts, 1) * 100, marker='o',
+                        label='MTs')
+                ax.plot(curve['cutoff'], curve['retained_segments'] / max(self.number_of_segments, 1) * 100,
+                        marker='o', label='Segments')
+                ax.set_ylabel('Retained %')
+            else:
+                ax.plot(curve['cutoff'], curve['fit_segments'] / max(self.number_of_segments, 1) * 100, marker='o',
+                        label='Segments in top clusters')
+                ax.plot(curve['cutoff'], curve['edge_mts'] / max(self.number_of_mts, 1) * 100, marker='o',
+                        label='MTs at the edge of the range')
+                ax.set_ylabel('%')
+            ax.set_xlabel('Cutoff')
+            ax.set_title(name)
+            ax.legend()
+
+        fig.tight_layout()
+        return fig
@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 02/07/24
-Updated: 28/07/24
+Updated: 18/10/26
 
 Method to generate masks volume .mrc file in the form of a wedge or a cylindrical cutout
 """
@@ -37,9 +37,9 @@ class MaskGenerator(MethodBase):
         protofilament number (pf_number), helical_twist and a helical_rise at a selected output_path.
         """
 
-        particles_star_file_data = ParticlesStarfile(input_star_file.get())
-        self.particles_dataframe = particles_star_file_data.particles_dataframe
-        self.data_optics_dataframe = particles_star_file_data.particles_dataframe
+        # Only the optics data block is needed for the pixel size
+        particles_star_file_data = ParticlesStarfile(input_star_file.get(), data_blocks=['optics'])
+        self.data_optics_dataframe = particles_star_file_data.optics_dataframe
         self.pixel_size = particles_star_file_data.pixel_size
         self.microtubule_volume = microtubule_volume.get()
         self.microtubule_mask = microtubule_mask.get()
@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 15/04/24
-Updated: 28/07/24
+Updated: 18/10/26
 
 Methods for angles and shifts manipulation during initial seam assignment step
 
@@ -10,14 +10,20 @@ angles: rlnAngleRot, rlnAnglePsi, rlnAngleTilt
 
 If set to 0 then the values are set to 0, if set to prior then are set to priors (rlnAnglePsiPrior, rlnAngleTiltPrior)
 if none, then untouched.
+With stream=True the particles aren't loaded at all, the lines of the STAR file are rewritten in large blocks with only
+the reset fields replaced, so resetting a STAR file of any size takes a constant amount of memory.
 
 """
 import os
 
-import starfile
-
 from ..methods_base.method_base import MethodBase, print_done_decorator
-from ..methods_base.particles_starfile import ParticlesStarfile
+from ..methods_base.particles_starfile import ParticlesStarfile, ANGLES_AND_SHIFTS_LABELS
+from ..methods_base.star_writer import write_star_file, rewrite_loop_block
+from ..methods_base.star_compression import strip_star_extension, star_file_name
+from ..methods_base.star_delta import write_star_delta
+
+# Columns loaded from the input STAR file, the other columns are copied to the output untouched
+RESET_LABELS = ANGLES_AND_SHIFTS_LABELS + ['rlnAnglePsiPrior', 'rlnAngleTiltPrior', 'rlnOriginZ', 'rlnOriginZAngst']
 
 
 class ResetAnglesAndShifts(MethodBase):
@@ -25,7 +31,7 @@ class ResetAnglesAndShifts(MethodBase):
         Method inherits from MethodBase class in method_base.py
     """
 
-    def __init__(self, star_file_input, output_directory):
+    def __init__(self, star_file_input, output_directory, compression=None, delta=False):
         """
         Takes the star_file_input and resets rot (rlnAngleRot), x (rlnOriginX), y (rlnOriginY) and z (rlnOriginZ), and
         sets psi (rlnAnglePsi) and tilt (rlnAngleTilt) to prior (rlnAnglePsiPrior and rlnAngleTiltPrior accordingly)
@@ -33,13 +39,18 @@ class ResetAnglesAndShifts(MethodBase):
 
         :param star_file_input: star file
         :param output_directory: output path
+        :param compression: None for a plain STAR file (readable by RELION), 'gzip' or 'zstd' for a compressed one
+        :param delta: if True a delta file with only the reset columns is written instead of a complete STAR file (see
+        star_delta.py)
         """
         self.star_file_input = star_file_input.get()
         self.star_file_name = os.path.basename(self.star_file_input)
         self.output_directory = output_directory.get()
+        self.compression = compression
+        self.delta = delta
 
     @print_done_decorator
-    def reset_angles_and_translations(self, rot=None, x=None, y=None, z=None, psi=None, tilt=None):
+    def reset_angles_and_translations(self, rot=None, x=None, y=None, z=None, psi=None, tilt=None, stream=False):
         """
         Takes the star_file_input and resets rot (rlnAngleRot), x (rlnOriginX), y (rlnOriginY) and z (rlnOriginZ), and
         sets psi (rlnAnglePsi) and tilt (rlnAngleTilt) to prior (rlnAnglePsiPrior and rlnAngleTiltPrior accordingly)
@@ -51,6 +62,9 @@ class ResetAnglesAndShifts(MethodBase):
         :param rot: 0 or None
         :param psi: prior or None
         :param tilt: prior or None
+        :param stream: if True the particles aren't loaded, the rows are rewritten as text in chunks with only the reset
+        columns replaced (constant memory, for very large STAR files). Not used when writing a delta file.
+        :return: the original and the new particles pandas.DataFrame, (None, None) if stream is True
         """
         x = x.get()
         y = y.get()
@@ -68,59 +82,103 @@ class ResetAnglesAndShifts(MethodBase):
               f"rlnAngleTilt = {tilt}\n"
               f"rlnAnglePsi = {psi}")
 
-        # Read the STAR file and convert it to a pandas DataFrame
-        file = ParticlesStarfile(self.star_file_input)
+        if stream and not self.delta:
+            # Only the header is read, the columns are replaced in the text of the rows
+            file = ParticlesStarfile(self.star_file_input, stream=True)
+            values, copies, name = self.reset_columns(file.blocks['particles'].labels, rot, x, y, z, psi, tilt)
+            new_star_file = self.new_star_file_name(name)
+            rewrite_loop_block(file.blocks, 'particles', os.path.join(self.output_directory, new_star_file), values,
+                               copies)
+            print(f"Updated STAR file saved as: {new_star_file} at {self.output_directory}")
+            return None, None
+
+        # Read the STAR file and convert it to a pandas DataFrame, only the columns that can be reset are loaded
+        file = ParticlesStarfile(self.star_file_input, columns=RESET_LABELS)
 
         particles_dataframe = file.particles_dataframe
         data_optics_dataframe = file.optics_dataframe
 
+        values, copies, name = self.reset_columns(particles_dataframe.columns, rot, x, y, z, psi, tilt)
+        for label, value in values.items():
+            particles_dataframe[label] = value
+        for label, source_label in copies.items():
+            particles_dataframe[label] = particles_dataframe[source_label]
+
+        # Write the modified DataFrame back to a new STAR file (or only the reset columns to a delta file)
+        new_particles_star_file_data = {'optics': data_optics_dataframe, 'particles': particles_dataframe}
+        new_star_file = self.new_star_file_name(name)
+        new_star_file_path = os.path.join(self.output_directory, new_star_file)
+        if self.delta:
+            write_star_delta(particles_dataframe, [*values, *copies], new_star_file_path, self.star_file_input)
+        else:
+            write_star_file(new_particles_star_file_data, new_star_file_path, file.sources)
+
+        print(f"Updated STAR file saved as: {new_star_file} at {self.output_directory}")
+
+        return ParticlesStarfile(self.star_file_input, columns=RESET_LABELS).particles_dataframe, particles_dataframe
+
+    def reset_columns(self, labels, rot, x, y, z, psi, tilt):
+        """
+        Finds which columns are reset according to the parameters and the columns of the STAR file
+
+        :param labels: the labels of the columns of the particles data block
+        :param rot: '0' or None
+        :param x: '0' or None
+        :param y: '0' or None
+        :param z: '0' or None
+        :param psi: 'prior' or None
+        :param tilt: 'prior' or None
+        :return: dictionary of label: new value, dictionary of label: label of the prior it is copied from and the list
+        of the parameters used in the name of the final star file
+        """
+        values = {}
+        copies = {}
         # Set an empty list to use as parameters in the name of the final star file
         name = []
 
         # Reset PHI/Rot to 0
-        if rot == '0' and 'rlnAngleRot' in particles_dataframe.columns:
-            particles_dataframe['rlnAngleRot'] = 0.0
+        if rot == '0' and 'rlnAngleRot' in labels:
+            values['rlnAngleRot'] = 0.0
             name.append('rot_0')
 
-        # Reset PSI and TILT to match PRIORS (assuming the prior columns exist in the DataFrame)
-        # Adjust column names according to the actual column names in the STAR file
-        if psi == 'prior' and 'rlnAnglePsiPrior' in particles_dataframe.columns:
-            particles_dataframe['rlnAnglePsi'] = particles_dataframe['rlnAnglePsiPrior']
+        # Reset PSI and TILT to match PRIORS (assuming the prior columns exist in the STAR file)
+        if psi == 'prior' and 'rlnAnglePsiPrior' in labels:
+            copies['rlnAnglePsi'] = 'rlnAnglePsiPrior'
             name.append('psi_prior')
-        elif 'rlnAnglePsiPrior' not in particles_dataframe.columns:
+        elif 'rlnAnglePsiPrior' not in labels:
             print("There is no rlnAnglePsiPrior in the star file")
 
-        if tilt == 'prior' and 'rlnAngleTiltPrior' in particles_dataframe.columns:
-            particles_dataframe['rlnAngleTilt'] = particles_dataframe['rlnAngleTiltPrior']
+        if tilt == 'prior' and 'rlnAngleTiltPrior' in labels:
+            copies['rlnAngleTilt'] = 'rlnAngleTiltPrior'
             name.append('tilt_prior')
-        elif 'rlnAngleTiltPrior' not in particles_dataframe.columns:
+        elif 'rlnAngleTiltPrior' not in labels:
             print("There is no rlnAngleTiltPrior in the star file")
 
         # Reset translations to 0
-        if x == '0' and 'rlnOriginXAngst' in particles_dataframe.columns:
-            particles_dataframe['rlnOriginXAngst'] = 0.0
+        if x == '0' and 'rlnOriginXAngst' in labels:
+            values['rlnOriginXAngst'] = 0.0
             name.append('x_0')
-        elif 'rlnOriginXAngst' not in particles_dataframe.columns:
+        elif 'rlnOriginXAngst' not in labels:
             print("There is no rlnOriginXAngst in the star file")
 
-        if y == '0' and 'rlnOriginYAngst' in particles_dataframe.columns:
-            particles_dataframe['rlnOriginYAngst'] = 0.0
+        if y == '0' and 'rlnOriginYAngst' in labels:
+            values['rlnOriginYAngst'] = 0.0
             name.append('y_0')
-        elif 'rlnOriginYAngst' not in particles_dataframe.columns:
+        elif 'rlnOriginYAngst' not in labels:
             print("There is no rlnOriginYAngst in the star file")
 
-        if z == '0' and 'rlnOriginZ' in particles_dataframe.columns:
-            particles_dataframe['rlnOriginZAngst'] = 0.0
+        if z == '0' and 'rlnOriginZ' in labels:
+            values['rlnOriginZAngst'] = 0.0
             name.append('z_0')
-        elif 'rlnOriginZ' not in particles_dataframe.columns:
+        elif 'rlnOriginZ' not in labels:
             print("There is no rlnOriginZ in the star file")
 
-        # Write the modified DataFrame back to a new STAR file
-        os.chdir(self.output_directory)
-        new_particles_star_file_data = {'optics': data_optics_dataframe, 'particles': particles_dataframe}
-        new_star_file = self.star_file_name.replace('.star', f'_{"_".join(name)}.star')
-        starfile.write(new_particles_star_file_data, new_star_file)
-
-        print(f"Updated STAR file saved as: {new_star_file} at {self.output_directory}")
+        return values, copies, name
 
-        return ParticlesStarfile(self.star_file_input).particles_dataframe, particles_dataframe
+    def new_star_file_name(self, name):
+        """
+        :param name: list of the parameters used in the name of the final star file
+        :return: name of the final star file (or delta file)
+        """
+        original_name = strip_star_extension(self.star_file_name)
+        return star_file_name(f'{original_name}_{"_".join(name)}', self.compression, self.delta)
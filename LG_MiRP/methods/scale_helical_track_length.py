@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 26/02/24
-Updated: 1/3/24
+Updated: 18/10/26
 
 Method to scale helical track length
 Updating the _rlnHelicalTrackLengthAngst column in the particles star file
@@ -12,6 +12,8 @@ I don't implement this method, but it's here just in case we will need it
 import starfile
 import os
 
+from ..methods_base.star_writer import write_star_file
+
 
 def scale_helical_track_length(star_entry, binning):
     """
@@ -35,7 +37,7 @@ def scale_helical_track_length(star_entry, binning):
     output_file = f'scaled_helical_track_length_binning_{binning}.star'
     if output_file not in os.listdir(os.getcwd()):
         try:
-            starfile.write(data, output_file)
+            write_star_file(data, output_file)
             print(f'File was saved to {os.getcwd()}\\{output_file} ')
         except Exception as e:
             print("Error:", e)
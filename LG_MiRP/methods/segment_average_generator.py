@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 05/03/24
-Updated: 28/07/24
+Updated: 18/10/26
 
 Method to generate averages of segments of MTs, ATM used only to assess the quality of the data
 Could be broken to several methods instead of spaghetti, but I'm too lazy
@@ -10,11 +10,12 @@ Could be broken to several methods instead of spaghetti, but I'm too lazy
 import os
 import subprocess
 import tensorflow as tf
-import starfile
 import mrcfile
 
 from ..methods_base.method_base import MethodBase, print_done_decorator
 from ..methods_base.particles_starfile import ParticlesStarfile
+from ..methods_base.star_writer import write_star_file
+from ..methods_base.particles_schema import expand_dtypes
 
 
 class SegmentAverageGenerator(MethodBase):
@@ -37,7 +38,8 @@ class SegmentAverageGenerator(MethodBase):
 
         # Reading the particles.star file
         particles_star_file_data = ParticlesStarfile(self.particles_star_file)
-        particles_dataframe = particles_star_file_data.particles_dataframe
+        # rlnMicrographName gets new values that are not among its categories
+        particles_dataframe = expand_dtypes(particles_star_file_data.particles_dataframe, ['rlnMicrographName'])
         data_optics_dataframe = particles_star_file_data.optics_dataframe
 
         # Calculating background radius box for normalization by relion
@@ -191,10 +193,9 @@ class SegmentAverageGenerator(MethodBase):
         # Generating a new star file named segment_average.star in the output directory
         new_particles_star_file_data = {'optics': data_optics_dataframe, 'particles': particles_dataframe}
 
-        os.chdir(output_path)
         output_file = 'segment_average.star'
         try:
-            starfile.write(new_particles_star_file_data, output_file)
+            write_star_file(new_particles_star_file_data, os.path.join(output_path, output_file))
         except NameError:
             print(f"File names {output_file} already exists, delete old file and try again")
             raise NameError("File already exists")
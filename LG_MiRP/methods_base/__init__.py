@@ -1,3 +1,17 @@
 from .volume_mrc import *
+from .star_compression import *
+from .star_reader import *
+from .star_cache import *
+from .star_writer import *
+from .star_delta import *
+from .particles_schema import *
+from .keyed_join import *
+from .microtubule_index import *
+from .microtubule_offsets import *
+from .ragged_array import *
+from .class_count_matrix import *
+from .microtubule_results import *
+from .grouped_kernels import *
+from .angle_clustering import *
 from .particles_starfile import *
 from .method_base import *
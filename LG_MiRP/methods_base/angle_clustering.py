@@ -0,0 +1,179 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Clustering of the rot angles (rlnAngleRot) of a single microtubule (MT).
+cluster_angles finds the same clusters as MethodBase.cluster_shallow_slopes without the N x N matrix of pairwise
+differences. The angles are sorted once and the angles close to each angle are found by binary search, so they are a
+contiguous range of the sorted angles. Sets of angles are kept as bitsets over the sorted angles, which makes every
+step of the clustering a few operations on machine words instead of a pass over all the pairs.
+Angles are compared around the circle, so -179 and 179 are 2 degrees apart.
+
+"""
+import numpy as np
+
+# Period of rlnAngleRot in degrees
+ROT_PERIOD = 360.0
+
+
+def cluster_angles(angles, cutoff, period=ROT_PERIOD):
+    """
+    Clusters angles based on pairwise differences within a cutoff range, as MethodBase.cluster_shallow_slopes does:
+    the last pair within the cutoff (by index) is merged with all the angles paired to either of its angles, the pairs
+    inside the new cluster are removed and this is repeated until there are no pairs left.
+
+    :param angles: array-like of the angle values of an MT
+    :param cutoff: maximal difference between the two angles of a pair
+    :param period: period of the angles (360 for rlnAngleRot), None to compare the angles without wrap-around
+    :return: top_cluster (list of the indices of the largest cluster) and low_weight_cluster (list of the indices of
+    the other clusters), both None if no two angles are within the cutoff
+    """
+    windows = _AngleWindows(angles, cutoff, period)
+
+    clusters = []
+    # Bitset of every cluster and the numbers of the clusters of every angle, the pairs inside a cluster are removed
+    cluster_bits = []
+    memberships = [[] for _ in range(len(windows.angles))]
+
+    def remaining_pairs(index):
+        """
+        :return: bitset of the angles that still make a pair with the angle
+        """
+        bits = windows.bits(index)
+        for cluster_number in memberships[index]:
+            bits &= ~cluster_bits[cluster_number]
+        return bits
+
+    # The angles are visited from the last one, so the first angle that has a pair with a later angle gives the last
+    # pair. Pairs are only removed, so an angle without such a pair never gets one.
+    later = 0
+    for first in windows.indices[::-1].tolist():
+        first_bit = 1 << windows.ranks[first]
+        first_pairs = remaining_pairs(first)
+
+        later_pairs = first_pairs & later
+        if later_pairs:
+            # The last pair and all the pairs of its two angles
+            second = int(windows.to_indices(later_pairs).max())
+            cluster = first_pairs | remaining_pairs(second) | first_bit | (1 << windows.ranks[second])
+
+            members = np.sort(windows.to_indices(cluster)).tolist()
+            for index in members:
+                memberships[index].append(len(clusters))
+            cluster_bits.append(cluster)
+            clusters.append(members)
+
+        later |= first_bit
+
+    if not clusters:
+        return None, None
+
+    top_cluster = max(clusters, key=len)
+    low_weight_cluster = [j for i in clusters if i != top_cluster for j in i]
+
+    return top_cluster, low_weight_cluster
+
+
+def unwrap_angles(angles, period=ROT_PERIOD):
+    """
+    Makes the angles of a cluster continuous across the wrap-around, e.g. [178, -179] -> [178, 181]
+
+    :param angles: numpy array of angles that are close to each other around the circle
+    :param period: period of the angles
+    :return: numpy array of the unwrapped angles, the same array if the angles don't cross the wrap-around
+    """
+    if len(angles) == 0 or np.ptp(angles) <= period / 2:
+        return angles
+    reference = angles[0]
+    return reference + (angles - reference + period / 2) % period - period / 2
+
+
+def wrap_angles(angles, period=ROT_PERIOD):
+    """
+    :param angles: numpy array of angles
+    :param period: period of the angles
+    :return: the angles in the range [-period / 2, period / 2)
+    """
+    return (angles + period / 2) % period - period / 2
+
+
+class _AngleWindows:
+    """
+    The angles within the cutoff of every angle, as bitsets over the sorted angles (bit r is the angle of rank r)
+    """
+
+    def __init__(self, angles, cutoff, period):
+        self.angles = np.asarray(angles, dtype=float)
+        self.cutoff = cutoff
+        self.period = period
+
+        # Angles that are not numbers have no pairs
+        self.indices = np.flatnonzero(~np.isnan(self.angles))
+        positions = self.angles[self.indices] if period is None else np.mod(self.angles[self.indices], period)
+        order = np.argsort(positions, kind='stable')
+        self.sorted_indices = self.indices[order]
+        self.size = len(order)
+        ranks = np.zeros(len(self.angles), dtype=np.int64)
+        ranks[self.sorted_indices] = np.arange(self.size)
+        self.ranks = ranks.tolist()
+
+        sorted_positions = positions[order]
+        tiled_indices = self.sorted_indices
+        if period is not None:
+            # One more period on both sides, so the angles around the wrap-around are next to each other
+            sorted_positions = np.concatenate([sorted_positions - period, sorted_positions, sorted_positions + period])
+            tiled_indices = np.tile(self.sorted_indices, 3)
+
+        # The windows are found a bit wider than the cutoff, then narrowed with the same test as the pairwise
+        # differences, so rounding never adds or drops a pair
+        slack = 1e-9 * (np.abs(positions) + cutoff + 1)
+        starts = np.searchsorted(sorted_positions, positions - cutoff - slack, side='left')
+        stops = np.searchsorted(sorted_positions, positions + cutoff + slack, side='right')
+        for ends, step in ((starts, 1), (stops, -1)):
+            moving = np.flatnonzero(starts < stops)
+            while len(moving):
+                edge = ends[moving] if step == 1 else ends[moving] - 1
+                moving = moving[~self._within(self.indices[moving], tiled_indices[edge])]
+                ends[moving] += step
+                moving = moving[starts[moving] < stops[moving]]
+
+        self.starts = np.zeros(len(self.angles), dtype=np.int64)
+        self.stops = np.zeros(len(self.angles), dtype=np.int64)
+        self.starts[self.indices] = starts
+        self.stops[self.indices] = stops
+        self.starts = self.starts.tolist()
+        self.stops = self.stops.tolist()
+
+    def _within(self, firsts, seconds):
+        """
+        :return: boolean numpy array, True where the two angles are within the cutoff
+        """
+        differences = np.abs(self.angles[firsts] - self.angles[seconds])
+        if self.period is not None:
+            differences = np.minimum(differences % self.period, self.period - differences % self.period)
+        return differences <= self.cutoff
+
+    def bits(self, index):
+        """
+        :param index: index of an angle
+        :return: bitset of the other angles within the cutoff
+        """
+        start, length = self.starts[index], self.stops[index] - self.starts[index]
+        if length >= self.size:
+            bits = (1 << self.size) - 1
+        else:
+            # With a period the window is in the tiled angles, so it may wrap around the ranks
+            start %= self.size
+            bits = ((1 << min(length, self.size - start)) - 1) << start
+            if start + length > self.size:
+                bits |= (1 << (start + length - self.size)) - 1
+        return bits & ~(1 << self.ranks[index])
+
+    def to_indices(self, bits):
+        """
+        :param bits: bitset of angles
+        :return: numpy array of the indices of the angles
+        """
+        data = np.frombuffer(bits.to_bytes((self.size + 7) // 8, 'little'), dtype=np.uint8)
+        return self.sorted_indices[np.flatnonzero(np.unpackbits(data, bitorder='little')[:self.size])]
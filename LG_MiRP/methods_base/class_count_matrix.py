@@ -0,0 +1,144 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Number of segments of every class (rlnClassNumber) in every microtubule (MT) of a data set, as a sparse MT x class
+matrix: only the classes that appear in an MT are stored, MT after MT (compressed rows).
+The matrix is built once from the classes of a particles data block and everything that depends on the classes of the
+MTs is read from it: the most common class of every MT and its proportion (class unification), the confidence of every
+MT (confidence histogram), and the number of segments and MTs of every class (report and class distribution).
+
+"""
+import numpy as np
+import pandas as pd
+
+from .ragged_array import RaggedArray
+
+
+class ClassCountMatrix:
+    """
+    Sparse MT x class count matrix, the classes of MT g are class_codes[offsets[g]:offsets[g + 1]] (in increasing order)
+    and their numbers of segments counts[offsets[g]:offsets[g + 1]]:
+
+        class_counts = ClassCountMatrix.from_index(particles_dataframe['rlnClassNumber'].to_numpy(), microtubule_index)
+        most_common_classes, appearances, proportions = class_counts.mode()
+    """
+
+    def __init__(self, classes, offsets, class_codes, counts, sizes):
+        """
+        :param classes: numpy array of the classes (sorted), the entries refer to them by their position
+        :param offsets: numpy array of the start of the entries of every MT followed by the number of entries
+        :param class_codes: numpy array of the position of the class of every entry in classes
+        :param counts: numpy array of the number of segments of every entry
+        :param sizes: numpy array of the number of segments of every MT, including segments without a class
+        """
+        self.classes = classes
+        self.offsets = offsets
+        self.class_codes = class_codes
+        self.counts = counts
+        self.sizes = sizes
+
+    @classmethod
+    def from_index(cls, class_values, microtubule_index):
+        """
+        Counts the classes of every MT with a single sort of the (MT, class) pairs
+
+        :param class_values: numpy array of the rlnClassNumber column of the DataFrame the index was built from
+        :param microtubule_index: MicrotubuleIndex of the DataFrame
+        :return: ClassCountMatrix with the MTs in the order of the index, classes that are NaN are not counted
+        """
+        ragged = RaggedArray.from_index(class_values, microtubule_index)
+        groups = ragged.group_numbers()
+        values = ragged.values
+        if values.dtype.kind == 'f':
+            valid = ~np.isnan(values)
+            groups, values = groups[valid], values[valid]
+
+        classes, codes = np.unique(values, return_inverse=True)
+        pairs, counts = np.unique(groups * max(len(classes), 1) + codes, return_counts=True)
+        entry_groups = pairs // max(len(classes), 1)
+
+        return cls(classes=classes,
+                   offsets=np.searchsorted(entry_groups, np.arange(len(ragged) + 1)),
+                   class_codes=pairs % max(len(classes), 1),
+                   counts=counts,
+                   sizes=ragged.sizes)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def entry_groups(self):
+        """
+        :return: numpy array of the number of the MT of every entry
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def mode(self):
+        """
+        Most common class of every MT, the smallest one if several classes are equally common (as grouped_mode)
+
+        :return: numpy array of the most common class of every MT (NaN for MTs without classes, if the dtype allows),
+        numpy array of the number of its segments and numpy array of its proportion of the segments of the MT
+        """
+        entry_groups = self.entry_groups()
+        max_counts = np.zeros(len(self), dtype=np.int64)
+        np.maximum.at(max_counts, entry_groups, self.counts)
+
+        # The first (smallest) of the most common classes of every MT
+        longest = np.flatnonzero(self.counts == max_counts[entry_groups])
+        first_longest = longest[np.unique(entry_groups[longest], return_index=True)[1]]
+
+        has_classes = max_counts > 0
+        if self.classes.dtype.kind == 'f':
+            modes = np.full(len(self), np.nan, dtype=self.classes.dtype)
+        else:
+            modes = np.zeros(len(self), dtype=self.classes.dtype)
+        modes[has_classes] = self.classes[self.class_codes[first_longest]]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            proportions = max_counts / self.sizes
+
+        return modes, max_counts, proportions
+
+    def confidences(self):
+        """
+        :return: numpy array of the percent of the segments of every MT in its most common class
+        """
+        return self.mode()[2] * 100
+
+    def class_mt_counts(self):
+        """
+        :return: dictionary of class: number of MTs with segments of the class
+        """
+        return dict(zip(self.classes.tolist(), np.bincount(self.class_codes, minlength=len(self.classes)).tolist()))
+
+    def class_segment_counts(self):
+        """
+        :return: pandas.Series of the number of segments of every class, most common first (as value_counts)
+        """
+        segment_counts = np.bincount(self.class_codes, weights=self.counts, minlength=len(self.classes))
+        series = pd.Series(segment_counts.astype(np.int64), index=self.classes, name='count')
+        return series.sort_values(ascending=False, kind='stable')
+
+    def to_arrays(self):
+        """
+        :return: dictionary of numpy arrays describing the matrix, for saving it
+        """
+        return {'classes': self.classes,
+                'offsets': self.offsets,
+                'class_codes': self.class_codes,
+                'counts': self.counts,
+                'sizes': self.sizes}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        :param arrays: dictionary of numpy arrays from to_arrays
+        :return: ClassCountMatrix
+        """
+        return cls(classes=arrays['classes'],
+                   offsets=arrays['offsets'],
+                   class_codes=arrays['class_codes'],
+                   counts=arrays['counts'],
+                   sizes=arrays['sizes'])
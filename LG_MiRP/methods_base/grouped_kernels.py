@@ -0,0 +1,367 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Statistics of every microtubule (MT) of a data set computed at once.
+The values of all the MTs are packed one MT after the other (as in RaggedArray), values[offsets[g]:offsets[g + 1]]
+being the values of MT g, and every function returns an array with a value for every MT. The sums are done with
+bincount and the order statistics (mode, median, percentiles, histogram bins) with a single sort of all the values, so
+there is no loop over the MTs.
+MTs without values get NaN (or a count of 0).
+
+"""
+import numpy as np
+
+from .angle_clustering import ROT_PERIOD
+
+
+def group_numbers(offsets):
+    """
+    :param offsets: numpy array of the start of every MT in the values followed by the number of values
+    :return: numpy array of the number of the MT of every value
+    """
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def grouped_count(offsets, mask=None):
+    """
+    :param offsets: start of every MT in the values followed by the number of values
+    :param mask: boolean numpy array, only the True values are counted (all the values if None)
+    :return: numpy array of the number of values of every MT
+    """
+    if mask is None:
+        return np.diff(offsets)
+    return np.bincount(group_numbers(offsets)[mask], minlength=len(offsets) - 1)
+
+
+def grouped_sum(values, offsets):
+    """
+    :param values: numpy array of the values of all the MTs
+    :param offsets: start of every MT in the values followed by the number of values
+    :return: numpy array of the sum of the values of every MT
+    """
+    return np.bincount(group_numbers(offsets), values, minlength=len(offsets) - 1)
+
+
+def grouped_mean(values, offsets):
+    """
+    :param values: numpy array of the values of all the MTs
+    :param offsets: start of every MT in the values followed by the number of values
+    :return: numpy array of the mean of every MT
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return grouped_sum(values, offsets) / np.diff(offsets)
+
+
+def grouped_var(values, offsets, ddof=0):
+    """
+    Variance of every MT, computed around the mean of the MT (not as mean of squares minus squared mean, which loses
+    precision when the values are far from 0)
+
+    :param values: numpy array of the values of all the MTs
+    :param offsets: start of every MT in the values followed by the number of values
+    :param ddof: delta degrees of freedom, as in np.var
+    :return: numpy array of the variance of every MT
+    """
+    deviations = values - np.repeat(grouped_mean(values, offsets), np.diff(offsets))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return grouped_sum(deviations ** 2, offsets) / (np.diff(offsets) - ddof)
+
+
+def grouped_circular_mean(angles, offsets, period=ROT_PERIOD):
+    """
+    Mean direction of the angles of every MT, so the mean of 179 and -179 is 180 and not 0
+
+    :param angles: numpy array of the angles of all the MTs
+    :param offsets: start of every MT in the angles followed by the number of angles
+    :param period: period of the angles (360 for rlnAngleRot)
+    :return: numpy array of the mean angle of every MT in the range [-period / 2, period / 2], NaN for MTs without
+    angles
+    """
+    radians = angles * (2 * np.pi / period)
+    sines = grouped_sum(np.sin(radians), offsets)
+    cosines = grouped_sum(np.cos(radians), offsets)
+    means = np.arctan2(sines, cosines) * (period / (2 * np.pi))
+    means[np.diff(offsets) == 0] = np.nan
+    return means
+
+
+def grouped_linear_fit(x, y, offsets):
+    """
+    Least squares line of every MT in closed form, same solution as MethodBase.linear_fit (np.linalg.lstsq) up to
+    rounding. When all the x of an MT are equal (e.g. a single value) the line is not unique and, as lstsq, the minimal
+    norm solution is returned.
+
+    :param x: numpy array of the x values of all the MTs
+    :param y: numpy array of the y values of all the MTs
+    :param offsets: start of every MT in the values followed by the number of values
+    :return: numpy arrays of the slope and the intercept of every MT, NaN for MTs without values
+    """
+    sizes = np.diff(offsets)
+    x_mean = grouped_mean(x, offsets)
+    y_mean = grouped_mean(y, offsets)
+    dx = x - np.repeat(x_mean, sizes)
+    dy = y - np.repeat(y_mean, sizes)
+    sxx = grouped_sum(dx * dx, offsets)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = grouped_sum(dx * dy, offsets) / sxx
+        intercept = y_mean - slope * x_mean
+
+        # intercept + slope * x_mean = y_mean with the smallest intercept ** 2 + slope ** 2
+        degenerate = (sxx == 0) & (sizes > 0)
+        norm = 1 + x_mean[degenerate] ** 2
+        slope[degenerate] = y_mean[degenerate] * x_mean[degenerate] / norm
+        intercept[degenerate] = y_mean[degenerate] / norm
+
+    return slope, intercept
+
+
+def grouped_min_gap(values, offsets, period=None):
+    """
+    Smallest difference between two values of every MT, e.g. an MT has two angles within a cutoff of each other (as
+    cluster_angles pairs them) exactly when its smallest gap is at most the cutoff. NaN values are ignored.
+
+    :param values: numpy array of the values of all the MTs
+    :param offsets: start of every MT in the values followed by the number of values
+    :param period: period of the values (360 for rlnAngleRot) to compare them around the circle, None to compare them
+    without wrap-around
+    :return: numpy array of the smallest gap of every MT, inf for MTs with less than two values
+    """
+    number_of_groups = len(offsets) - 1
+    groups = group_numbers(offsets)
+    valid = ~np.isnan(values)
+    values, groups = values[valid], groups[valid]
+
+    # The closest values are next to each other once the values of every MT are sorted (around the circle)
+    positions = values if period is None else np.mod(values, period)
+    order = np.lexsort((positions, groups))
+    sorted_values = values[order]
+    sorted_groups = groups[order]
+    neighbours = np.flatnonzero(sorted_groups[1:] == sorted_groups[:-1])
+    firsts, seconds = sorted_values[neighbours], sorted_values[neighbours + 1]
+    pair_groups = sorted_groups[neighbours]
+
+    if period is not None:
+        # The last and the first values of an MT are next to each other across the wrap-around
+        counts = np.bincount(sorted_groups, minlength=number_of_groups)
+        ends = np.cumsum(counts)
+        wrapped = np.flatnonzero(counts > 2)
+        firsts = np.append(firsts, sorted_values[ends[wrapped] - 1])
+        seconds = np.append(seconds, sorted_values[ends[wrapped] - counts[wrapped]])
+        pair_groups = np.append(pair_groups, wrapped)
+
+    # The differences are computed as in cluster_angles, so the gap is within a cutoff exactly when a pair is
+    differences = np.abs(firsts - seconds)
+    if period is not None:
+        differences = np.minimum(differences % period, period - differences % period)
+
+    gaps = np.full(number_of_groups, np.inf)
+    np.minimum.at(gaps, pair_groups, differences)
+    return gaps
+
+
+def grouped_mode(values, offsets):
+    """
+    Most common value of every MT, the smallest one if several values are equally common (as pandas.Series.mode()[0]).
+    NaN values are ignored.
+
+    :param values: numpy array of the values of all the MTs (e.g. rlnClassNumber)
+    :param offsets: start of every MT in the values followed by the number of values
+    :return: numpy array of the most common value of every MT (NaN for MTs without values, if the dtype allows),
+    numpy array of the number of times it appears and numpy array of its proportion of the values of the MT
+    """
+    number_of_groups = len(offsets) - 1
+    sizes = np.diff(offsets)
+    groups = group_numbers(offsets)
+    valid = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+
+    # The values sorted by MT and by value, the runs of equal values are counted
+    order = np.flatnonzero(valid)
+    order = order[np.lexsort((values[order], groups[order]))]
+    sorted_values = values[order]
+    sorted_groups = groups[order]
+    new_run = np.ones(len(order), dtype=bool)
+    new_run[1:] = (sorted_groups[1:] != sorted_groups[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_counts = np.diff(np.append(run_starts, len(order)))
+    run_groups = sorted_groups[run_starts]
+
+    # The first (smallest) of the longest runs of every MT
+    counts = np.zeros(number_of_groups, dtype=np.int64)
+    np.maximum.at(counts, run_groups, run_counts)
+    longest = np.flatnonzero(run_counts == counts[run_groups])
+    first_longest = longest[np.unique(run_groups[longest], return_index=True)[1]]
+
+    has_values = counts > 0
+    if values.dtype.kind == 'f':
+        modes = np.full(number_of_groups, np.nan, dtype=values.dtype)
+    else:
+        modes = np.zeros(number_of_groups, dtype=values.dtype)
+    modes[has_values] = sorted_values[run_starts[first_longest]]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportions = counts / sizes
+
+    return modes, counts, proportions
+
+
+def grouped_median(values, offsets):
+    """
+    :param values: numpy array of the values of all the MTs, without NaN
+    :param offsets: start of every MT in the values followed by the number of values
+    :return: numpy array of the median of every MT, NaN for MTs without values
+    """
+    sizes = np.diff(offsets)
+    sorted_values = values[np.lexsort((values, group_numbers(offsets)))]
+
+    medians = np.full(len(sizes), np.nan)
+    has_values = sizes > 0
+    # The two middle values, the same one for an odd number of values
+    lower = offsets[:-1][has_values] + (sizes[has_values] - 1) // 2
+    upper = offsets[:-1][has_values] + sizes[has_values] // 2
+    medians[has_values] = (sorted_values[lower] + sorted_values[upper]) / 2
+    return medians
+
+
+def grouped_mad(values, offsets):
+    """
+    Median absolute deviation of every MT, a measure of the spread of the values that ignores outliers
+
+    :param values: numpy array of the values of all the MTs, without NaN
+    :param offsets: start of every MT in the values followed by the number of values
+    :return: numpy arrays of the median and of the median absolute deviation of every MT
+    """
+    medians = grouped_median(values, offsets)
+    deviations = np.abs(values - np.repeat(medians, np.diff(offsets)))
+    return medians, grouped_median(deviations, offsets)
+
+
+def grouped_percentiles(values, offsets, percentiles):
+    """
+    Percentiles of every MT, the same values as np.percentile(values, percentiles) of every MT (linear interpolation
+    between the two closest sorted values, done with the same floating point operations)
+
+    :param values: numpy array of the values of all the MTs, without NaN
+    :param offsets: start of every MT in the values followed by the number of values
+    :param percentiles: list of percentiles between 0 and 100
+    :return: numpy array of the percentiles of every MT (rows) in the order of percentiles (columns), NaN for MTs
+    without values
+    """
+    sizes = np.diff(offsets)
+    sorted_values = values[np.lexsort((values, group_numbers(offsets)))]
+    has_values = sizes > 0
+    starts = offsets[:-1][has_values]
+    counts = sizes[has_values]
+
+    results = np.full((len(sizes), len(percentiles)), np.nan)
+    for column, percentile in enumerate(percentiles):
+        quantile = np.true_divide(percentile, 100)
+        # Index of the percentile in the sorted values of the MT, between two values
+        virtual_indexes = counts * quantile + (1 - quantile) - 1
+        previous_indexes = np.floor(virtual_indexes)
+        next_indexes = previous_indexes + 1
+        # Above the last value the percentile is the last value
+        above_bounds = virtual_indexes >= counts - 1
+        previous_indexes[above_bounds] = counts[above_bounds] - 1
+        next_indexes[above_bounds] = counts[above_bounds] - 1
+        gammas = virtual_indexes - previous_indexes
+
+        lower = sorted_values[starts + previous_indexes.astype(np.int64)]
+        upper = sorted_values[starts + next_indexes.astype(np.int64)]
+        differences = upper - lower
+        # Interpolated from the closer value, as np.percentile does
+        interpolated = lower + differences * gammas
+        upper_half = gammas >= 0.5
+        interpolated[upper_half] = upper[upper_half] - differences[upper_half] * (1 - gammas[upper_half])
+        results[has_values, column] = interpolated
+
+    return results
+
+
+def grouped_histogram_bins(values, offsets):
+    """
+    Histogram bin of every value among the bins of its MT, the same as np.digitize(values, bins) with the bins of
+    np.histogram(values, bins='auto') of every MT. The bins are never made: the width of the bins of every MT is found
+    with the 'auto' rule of NumPy 2 and the bin of a value is found from its distance to the first edge, then checked
+    against the edges computed as np.linspace does.
+    The 'auto' width is the smaller of the Sturges width, range / (log2(n) + 1), and of the Freedman-Diaconis width,
+    2 * IQR / n ** (1 / 3), which is not allowed below half of range / sqrt(n) (so there are at most 2 * sqrt(n) + 1
+    bins).
+
+    :param values: numpy array of the values of all the MTs, without NaN
+    :param offsets: start of every MT in the values followed by the number of values
+    :return: numpy array of the bin of every value, 1 for the first bin of its MT, the number of bins + 1 for the
+    largest value (as np.digitize)
+    """
+    sizes = np.diff(offsets)
+    groups = group_numbers(offsets)
+    has_values = sizes > 0
+    counts = sizes[has_values]
+    starts = offsets[:-1][has_values]
+
+    first_edges = np.zeros(len(sizes))
+    last_edges = np.zeros(len(sizes))
+    first_edges[has_values] = np.minimum.reduceat(values, starts) if len(starts) else []
+    last_edges[has_values] = np.maximum.reduceat(values, starts) if len(starts) else []
+    value_ranges = last_edges - first_edges
+
+    # Terms that depend only on the number of values, computed for every size as np.histogram does for a single MT
+    unique_counts, size_numbers = np.unique(counts, return_inverse=True)
+    sturges_terms = np.array([np.log2(count) + 1.0 for count in unique_counts.tolist()])[size_numbers]
+    sqrt_terms = np.array([np.sqrt(count) for count in unique_counts.tolist()])[size_numbers]
+    fd_terms = np.array([count ** (-1.0 / 3.0) for count in unique_counts.tolist()])[size_numbers]
+
+    quartiles = grouped_percentiles(values, offsets, [75, 25])[has_values]
+    fd_widths = 2.0 * (quartiles[:, 0] - quartiles[:, 1]) * fd_terms
+    sturges_widths = value_ranges[has_values] / sturges_terms
+    sqrt_widths = value_ranges[has_values] / sqrt_terms
+    fd_widths = np.where(sqrt_widths / 2 > fd_widths, sqrt_widths / 2, fd_widths)
+    widths = np.zeros(len(sizes))
+    widths[has_values] = np.where(sturges_widths < fd_widths, sturges_widths, fd_widths)
+
+    # MTs with a single value (or equal values) get a single bin of width 1 around it
+    equal = has_values & (value_ranges == 0)
+    first_edges[equal] -= 0.5
+    last_edges[equal] += 0.5
+    deltas = last_edges - first_edges
+    number_of_bins = np.ones(len(sizes), dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        has_width = widths != 0
+        number_of_bins[has_width] = np.ceil(deltas[has_width] / widths[has_width]).astype(np.int64)
+        steps = deltas / number_of_bins
+
+    def edges(positions, numbers):
+        """
+        :param positions: numpy array of positions in values
+        :param numbers: numpy array of the number of an edge of the bins of the MT of every position
+        :return: numpy array of the edges, as in np.linspace(first_edge, last_edge, number_of_bins + 1)
+        """
+        position_groups = groups[positions]
+        edge_values = numbers * steps[position_groups] + first_edges[position_groups]
+        # np.linspace computes the edges from the range when the step is too small to be represented
+        tiny = steps[position_groups] == 0
+        tiny_groups = position_groups[tiny]
+        edge_values[tiny] = numbers[tiny] / number_of_bins[tiny_groups] * deltas[tiny_groups] + first_edges[tiny_groups]
+        last = numbers == number_of_bins[position_groups]
+        edge_values[last] = last_edges[position_groups[last]]
+        return edge_values
+
+    # The number of edges up to every value, estimated from the step and corrected with the exact edges
+    with np.errstate(divide='ignore', invalid='ignore'):
+        estimates = np.floor((values - first_edges[groups]) / steps[groups])
+    numbers = np.clip(np.nan_to_num(estimates), 0, number_of_bins[groups]).astype(np.int64)
+
+    moving = np.arange(len(values))
+    while len(moving):
+        moving = moving[numbers[moving] < number_of_bins[groups[moving]]]
+        moving = moving[edges(moving, numbers[moving] + 1) <= values[moving]]
+        numbers[moving] += 1
+    moving = np.arange(len(values))
+    while len(moving):
+        moving = moving[numbers[moving] > 0]
+        moving = moving[edges(moving, numbers[moving]) > values[moving]]
+        numbers[moving] -= 1
+
+    return numbers + 1
@@ -0,0 +1,229 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Compiled versions of the loops of the clustering in method_base.py, used when numba is installed.
+The backend is chosen once, when this module is imported: JIT_AVAILABLE is True if numba can be imported and
+LG_MIRP_JIT is not set to 0. Otherwise MethodBase uses its NumPy implementation and the functions here are never called.
+Every kernel does the same floating point operations in the same order as the NumPy code, including the pairwise
+summation of np.sum, so both backends give identical results (checked by tests/test_jit_kernels.py, with kernels
+compiled and with kernels loaded from numba's cache).
+
+"""
+import os
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+JIT_AVAILABLE = numba is not None and os.environ.get('LG_MIRP_JIT', '1') != '0'
+
+# Size of the blocks summed with 8 partial sums by np.sum (PW_BLOCKSIZE in NumPy)
+PAIRWISE_BLOCK_SIZE = 128
+
+
+def _jit(function):
+    """
+    Compiles the function with numba if it is used, otherwise returns it as is
+    """
+    if JIT_AVAILABLE:
+        return numba.njit(cache=True)(function)
+    return function
+
+
+@_jit
+def block_sum(values, start, length):
+    """
+    Sum of a block of at most PAIRWISE_BLOCK_SIZE values, added in the same order as np.sum
+
+    :param values: numpy array of float
+    :param start: index of the first value
+    :param length: number of values
+    :return: the sum
+    """
+    if length < 8:
+        result = 0.0
+        for i in range(length):
+            result += values[start + i]
+        return result
+    partial = np.empty(8)
+    for j in range(8):
+        partial[j] = values[start + j]
+    i = 8
+    while i < length - length % 8:
+        for j in range(8):
+            partial[j] += values[start + i + j]
+        i += 8
+    result = ((partial[0] + partial[1]) + (partial[2] + partial[3])) + \
+             ((partial[4] + partial[5]) + (partial[6] + partial[7]))
+    while i < length:
+        result += values[start + i]
+        i += 1
+    return result
+
+
+@_jit
+def pairwise_sum(values, start, length):
+    """
+    Sum of values[start:start + length] added in the same order as np.sum (pairwise summation).
+    np.sum splits the values in halves until they fit a block and adds the sums of the halves. The halves are kept on
+    an explicit stack of (start, length) pairs instead of recursion, numba can't load recursive functions from its
+    cache.
+
+    :param values: numpy array of float
+    :param start: index of the first value
+    :param length: number of values
+    :return: the sum
+    """
+    if length <= PAIRWISE_BLOCK_SIZE:
+        return block_sum(values, start, length)
+
+    # Every split replaces an entry by 3 and the halves are split less than 64 times, so 3 * 64 entries and 64 sums are
+    # enough for any length. A negative length marks the addition of the sums of the two halves.
+    starts = np.empty(3 * 64, dtype=np.int64)
+    lengths = np.empty(3 * 64, dtype=np.int64)
+    sums = np.empty(64)
+    number_of_entries = 1
+    number_of_sums = 0
+    starts[0] = start
+    lengths[0] = length
+
+    while number_of_entries > 0:
+        number_of_entries -= 1
+        start = starts[number_of_entries]
+        length = lengths[number_of_entries]
+        if length < 0:
+            number_of_sums -= 1
+            sums[number_of_sums - 1] = sums[number_of_sums - 1] + sums[number_of_sums]
+        elif length <= PAIRWISE_BLOCK_SIZE:
+            sums[number_of_sums] = block_sum(values, start, length)
+            number_of_sums += 1
+        else:
+            half = length // 2
+            half -= half % 8
+            # Popped in reverse order: the first half, the second half and then their addition
+            starts[number_of_entries] = start
+            lengths[number_of_entries] = -1
+            starts[number_of_entries + 1] = start + half
+            lengths[number_of_entries + 1] = length - half
+            starts[number_of_entries + 2] = start
+            lengths[number_of_entries + 2] = half
+            number_of_entries += 3
+
+    return sums[0]
+
+
+@_jit
+def flatness_scores_kernel(values, offsets, flattening_factors):
+    """
+    Same as MethodBase.flatness_scores_batched
+
+    :param values: numpy array of the shifts of all the MTs
+    :param offsets: numpy array of the start of every MT in values followed by the length of values
+    :param flattening_factors: numpy array of the flattening factors
+    :return: numpy array of the flatness score of every MT (rows) with every factor (columns)
+    """
+    number_of_groups = len(offsets) - 1
+    scores = np.zeros((number_of_groups, len(flattening_factors)))
+    differences = np.empty(max(len(values), 1))
+
+    for group in range(number_of_groups):
+        start = offsets[group]
+        size = offsets[group + 1] - start
+        for k in range(len(flattening_factors)):
+            factor = flattening_factors[k]
+            # Differences of consecutive flattened shifts, shift i is flattened by (i + 1) * factor
+            for i in range(size - 1):
+                flattened = values[start + i] - (i + 1) * factor
+                next_flattened = values[start + i + 1] - (i + 2) * factor
+                differences[i] = abs(next_flattened - flattened)
+            scores[group, k] = pairwise_sum(differences, 0, size - 1)
+
+    return scores
+
+
+@_jit
+def group_by_bins_kernel(bin_ids):
+    """
+    Groups the indices of values by their bin, as MethodBase.group_by_bins
+
+    :param bin_ids: numpy array of the bin of every value (np.digitize)
+    :return: numpy array of the bins in the order of their first value, numpy array of the indices grouped by bin (in
+    the same order) and numpy array of the start of every bin in the indices followed by the number of indices
+    """
+    ranks = np.full(bin_ids.max() + 1 if len(bin_ids) else 1, -1, dtype=np.int64)
+    bins = np.empty(len(bin_ids), dtype=np.int64)
+    sizes = np.zeros(len(bin_ids) + 1, dtype=np.int64)
+    number_of_bins = 0
+    for i in range(len(bin_ids)):
+        if ranks[bin_ids[i]] < 0:
+            ranks[bin_ids[i]] = number_of_bins
+            bins[number_of_bins] = bin_ids[i]
+            number_of_bins += 1
+        sizes[ranks[bin_ids[i]] + 1] += 1
+
+    offsets = np.cumsum(sizes[:number_of_bins + 1])
+    positions = offsets[:-1].copy()
+    members = np.empty(len(bin_ids), dtype=np.int64)
+    for i in range(len(bin_ids)):
+        rank = ranks[bin_ids[i]]
+        members[positions[rank]] = i
+        positions[rank] += 1
+
+    return bins[:number_of_bins], members, offsets
+
+
+@_jit
+def merge_pairs_kernel(pairs, number_of_angles):
+    """
+    The pair-merging loop of MethodBase.cluster_shallow_slopes: the last pair is merged with all the pairs that share an
+    angle with it, the pairs inside the new cluster are removed and this is repeated until there are no pairs left
+
+    :param pairs: numpy array (pairs x 2) of the indices of the pairs within the cutoff, in row-major order
+    :param number_of_angles: number of angles
+    :return: numpy array of the sorted indices of every cluster one after the other and numpy array of the start of
+    every cluster followed by the number of indices
+    """
+    alive = np.ones(len(pairs), dtype=np.bool_)
+    in_cluster = np.zeros(number_of_angles, dtype=np.bool_)
+    members = np.empty(max(number_of_angles, 1), dtype=np.int64)
+    offsets = np.zeros(len(pairs) + 1, dtype=np.int64)
+    number_of_members = 0
+    number_of_clusters = 0
+
+    last = len(pairs) - 1
+    while True:
+        # Pairs are only removed, so the last pair is never after the previous one
+        while last >= 0 and not alive[last]:
+            last -= 1
+        if last < 0:
+            break
+        first_angle = pairs[last, 0]
+        second_angle = pairs[last, 1]
+
+        in_cluster[:] = False
+        for q in range(last + 1):
+            if alive[q] and (pairs[q, 0] == first_angle or pairs[q, 1] == first_angle or
+                             pairs[q, 0] == second_angle or pairs[q, 1] == second_angle):
+                in_cluster[pairs[q, 0]] = True
+                in_cluster[pairs[q, 1]] = True
+        for q in range(last + 1):
+            if alive[q] and in_cluster[pairs[q, 0]] and in_cluster[pairs[q, 1]]:
+                alive[q] = False
+
+        for index in range(number_of_angles):
+            if in_cluster[index]:
+                if number_of_members == len(members):
+                    grown = np.empty(2 * len(members), dtype=np.int64)
+                    grown[:number_of_members] = members
+                    members = grown
+                members[number_of_members] = index
+                number_of_members += 1
+        number_of_clusters += 1
+        offsets[number_of_clusters] = number_of_members
+
+    return members[:number_of_members], offsets[:number_of_clusters + 1]
@@ -0,0 +1,108 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Joins between the particles tables of different RELION iterations (e.g. run_it000_data.star and run_it0xx_data.star)
+on a composite key: an MT key (rlnMicrographName, rlnHelicalTubeID) or a segment key (rlnImageName).
+The key of every row of one table is put in a hash index once, after that the rows of the other table are found all at
+once, and any set of columns is copied between the tables in a single vectorized operation instead of a scan of the
+table for every key.
+
+"""
+import numpy as np
+import pandas as pd
+
+# Key of a single segment, the same in all the iterations
+SEGMENT_KEY = ['rlnImageName']
+
+
+class KeyIndex:
+    """
+    Hash index of the rows of a table on a composite key:
+
+        key_index = KeyIndex.from_dataframe(particles_dataframe0, SEGMENT_KEY)
+        positions = key_index.find_dataframe(particles_dataframe1, SEGMENT_KEY)
+    """
+
+    def __init__(self, key_columns):
+        """
+        :param key_columns: list of numpy arrays of the columns of the key, one value for every row
+        """
+        key_columns = [np.asarray(column) for column in key_columns]
+        if len(key_columns) == 1:
+            self.index = pd.Index(key_columns[0])
+        else:
+            self.index = pd.MultiIndex.from_arrays(key_columns)
+        if not self.index.is_unique:
+            raise ValueError("The key is not unique in the table, rows with the same key can't be told apart")
+
+    @classmethod
+    def from_dataframe(cls, dataframe, key_labels):
+        """
+        :param dataframe: pandas.DataFrame with the key columns
+        :param key_labels: labels of the columns of the key
+        :return: KeyIndex of the rows of the DataFrame
+        """
+        return cls([dataframe[label].to_numpy() for label in key_labels])
+
+    @classmethod
+    def from_microtubule_index(cls, microtubule_index):
+        """
+        :param microtubule_index: MicrotubuleIndex
+        :return: KeyIndex of the MTs of the index on (rlnMicrographName, rlnHelicalTubeID)
+        """
+        return cls(microtubule_index.key_columns())
+
+    def __len__(self):
+        return len(self.index)
+
+    def find(self, key_columns):
+        """
+        :param key_columns: list of numpy arrays of the columns of the keys to find
+        :return: numpy array of the position of every key in the indexed table, -1 for keys that are not there
+        """
+        key_columns = [np.asarray(column) for column in key_columns]
+        if len(key_columns) == 1:
+            keys = pd.Index(key_columns[0])
+        else:
+            keys = pd.MultiIndex.from_arrays(key_columns)
+        return self.index.get_indexer(keys)
+
+    def find_dataframe(self, dataframe, key_labels):
+        """
+        :param dataframe: pandas.DataFrame with the key columns
+        :param key_labels: labels of the columns of the key
+        :return: numpy array of the position of every row of the DataFrame in the indexed table, -1 for rows that are
+        not there
+        """
+        return self.find([dataframe[label].to_numpy() for label in key_labels])
+
+
+def transfer_columns(source_dataframe, target_dataframe, labels, key_labels=SEGMENT_KEY):
+    """
+    Copies columns from the rows of the source table to the rows of the target table with the same key, in place.
+    Target rows without a source row keep their values (or get NaN if the target didn't have the column).
+
+    :param source_dataframe: pandas.DataFrame to copy the columns from (e.g. run_it0xx_data.star)
+    :param target_dataframe: pandas.DataFrame to copy the columns to (e.g. run_it000_data.star)
+    :param labels: labels of the columns to copy
+    :param key_labels: labels of the columns of the key, unique in the source table
+    :return: boolean numpy array, True for the target rows that were found in the source table
+    """
+    positions = KeyIndex.from_dataframe(source_dataframe, key_labels).find_dataframe(target_dataframe, key_labels)
+    found = positions >= 0
+
+    for label in labels:
+        source_values = source_dataframe[label].to_numpy()
+        if label in target_dataframe.columns:
+            target_values = target_dataframe[label].to_numpy()
+            values = target_values.astype(np.result_type(target_values, source_values))
+        elif source_values.dtype.kind in 'iuf':
+            values = np.full(len(target_dataframe), np.nan)
+        else:
+            values = np.full(len(target_dataframe), None, dtype=object)
+        values[found] = source_values[positions[found]]
+        target_dataframe[label] = values
+
+    return found
@@ -1,7 +1,7 @@
 """
 Author: Alina Levitin
 Date: 02/04/24
-Updated: 27/05/24
+Updated: 18/10/26
 
 This contains the base class for all the methods and wrappers for the methods
 
@@ -13,6 +13,15 @@ import functools
 import numpy as np
 import matplotlib.pyplot as plt
 
+from .angle_clustering import unwrap_angles, wrap_angles, ROT_PERIOD
+from .microtubule_index import MicrotubuleIndex
+from .class_count_matrix import ClassCountMatrix
+from .grouped_kernels import grouped_histogram_bins
+from .jit_kernels import JIT_AVAILABLE, flatness_scores_kernel, group_by_bins_kernel, merge_pairs_kernel
+
+# Maximal number of flattened shifts computed at once by flatten_and_cluster_shifts_batched
+FLATTENING_BATCH_SIZE = 4 * 1024 ** 2
+
 
 # Base class for all the method classes
 class MethodBase:
@@ -60,10 +69,30 @@ class MethodBase:
 
         return linear_fit_values
 
+    def fit_angle_clusters(self, angles, top_cluster, period=ROT_PERIOD):
+        """
+        Fits the angles according to the linear fit of the top cluster, as fit_clusters, but a top cluster that crosses
+        the wrap-around (e.g. 179 and -179) is unwrapped before fitting and the fit values are wrapped back
+
+        :param angles: numpy array of the angles to fit
+        :param top_cluster: top cluster of angles from cluster_angles
+        :param period: period of the angles
+        :return: fit values
+        """
+        top_angles = angles[top_cluster]
+        unwrapped_angles = unwrap_angles(top_angles, period)
+        if unwrapped_angles is top_angles:
+            return self.fit_clusters(angles, top_cluster)
+
+        angles = angles.copy()
+        angles[top_cluster] = unwrapped_angles
+        return wrap_angles(self.fit_clusters(angles, top_cluster), period)
+
     @staticmethod
     def cluster_shallow_slopes(angles, cutoff):
         """
         Clusters angles based on pairwise differences within a cutoff range.
+        Builds the N x N matrix of differences, angle_clustering.cluster_angles gives the same clusters much faster.
 
         Parameters:
         :param angles: (array-like): An array of angle values.
@@ -88,6 +117,29 @@ class MethodBase:
         # Find the indices of the pairs within the cutoff range
         pairs = np.transpose(np.nonzero(within_cutoff))
 
+        if JIT_AVAILABLE:
+            members, offsets = merge_pairs_kernel(pairs, len(angles))
+            clusters = [members[offsets[k]:offsets[k + 1]].tolist() for k in range(len(offsets) - 1)]
+        else:
+            clusters = MethodBase.merge_pairs(pairs)
+
+        # Find the cluster with the maximum length
+        if clusters:
+            top_cluster = max(clusters, key=len)
+            low_weight_cluster = [j for i in clusters if i != top_cluster for j in i]
+        else:
+            top_cluster, low_weight_cluster = None, None
+
+        return top_cluster, low_weight_cluster
+
+    @staticmethod
+    def merge_pairs(pairs):
+        """
+        Merges the pairs of cluster_shallow_slopes into clusters
+
+        :param pairs: numpy array (pairs x 2) of the indices of the pairs within the cutoff
+        :return: list of the clusters (sorted lists of indices)
+        """
         # Initialize a list to store clusters
         clusters = []
 
@@ -110,14 +162,7 @@ class MethodBase:
             # Remove the pairs belonging to the cluster from the list
             pairs = pairs[~np.isin(pairs, related_pairs).all(axis=1)]
 
-        # Find the cluster with the maximum length
-        if clusters:
-            top_cluster = max(clusters, key=len)
-            low_weight_cluster = [j for i in clusters if i != top_cluster for j in i]
-        else:
-            top_cluster, low_weight_cluster = None, None
-
-        return top_cluster, low_weight_cluster
+        return clusters
 
     def flatten_and_cluster_shifts(self, shifts, cutoff):
         """
@@ -131,35 +176,82 @@ class MethodBase:
         top_cluster (list): The cluster with the maximum length of flattened shifts.
         low_weight_cluster (list): The outliers from the flattened shifts.
         """
+        shifts = np.asarray(shifts, dtype=float)
         # Generate flattening factors within the specified cutoff range
         flattening_factors = np.arange(-cutoff, cutoff, 0.25)
-        flatness_score = []
-        b = []
 
-        # Initialize arrays to store flattened shifts and flatness scores
-        flattened_shifts = np.zeros((len(flattening_factors), len(shifts)))
-        flatness_scores = np.zeros(len(flattening_factors))
+        if JIT_AVAILABLE:
+            flatness_scores = flatness_scores_kernel(shifts, np.array([0, len(shifts)]), flattening_factors)[0]
+            best_factor = flattening_factors[np.argmin(flatness_scores)]
+            return self.cluster_flattened_shifts(shifts - np.arange(1, len(shifts) + 1) * best_factor)
 
-        # Iterate over each flattening factor
-        for i, factor in enumerate(flattening_factors):
-            # Flatten shifts using broadcasting; adjust each shift by a linearly increasing factor
-            flattened_shifts[i] = shifts - np.arange(1, len(shifts) + 1) * factor
+        # Flatten shifts with all the factors at once; row i adjusts each shift by a linearly increasing factor i
+        flattened_shifts = shifts - np.arange(1, len(shifts) + 1) * flattening_factors[:, np.newaxis]
 
-            # Calculate flatness score as the sum of absolute differences between consecutive flattened shifts
-            flatness_scores[i] = np.sum(np.abs(np.diff(flattened_shifts[i])))
+        # Calculate flatness score as the sum of absolute differences between consecutive flattened shifts
+        flatness_scores = np.sum(np.abs(np.diff(flattened_shifts, axis=1)), axis=1)
 
-        # Find the index of the minimum flatness score
-        min_flatness_idx = np.argmin(flatness_scores)
+        # Cluster the shifts flattened with the factor of the minimum flatness score
+        return self.cluster_flattened_shifts(flattened_shifts[np.argmin(flatness_scores)])
 
-        # Compute histogram bins using numpy's automatic bin selection
-        try:
-            hist, bins = np.histogram(flattened_shifts[min_flatness_idx], bins='auto')
-        except MemoryError:
-            # Fallback to a fixed number of bins in case of memory error
-            hist, bins = np.histogram(flattened_shifts[min_flatness_idx], bins=5)
+    def flatten_and_cluster_shifts_batched(self, ragged_shifts, cutoff):
+        """
+        Same as flatten_and_cluster_shifts for the shifts of all the MTs.
+        The flatness scores of the MTs of the same length are computed together (MTs x factors x shifts), so every score
+        is summed exactly as for a single MT, and the flattened shifts of all the MTs are clustered at once.
+
+        :param ragged_shifts: RaggedArray of the shifts of every MT
+        :param cutoff: The range within which flattening factors are generated
+        :return: boolean numpy array, True for the shifts in the top cluster of their MT
+        """
+        flattening_factors = np.arange(-cutoff, cutoff, 0.25)
+        flatness_scores = self.flatness_scores_batched(ragged_shifts, flattening_factors)
+        best_factors = flattening_factors[np.argmin(flatness_scores, axis=1)]
+        return self.cluster_flattened_shifts_batched(ragged_shifts, best_factors)
+
+    @staticmethod
+    def flatness_scores_batched(ragged_shifts, flattening_factors):
+        """
+        Flatness scores of the shifts of every MT flattened with every factor, as in flatten_and_cluster_shifts
+
+        :param ragged_shifts: RaggedArray of the shifts of every MT
+        :param flattening_factors: numpy array of the flattening factors
+        :return: numpy array of the flatness score of every MT (rows) with every factor (columns)
+        """
+        if JIT_AVAILABLE:
+            return flatness_scores_kernel(ragged_shifts.values, ragged_shifts.offsets, flattening_factors)
+
+        sizes = ragged_shifts.sizes
+        flatness_scores = np.zeros((len(ragged_shifts), len(flattening_factors)))
+
+        for size in np.unique(sizes).tolist():
+            groups = np.flatnonzero(sizes == size)
+            # Limiting the number of flattened shifts in memory
+            batch_size = max(1, FLATTENING_BATCH_SIZE // (max(len(flattening_factors), 1) * size))
+            for batch in range(0, len(groups), batch_size):
+                batch_groups = groups[batch:batch + batch_size]
+                rows = ragged_shifts.offsets[batch_groups][:, np.newaxis] + np.arange(size)
+                shifts = ragged_shifts.values[rows][:, np.newaxis, :]
+
+                flattened_shifts = shifts - np.arange(1, size + 1) * flattening_factors[:, np.newaxis]
+                flatness_scores[batch_groups] = np.sum(np.abs(np.diff(flattened_shifts, axis=2)), axis=2)
+
+        return flatness_scores
+
+    def cluster_flattened_shifts(self, flattened_shifts):
+        """
+        Clusters flattened shifts by their histogram bins
+
+        :param flattened_shifts: numpy array of the shifts flattened with the best flattening factor
+        :return: top_cluster (list of the indices of the largest cluster) and low_weight_cluster (list of the indices of
+        the other clusters)
+        """
+        # Histogram bins of the shifts with numpy's automatic bin selection, found as for all the MTs at once by
+        # cluster_flattened_shifts_batched
+        bin_ids = grouped_histogram_bins(flattened_shifts, np.array([0, len(flattened_shifts)]))
 
         # Cluster shift values based on histogram bins
-        clusters = self.cluster_numpy_bins(flattened_shifts[min_flatness_idx], bins)
+        clusters = self.group_by_bins(bin_ids)
 
         # Sort clusters by size in descending order and get the largest cluster
         sorted_clusters = sorted(clusters.items(), key=lambda item: len(item[1]), reverse=True)
@@ -170,40 +262,89 @@ class MethodBase:
 
         return top_cluster, low_weight_cluster
 
+    @staticmethod
+    def cluster_flattened_shifts_batched(ragged_shifts, flattening_factors):
+        """
+        Same as cluster_flattened_shifts for the shifts of every MT flattened with its own factor: the histogram bins of
+        all the MTs are found at once and the largest bin of every MT (the first one if several are as large) is its top
+        cluster
+
+        :param ragged_shifts: RaggedArray of the shifts of every MT
+        :param flattening_factors: numpy array of the flattening factor of every MT
+        :return: boolean numpy array, True for the shifts in the top cluster of their MT
+        """
+        groups = ragged_shifts.group_numbers()
+        flattened_shifts = ragged_shifts.values - (ragged_shifts.positions() + 1) * flattening_factors[groups]
+        bin_ids = grouped_histogram_bins(flattened_shifts, ragged_shifts.offsets)
+
+        # Runs of the values of the same MT and bin, lexsort is stable so every run starts with its first value
+        order = np.lexsort((bin_ids, groups))
+        sorted_groups = groups[order]
+        sorted_bins = bin_ids[order]
+        new_run = np.ones(len(order), dtype=bool)
+        new_run[1:] = (sorted_groups[1:] != sorted_groups[:-1]) | (sorted_bins[1:] != sorted_bins[:-1])
+        run_starts = np.flatnonzero(new_run)
+        run_sizes = np.diff(np.append(run_starts, len(order)))
+        run_groups = sorted_groups[run_starts]
+
+        # The largest run of every MT, the one whose first value comes first if several are as large
+        best_runs = np.lexsort((order[run_starts], -run_sizes, run_groups))
+        best_runs = best_runs[np.unique(run_groups[best_runs], return_index=True)[1]]
+        top_bins = np.zeros(len(ragged_shifts), dtype=bin_ids.dtype)
+        top_bins[run_groups[best_runs]] = sorted_bins[run_starts[best_runs]]
+
+        return bin_ids == top_bins[groups]
+
     @staticmethod
     def cluster_numpy_bins(data, bins):
-        bin_ids = np.digitize(data, bins)
+        """
+        Groups the indices of the data by their histogram bin
 
-        cluster = {}
+        :param data: numpy array of values
+        :param bins: bin edges
+        :return: dictionary of bin number: list of the indices of the values in the bin, in the order of the first value
+        of every bin
+        """
+        return MethodBase.group_by_bins(np.digitize(data, bins))
 
-        for idx, a in enumerate(bin_ids):
-            if a in cluster.keys():
-                for b in cluster.keys():
-                    if a == b:
-                        cluster[b].append(idx)
-                    else:
-                        pass
-            else:
-                cluster[a] = [idx]
+    @staticmethod
+    def group_by_bins(bin_ids):
+        """
+        Groups the indices of values by their bin
+
+        :param bin_ids: numpy array of the bin of every value
+        :return: dictionary of bin number: list of the indices of the values in the bin, in the order of the first value
+        of every bin
+        """
+        if JIT_AVAILABLE:
+            bin_numbers, members, offsets = group_by_bins_kernel(bin_ids)
+            return {bin_number: members[offsets[k]:offsets[k + 1]].tolist()
+                    for k, bin_number in enumerate(bin_numbers)}
+
+        bin_values, first_indices, inverse = np.unique(bin_ids, return_index=True, return_inverse=True)
+
+        # The bins in the order of their first value, and the indices sorted by the bin in that order
+        appearance = np.argsort(first_indices)
+        ranks = np.empty_like(appearance)
+        ranks[appearance] = np.arange(len(appearance))
+        members = np.argsort(ranks[inverse], kind='stable')
+        sizes = np.bincount(inverse)[appearance]
 
-        return cluster
+        return {bin_ids[first_indices[bin_number]]: indices.tolist()
+                for bin_number, indices in zip(appearance, np.split(members, np.cumsum(sizes)[:-1]))}
 
     def plot_confidence_distribution(self, data, cutoff=None):
 
+        microtubule_index = MicrotubuleIndex.from_dataframe(data)
         if cutoff:
-            data = self.filter_microtubules_by_length(data, cutoff)
-
-        # Group particle data by micrograph name and helical tube ID
-        grouped_data = data.groupby(['rlnMicrographName', 'rlnHelicalTubeID'])
-
-        # Calculate confidence distribution for each microtubule
-        cer = []
-        for _, group in grouped_data:
-            cls_distribution = group['rlnClassNumber'].value_counts()
-            max_count = cls_distribution.max()
-            total_particles = len(group)
-            confidence = (max_count / total_particles) * 100
-            cer.append(confidence)
+            # MTs with fewer segments than the cutoff are left out
+            keep = microtubule_index.row_mask(microtubule_index.sizes >= cutoff)
+            data = data[keep]
+            microtubule_index = microtubule_index.select_rows(keep)
+
+        # Calculate confidence distribution for each microtubule (micrograph name and helical tube ID), the percent of
+        # its segments in its most common class
+        cer = ClassCountMatrix.from_index(data['rlnClassNumber'].to_numpy(), microtubule_index).confidences()
 
         # Create a histogram of the confidence distribution
         fig, ax = plt.subplots()
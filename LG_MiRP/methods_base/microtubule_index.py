@@ -0,0 +1,235 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Index of the segments of every microtubule (MT) in a particles data block.
+The MTs are found once by sorting the rows by micrograph and helical tube ID, after that the rows of any MT are a
+slice of the sorted row positions, so the methods don't need to compute a mask over the whole data block for every MT.
+
+"""
+import numpy as np
+import pandas as pd
+
+from .keyed_join import KeyIndex
+
+# Columns identifying a single MT
+MICROTUBULE_LABELS = ['rlnMicrographName', 'rlnHelicalTubeID']
+
+
+class MicrotubuleIndex:
+    """
+    Index of the rows of every MT (rlnMicrographName, rlnHelicalTubeID group) in a particles DataFrame.
+    The MTs are in the same order as in DataFrame.groupby(['rlnMicrographName', 'rlnHelicalTubeID']) and the rows of
+    each MT keep their order in the DataFrame, so iterating over the index gives the same groups as groupby:
+
+        for (micrograph, tube_id), rows in MicrotubuleIndex.from_dataframe(particles_dataframe):
+            values = particles_dataframe['rlnAngleRot'].to_numpy()[rows]
+
+    The rows are positions (as in DataFrame.iloc), so an index is only valid for the DataFrame it was built from, use
+    select_rows after removing rows.
+    """
+
+    def __init__(self, micrographs, group_micrographs, group_tubes, order, starts, stops, number_of_rows):
+        """
+        :param micrographs: numpy array of the micrograph names (sorted), the MTs refer to them by their position
+        :param group_micrographs: position of the micrograph of every MT in micrographs
+        :param group_tubes: helical tube ID of every MT
+        :param order: row positions sorted by MT
+        :param starts: start of the rows of every MT in order
+        :param stops: end of the rows of every MT in order
+        :param number_of_rows: number of rows in the indexed DataFrame
+        """
+        self.micrographs = micrographs
+        self.group_micrographs = group_micrographs
+        self.group_tubes = group_tubes
+        self.order = order
+        self.starts = starts
+        self.stops = stops
+        self.number_of_rows = number_of_rows
+        self._groups = None
+
+    @classmethod
+    def from_dataframe(cls, particles_dataframe, group_labels=MICROTUBULE_LABELS):
+        """
+        Builds the index of a particles DataFrame
+
+        :param particles_dataframe: particles data block containing the group_labels columns
+        :param group_labels: the columns that identify a single MT
+        :return: MicrotubuleIndex
+        """
+        micrograph_label, tube_label = group_labels
+        micrograph_codes, micrographs = pd.factorize(particles_dataframe[micrograph_label], sort=True)
+        tube_codes, tube_ids = pd.factorize(particles_dataframe[tube_label], sort=True)
+
+        # lexsort is stable, so the rows of each MT stay in their original order
+        order = np.lexsort((tube_codes, micrograph_codes))
+
+        # Rows with a missing micrograph name or tube ID don't belong to any MT (as in groupby)
+        order = order[(micrograph_codes[order] >= 0) & (tube_codes[order] >= 0)]
+
+        sorted_micrographs = micrograph_codes[order]
+        sorted_tubes = tube_codes[order]
+        new_group = np.ones(len(order), dtype=bool)
+        new_group[1:] = (sorted_micrographs[1:] != sorted_micrographs[:-1]) | (sorted_tubes[1:] != sorted_tubes[:-1])
+        starts = np.flatnonzero(new_group)
+        stops = np.append(starts[1:], len(order))
+
+        return cls(micrographs=np.asarray(micrographs, dtype=object),
+                   group_micrographs=sorted_micrographs[starts].astype(np.int32),
+                   group_tubes=np.asarray(tube_ids)[sorted_tubes[starts]],
+                   order=order,
+                   starts=starts,
+                   stops=stops,
+                   number_of_rows=len(particles_dataframe))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        """
+        :return: generator of ((micrograph, tube_id), rows) for every MT, rows are positions in the DataFrame
+        """
+        micrographs = self.micrographs[self.group_micrographs].tolist()
+        for micrograph, tube_id, start, stop in zip(micrographs, self.group_tubes.tolist(), self.starts, self.stops):
+            yield (micrograph, tube_id), self.order[start:stop]
+
+    def keys(self):
+        """
+        :return: list of (micrograph, tube_id) of every MT
+        """
+        return list(zip(self.micrographs[self.group_micrographs].tolist(), self.group_tubes.tolist()))
+
+    def rows(self, group):
+        """
+        :param group: number of the MT in the index
+        :return: positions of the rows of the MT in the DataFrame
+        """
+        return self.order[self.starts[group]:self.stops[group]]
+
+    def find(self, micrograph, tube_id):
+        """
+        Finds an MT by its micrograph name and tube ID
+
+        :param micrograph: micrograph name
+        :param tube_id: helical tube ID
+        :return: number of the MT in the index, None if there is no such MT
+        """
+        if self._groups is None:
+            self._groups = {key: group for group, key in enumerate(self.keys())}
+        return self._groups.get((micrograph, tube_id))
+
+    def key_columns(self):
+        """
+        :return: numpy arrays of the micrograph name and of the tube ID of every MT
+        """
+        return [self.micrographs[self.group_micrographs], self.group_tubes]
+
+    def match(self, other):
+        """
+        Finds the MTs of this index in another index (e.g. of another iteration of the same particles) at once, with a
+        hash index on the MT key of the other index
+
+        :param other: MicrotubuleIndex
+        :return: numpy array of the number of every MT of this index in other, -1 for MTs that are not in other
+        """
+        return KeyIndex.from_microtubule_index(other).find(self.key_columns())
+
+    @property
+    def sizes(self):
+        """
+        :return: numpy array of the number of segments of every MT
+        """
+        return self.stops - self.starts
+
+    def group_numbers(self):
+        """
+        :return: numpy array of the number of the MT of every row, -1 for rows that don't belong to any MT
+        """
+        numbers = np.full(self.number_of_rows, -1, dtype=np.int64)
+        numbers[self.order] = np.repeat(np.arange(len(self)), self.sizes)
+        return numbers
+
+    def to_rows(self, group_values, fill):
+        """
+        :param group_values: numpy array with a value for every MT
+        :param fill: value of the rows that don't belong to any MT
+        :return: numpy array with the value of the MT of every row
+        """
+        values = np.full(self.number_of_rows, fill, dtype=np.result_type(group_values, fill))
+        values[self.order] = np.repeat(group_values, self.sizes)
+        return values
+
+    def row_mask(self, group_mask):
+        """
+        :param group_mask: boolean numpy array with a value for every MT
+        :return: boolean numpy array with a value for every row, True for the rows of the selected MTs
+        """
+        mask = np.zeros(self.number_of_rows, dtype=bool)
+        mask[self.order[np.repeat(group_mask, self.sizes)]] = True
+        return mask
+
+    def select_rows(self, keep):
+        """
+        Builds the index of DataFrame[keep] without sorting again
+
+        :param keep: boolean numpy array with a value for every row
+        :return: MicrotubuleIndex of the kept rows
+        """
+        keep = np.asarray(keep, dtype=bool)
+        new_positions = np.cumsum(keep) - 1
+
+        kept = keep[self.order]
+        groups = np.repeat(np.arange(len(self)), self.sizes)[kept]
+        sizes = np.bincount(groups, minlength=len(self))
+        not_empty = sizes > 0
+        stops = np.cumsum(sizes[not_empty])
+
+        return MicrotubuleIndex(micrographs=self.micrographs,
+                                group_micrographs=self.group_micrographs[not_empty],
+                                group_tubes=self.group_tubes[not_empty],
+                                order=new_positions[self.order[kept]],
+                                starts=stops - sizes[not_empty],
+                                stops=stops,
+                                number_of_rows=int(keep.sum()))
+
+    def split_by_micrograph(self, number_of_shards):
+        """
+        Splits the MTs into consecutive shards with about the same number of rows, all the MTs of a micrograph are in
+        the same shard
+
+        :param number_of_shards: maximal number of shards
+        :return: list of (first MT, end MT) of every shard, fewer shards if there are not enough micrographs
+        """
+        # The first MT of every micrograph is where a shard may start
+        micrograph_starts = np.flatnonzero(np.diff(self.group_micrographs, prepend=-1) != 0)
+        targets = np.arange(1, number_of_shards) * len(self.order) / number_of_shards
+        cuts = np.append(micrograph_starts, len(self))[np.searchsorted(self.starts[micrograph_starts], targets)]
+        boundaries = np.unique(np.concatenate([[0], cuts, [len(self)]])).tolist()
+        return [(first, end) for first, end in zip(boundaries[:-1], boundaries[1:]) if first < end]
+
+    def to_arrays(self):
+        """
+        :return: dictionary of numpy arrays describing the index, for saving it
+        """
+        return {'micrographs': np.char.encode(self.micrographs.astype(str), 'utf-8'),
+                'group_micrographs': self.group_micrographs,
+                'group_tubes': self.group_tubes,
+                'order': self.order,
+                'starts': self.starts,
+                'stops': self.stops,
+                'number_of_rows': np.array(self.number_of_rows)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        :param arrays: dictionary of numpy arrays from to_arrays
+        :return: MicrotubuleIndex
+        """
+        return cls(micrographs=np.char.decode(arrays['micrographs'], 'utf-8').astype(object),
+                   group_micrographs=arrays['group_micrographs'],
+                   group_tubes=arrays['group_tubes'],
+                   order=arrays['order'],
+                   starts=arrays['starts'],
+                   stops=arrays['stops'],
+                   number_of_rows=int(arrays['number_of_rows']))
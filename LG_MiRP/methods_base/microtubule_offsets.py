@@ -0,0 +1,170 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Random access to the segments of single microtubules (MTs) in a STAR file.
+The byte offset of every row of the particles data block is found once and saved in the cache together with the
+MicrotubuleIndex of the file, after that the rows of any MT are read directly from the file, so reading a few MTs
+doesn't depend on the size of the data set.
+
+"""
+import io
+import random
+
+import numpy as np
+import pandas as pd
+
+from .star_reader import read_loop_block, read_csv_options
+from .star_cache import star_cache
+from .microtubule_index import MicrotubuleIndex, MICROTUBULE_LABELS
+
+# Number of bytes scanned at once when looking for the rows
+SCAN_WINDOW_SIZE = 64 * 1024 ** 2
+
+# Bytes that don't start a row
+_WHITESPACE = np.frombuffer(b' \t\r\n', dtype=np.uint8)
+_COMMENT = ord('#')
+
+
+class MicrotubuleOffsets:
+    """
+    Byte offsets of the rows of every MT in a loop block of a STAR file:
+
+        offsets = MicrotubuleOffsets.load_or_build(scan_star_file(path)['particles'])
+        for (micrograph, tube_id), mt_dataframe in offsets.sample(10, columns=['rlnAngleRot']):
+            ...
+    """
+
+    def __init__(self, block, microtubule_index, row_offsets):
+        """
+        :param block: StarBlock of the particles data block
+        :param microtubule_index: MicrotubuleIndex of the rows of the block
+        :param row_offsets: numpy array of the byte offset of every row in the file, followed by the end of the block
+        """
+        self.block = block
+        self.microtubule_index = microtubule_index
+        self.row_offsets = row_offsets
+
+    @classmethod
+    def build(cls, block):
+        """
+        Finds the rows of every MT in a loop block, only the MT columns are parsed
+
+        :param block: StarBlock from scan_star_file
+        :return: MicrotubuleOffsets
+        """
+        microtubule_index = MicrotubuleIndex.from_dataframe(read_loop_block(block.path, block, MICROTUBULE_LABELS))
+        row_offsets = find_row_offsets(block)
+        if len(row_offsets) - 1 != microtubule_index.number_of_rows:
+            raise ValueError(f'Could not find the rows of {block.name} in {block.path}')
+        return cls(block, microtubule_index, row_offsets)
+
+    @classmethod
+    def load_or_build(cls, block, use_cache=True):
+        """
+        Loads the offsets of a loop block from the cache, or builds and caches them
+
+        :param block: StarBlock from scan_star_file
+        :param use_cache: if False the offsets are always built
+        :return: MicrotubuleOffsets
+        """
+        cache_name = f'microtubule_offsets_{block.name}'
+        arrays = star_cache.load_arrays(block.path, cache_name) if use_cache else None
+        if arrays is not None:
+            return cls(block, MicrotubuleIndex.from_arrays(arrays), arrays['row_offsets'])
+
+        offsets = cls.build(block)
+        if use_cache:
+            star_cache.store_arrays(block.path, cache_name,
+                                    dict(offsets.microtubule_index.to_arrays(), row_offsets=offsets.row_offsets))
+        return offsets
+
+    def __len__(self):
+        return len(self.microtubule_index)
+
+    def read(self, groups, columns=None):
+        """
+        Reads the rows of some MTs from the file
+
+        :param groups: numbers of the MTs in the microtubule_index
+        :param columns: labels of the columns to parse (None for all)
+        :return: list of ((micrograph, tube_id), pandas.DataFrame) of every MT, the index of each DataFrame is the row
+        numbers in the file (as when reading the whole block)
+        """
+        index = self.microtubule_index
+        if len(groups) == 0:
+            return []
+        rows = np.concatenate([index.rows(group) for group in groups])
+
+        # Consecutive rows are read at once
+        run_starts = np.flatnonzero(np.diff(rows, prepend=-2) != 1)
+        run_stops = np.append(run_starts[1:], len(rows))
+        pieces = []
+        with open(self.block.path, 'rb') as file:
+            for first, last in zip(rows[run_starts], rows[run_stops - 1]):
+                file.seek(self.row_offsets[first])
+                pieces.append(file.read(self.row_offsets[last + 1] - self.row_offsets[first]))
+                if not pieces[-1].endswith(b'\n'):
+                    pieces.append(b'\n')
+
+        dataframe = pd.read_csv(io.BytesIO(b''.join(pieces)), **read_csv_options(self.block, columns))
+        if len(dataframe) != len(rows):
+            raise ValueError(f'{self.block.path} changed since its microtubule offsets were found')
+        dataframe.index = rows
+
+        keys = index.keys()
+        microtubules = []
+        start = 0
+        for group in groups:
+            stop = start + index.stops[group] - index.starts[group]
+            microtubules.append((keys[group], dataframe.iloc[start:stop]))
+            start = stop
+        return microtubules
+
+    def sample(self, n, columns=None):
+        """
+        Reads n random MTs from the file
+
+        :param n: number of MTs (all of them if there are fewer)
+        :param columns: labels of the columns to parse (None for all)
+        :return: list of ((micrograph, tube_id), pandas.DataFrame) of every MT
+        """
+        return self.read(random.sample(range(len(self)), min(n, len(self))), columns)
+
+
+def find_row_offsets(block):
+    """
+    Finds the byte offset of every row of a loop block, skipping empty and comment lines in the same way as pandas
+
+    :param block: StarBlock from scan_star_file
+    :return: numpy array of the offset of every row followed by the end of the block
+    """
+    offsets = []
+    with open(block.path, 'rb') as file:
+        position = block.data_start
+        while position < block.data_end:
+            file.seek(position)
+            window = file.read(min(SCAN_WINDOW_SIZE, block.data_end - position))
+
+            # Scanning only complete lines, the rest is scanned with the next window
+            if position + len(window) < block.data_end:
+                window = window[:window.rfind(b'\n') + 1] or window
+
+            data = np.frombuffer(window, dtype=np.uint8)
+            line_ends = np.flatnonzero(data == ord('\n'))
+            line_starts = np.concatenate([[0], line_ends + 1])
+            line_ends = np.append(line_ends, len(data))
+
+            # pandas skips the lines that are only whitespace and the lines that start with a comment
+            visible = np.flatnonzero(~np.isin(data, _WHITESPACE))
+            first_visible = np.searchsorted(visible, line_starts)
+            has_visible = first_visible < len(visible)
+            has_visible[has_visible] = visible[first_visible[has_visible]] < line_ends[has_visible]
+            is_row = has_visible & (data[np.minimum(line_starts, len(data) - 1)] != _COMMENT)
+
+            offsets.append(line_starts[is_row] + position)
+            position += len(window)
+
+    offsets.append(np.array([block.data_end]))
+    return np.concatenate(offsets).astype(np.int64)
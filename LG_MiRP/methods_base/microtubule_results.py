@@ -0,0 +1,154 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Results of a method for every microtubule (MT), saved next to its output so a later run can reuse them.
+Every MT is saved with a hash of its input values, so when the method is run again (e.g. on the data of the next RELION
+iteration) the results of the MTs whose input didn't change are reused and only the other MTs are computed.
+The results are saved for a set of parameters (e.g. the method and the cutoffs), results saved with other parameters are
+never used.
+
+"""
+import os
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+from .ragged_array import RaggedArray
+
+# Changing this invalidates all the saved results
+RESULTS_FORMAT_VERSION = 1
+
+DIGEST_SIZE = 16
+
+
+class MicrotubuleResults:
+    """
+    Saved per MT results: whether the MT was kept and its output values for every label.
+
+        results = MicrotubuleResults(path, {'method': 'angles', 'cutoff': 8})
+        entries = results.find(microtubule_index.keys(), MicrotubuleResults.input_digests([ragged_angles]))
+        ...
+        results.add(keys, digests, kept, {'rlnAngleRot': ragged_fit_values})
+        results.save()
+    """
+
+    def __init__(self, path, parameters):
+        """
+        Loads the results saved at path if they were saved with the same parameters
+
+        :param path: path of the .npz file of the results
+        :param parameters: dictionary of the parameters of the method (JSON serializable)
+        """
+        self.path = path
+        self.parameters = json.dumps({'version': RESULTS_FORMAT_VERSION, **parameters}, sort_keys=True)
+
+        self.keys = {}
+        self.digests = np.zeros(0, dtype=f'S{DIGEST_SIZE}')
+        self.kept = np.zeros(0, dtype=bool)
+        self.values = {}
+        self._new_results = []
+        self._load()
+
+    def _load(self):
+        """
+        Loads the saved results, missing, broken or outdated results are ignored
+        """
+        try:
+            with np.load(self.path) as results_file:
+                if str(results_file['parameters']) != self.parameters:
+                    print(f"The results in {self.path} were computed with other parameters and are not used")
+                    return
+                micrographs = np.char.decode(results_file['micrographs'], 'utf-8').tolist()
+                tubes = results_file['tubes'].tolist()
+                digests = results_file['digests']
+                kept = results_file['kept']
+                offsets = results_file['offsets']
+                values = {name[len('values_'):]: RaggedArray(results_file[name], offsets)
+                          for name in results_file.files if name.startswith('values_')}
+        except (OSError, ValueError, KeyError):
+            return
+
+        self.keys = {key: entry for entry, key in enumerate(zip(micrographs, tubes))}
+        self.digests = digests
+        self.kept = kept
+        self.values = values
+
+    @staticmethod
+    def input_digests(columns):
+        """
+        Hashes the input values of every MT
+
+        :param columns: list of RaggedArray of the input columns, all with the same MTs
+        :return: numpy array of the hash of every MT
+        """
+        digests = np.zeros(len(columns[0]), dtype=f'S{DIGEST_SIZE}')
+        for group in range(len(digests)):
+            digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+            for column in columns:
+                digest.update(np.ascontiguousarray(column[group]).tobytes())
+            digests[group] = digest.digest()
+        return digests
+
+    def find(self, keys, digests):
+        """
+        Finds the saved results of MTs with the same input
+
+        :param keys: list of (micrograph, tube_id) of the MTs
+        :param digests: numpy array of the input hash of every MT from input_digests
+        :return: numpy array of the number of the saved entry of every MT, -1 for MTs that have to be computed
+        """
+        entries = np.array([self.keys.get(key, -1) for key in keys], dtype=np.int64)
+        found = entries >= 0
+        found[found] = self.digests[entries[found]] == digests[found]
+        entries[~found] = -1
+        return entries
+
+    def add(self, keys, digests, kept, values):
+        """
+        Adds the results of MTs, they are saved by save
+
+        :param keys: list of (micrograph, tube_id) of the MTs
+        :param digests: numpy array of the input hash of every MT
+        :param kept: boolean numpy array, False for the MTs that were discarded
+        :param values: dictionary of label: RaggedArray of the output values of the MTs (ignored for discarded MTs)
+        """
+        self._new_results.append((list(keys), digests, kept, values))
+
+    def save(self):
+        """
+        Saves the added results, replacing the saved ones (so results of MTs that were not added are dropped)
+        """
+        keys = [key for result in self._new_results for key in result[0]]
+        labels = list(self._new_results[0][3]) if self._new_results else []
+
+        # Discarded MTs have no values
+        sizes = [np.zeros(0, dtype=np.int64)]
+        values = {label: [np.zeros(0)] for label in labels}
+        for _, _, kept, result_values in self._new_results:
+            sizes.append(np.where(kept, result_values[labels[0]].sizes, 0) if labels else np.zeros(len(kept), np.int64))
+            for label in labels:
+                values[label].append(result_values[label].take(np.flatnonzero(kept)).values)
+
+        arrays = {'parameters': np.array(self.parameters),
+                  'micrographs': np.char.encode(np.array([str(key[0]) for key in keys], dtype=str), 'utf-8'),
+                  'tubes': np.array([key[1] for key in keys], dtype=np.int64),
+                  'digests': np.concatenate([np.zeros(0, dtype=f'S{DIGEST_SIZE}')] +
+                                            [result[1] for result in self._new_results]),
+                  'kept': np.concatenate([np.zeros(0, dtype=bool)] + [result[2] for result in self._new_results]),
+                  'offsets': np.append(0, np.cumsum(np.concatenate(sizes)))}
+        for label in labels:
+            arrays[f'values_{label}'] = np.concatenate(values[label])
+
+        temporary_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary_path, 'wb') as results_file:
+                np.savez(results_file, **arrays)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print(f"Could not save the results to {self.path}: {e}")
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
@@ -0,0 +1,146 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Compact dtypes of the particles data block.
+Every numeric column is parsed as float64 or int64 and every path as a Python string, which is several times more memory
+than needed. compact_dtypes converts the columns listed in PARTICLES_SCHEMA to smaller dtypes, but only when the column
+is written back to exactly the same text by star_writer.py, so the conversion never changes an output file.
+
+"""
+import numpy as np
+import pandas as pd
+
+# Label: compact kind of the column
+# 'float32' - used only if every value is written with the same 6 decimals as the float64 value
+# 'integer' - the smallest of int16 and int32 that holds all the values
+# 'category' - used only if the column has few distinct values (micrographs, not images)
+PARTICLES_SCHEMA = {
+    'rlnAngleRot': 'float32',
+    'rlnAngleTilt': 'float32',
+    'rlnAnglePsi': 'float32',
+    'rlnAngleRotPrior': 'float32',
+    'rlnAngleTiltPrior': 'float32',
+    'rlnAnglePsiPrior': 'float32',
+    'rlnAnglePsiFlipRatio': 'float32',
+    'rlnOriginX': 'float32',
+    'rlnOriginY': 'float32',
+    'rlnOriginZ': 'float32',
+    'rlnOriginXAngst': 'float32',
+    'rlnOriginYAngst': 'float32',
+    'rlnOriginZAngst': 'float32',
+    'rlnOriginXPriorAngst': 'float32',
+    'rlnOriginYPriorAngst': 'float32',
+    'rlnCoordinateX': 'float32',
+    'rlnCoordinateY': 'float32',
+    'rlnHelicalTrackLengthAngst': 'float32',
+    'rlnMaxValueProbDistribution': 'float32',
+    'rlnClassNumber': 'integer',
+    'rlnHelicalTubeID': 'integer',
+    'rlnOpticsGroup': 'integer',
+    'rlnGroupNumber': 'integer',
+    'rlnRandomSubset': 'integer',
+    'rlnNrOfSignificantSamples': 'integer',
+    'rlnMicrographName': 'category',
+    'rlnImageName': 'category',
+    'rlnCtfImage': 'category',
+    'rlnOriginalImageName': 'category',
+}
+
+# Number of decimals written by star_writer.py (FLOAT_FORMAT)
+WRITTEN_DECIMALS = 6
+
+# A column becomes categorical only if it has at most this fraction of distinct values
+MAX_CATEGORY_FRACTION = 0.5
+CATEGORY_SAMPLE_SIZE = 10000
+
+
+def compact_dtypes(dataframe, schema=PARTICLES_SCHEMA):
+    """
+    Converts the columns of a particles DataFrame to the compact dtypes of the schema, in place.
+    Columns that can't be converted without changing their text in the output STAR file are left as they are.
+
+    :param dataframe: pandas.DataFrame of the particles data block
+    :param schema: dictionary of label: compact kind
+    :return: the same DataFrame
+    """
+    for label, kind in schema.items():
+        if label not in dataframe.columns or isinstance(dataframe[label].dtype, pd.CategoricalDtype):
+            continue
+
+        values = dataframe[label].to_numpy()
+        if kind == 'float32' and values.dtype == np.float64 and _fits_float32(values):
+            dataframe[label] = values.astype(np.float32)
+
+        elif kind == 'integer' and values.dtype.kind == 'i' and len(values):
+            for dtype in (np.int16, np.int32):
+                if np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max:
+                    if dtype != values.dtype:
+                        dataframe[label] = values.astype(dtype)
+                    break
+
+        elif kind == 'category' and values.dtype == object:
+            # Image names are usually all different, which is seen from the first rows without factorizing the column
+            sample = values[:CATEGORY_SAMPLE_SIZE]
+            if len(pd.unique(sample)) > MAX_CATEGORY_FRACTION * len(sample):
+                continue
+            codes, categories = pd.factorize(values, sort=True)
+            if len(categories) <= MAX_CATEGORY_FRACTION * len(values):
+                dataframe[label] = pd.Categorical.from_codes(codes, categories)
+
+    return dataframe
+
+
+def expand_dtypes(dataframe, labels):
+    """
+    Converts compact columns back to float64 and Python strings, in place. Needed before computing with a float32
+    column or setting single values that don't fit the compact dtype (e.g. a new micrograph name or a value with more
+    precision than float32).
+
+    :param dataframe: pandas.DataFrame of the particles data block
+    :param labels: labels of the columns to convert
+    :return: the same DataFrame
+    """
+    for label in labels:
+        if label not in dataframe.columns:
+            continue
+        dtype = dataframe[label].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            dataframe[label] = dataframe[label].to_numpy(dtype=object)
+        elif dtype == np.float32:
+            dataframe[label] = exact_float64(dataframe[label].to_numpy())
+    return dataframe
+
+
+def exact_float64(values):
+    """
+    Converts the values of a float32 column back to the float64 values parsed from the STAR file.
+    The float32 value of 0.1 is 0.10000000149..., which changes computations done with it, but it is closer to 0.1 than
+    half of the last written decimal (see _fits_float32), so rounding it to WRITTEN_DECIMALS gives the parsed value.
+
+    :param values: numpy array of float32
+    :return: numpy array of float64
+    """
+    scale = 10.0 ** WRITTEN_DECIMALS
+    return np.rint(values.astype(np.float64) * scale) / scale
+
+
+def _fits_float32(values):
+    """
+    Checks that float32 values are written with the same text as the float64 values.
+    That is the case when every value has at most WRITTEN_DECIMALS decimals (as in RELION files) and the float32 value
+    is closer to it than half of the last decimal, so both round to the same text.
+
+    :param values: numpy array of float64
+    :return: True if the column can be stored as float32
+    """
+    finite = np.isfinite(values)
+    values = values[finite]
+    if not len(values):
+        return True
+
+    scaled = values * 10.0 ** WRITTEN_DECIMALS
+    on_grid = np.abs(scaled - np.rint(scaled)) < 1e-3
+    close = np.abs(values.astype(np.float32).astype(np.float64) - values) < 0.4 * 10.0 ** -WRITTEN_DECIMALS
+    return bool(np.all(on_grid & close))
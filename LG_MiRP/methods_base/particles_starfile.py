@@ -1,23 +1,84 @@
 """
 Author: Alina Levitin
 Date: 28/07/24
-Updated: 28/07/24
+Updated: 18/10/26
 
 This contains a collection of plotting functions
 
 """
+import os
+
+import numpy as np
 import matplotlib.pyplot as plt
-import starfile
+
+from .star_reader import scan_star_file, read_star_file, read_loop_block, iter_microtubule_chunks, \
+    DEFAULT_CHUNK_SIZE
+from .star_cache import star_cache
+from .star_compression import compression_of
+from .star_delta import StarDelta, is_star_delta
+from .star_writer import write_star_file
+from .particles_schema import compact_dtypes
+from .microtubule_index import MicrotubuleIndex, MICROTUBULE_LABELS
+from .microtubule_offsets import MicrotubuleOffsets
+from .class_count_matrix import ClassCountMatrix
+
+# Columns shown in plot_angles_and_shifts
+ANGLES_AND_SHIFTS_LABELS = MICROTUBULE_LABELS + ['rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi',
+                                                 'rlnOriginXAngst', 'rlnOriginYAngst']
 
 
 class ParticlesStarfile:
 
-    def __init__(self, particles_starfile_path):
+    def __init__(self, particles_starfile_path, stream=False, use_cache=True, columns=None, data_blocks=None,
+                 workers=1, compact=True):
+        """
+        :param particles_starfile_path: path of the particles STAR file, a .star.gz or .star.zst file is decompressed
+        once to a plain copy in the cache and read from there. A delta file (.delta.npz, see star_delta.py) is read as
+        the STAR file it describes: its base file is read and the delta is applied to the particles.
+        :param stream: if True only the optics data block is read, the particles data block is read in chunks with
+        iter_particles instead of being loaded to particles_dataframe
+        :param use_cache: if True the parsed file is loaded from (and saved to) the binary cache in star_cache.py
+        :param columns: labels of the particles columns that are needed, only they are loaded to particles_dataframe.
+        The other columns are copied from this file when the particles are written with write_star_file(..., sources)
+        (None loads all the columns)
+        :param data_blocks: names of the data blocks to read, e.g. ['optics'] when only the pixel size is needed
+        (None reads all the blocks)
+        :param workers: number of processes used to parse a large particles data block
+        :param compact: if True the particles columns are stored with the compact dtypes of particles_schema.py
+        (float32 angles and shifts, small integers and categorical micrograph names) where it doesn't change the
+        written values
+        """
+        self.path = particles_starfile_path
+        self.use_cache = use_cache
+        self.columns = columns
+        self.data_blocks = data_blocks
+        self.workers = workers
+        self.compact = compact
         self.particles_dataframe = None
         self.optics_dataframe = None
         self.pixel_size = None
+        self.blocks = None
+        # Data blocks that were loaded without all their columns, for write_star_file
+        self.sources = {}
+        self._microtubule_index = None
+        self._microtubule_offsets = None
+        self._class_counts = None
+        self._base_file = None
+        # StarDelta applied to the particles of the base file if this is a delta file
+        self.delta = None
+        # The arrays computed from the particles (e.g. the microtubule index) are cached for this file
+        self.arrays_path = particles_starfile_path
         try:
-            self.read_particles_starfile(particles_starfile_path)
+            if is_star_delta(particles_starfile_path):
+                self.read_star_delta(particles_starfile_path, stream)
+            else:
+                if compression_of(particles_starfile_path):
+                    self.path = star_cache.plain_copy(particles_starfile_path)
+                self.arrays_path = self.path
+                if stream:
+                    self.read_optics_only(self.path)
+                else:
+                    self.read_particles_starfile(self.path)
         except FileNotFoundError:
             # Handle the case where the specified STAR file does not exist
             print("Error: The specified STAR file does not exist.")
@@ -25,31 +86,176 @@ class ParticlesStarfile:
             raise
 
     def read_particles_starfile(self, path):
-        particles_star_file_data = starfile.read(path)
-        self.particles_dataframe = particles_star_file_data['particles']
-        self.optics_dataframe = particles_star_file_data['optics']
+        # Parsing the text file only if it is not already in the cache
+        particles_star_file_data = star_cache.load(path, self.data_blocks) if self.use_cache else None
+        if particles_star_file_data is None:
+            self.blocks = scan_star_file(path)
+            # Only completely parsed files are cached, so when the cache is used the whole file is parsed even if only
+            # some columns are needed, and the next load of any columns of the file is read from the cache
+            store = self.use_cache and star_cache.enabled and self.data_blocks is None
+            columns = None if self.columns is None or store else {'particles': self.columns}
+            particles_star_file_data = read_star_file(path, self.data_blocks, columns, self.blocks, self.workers)
+            if store:
+                star_cache.store(path, particles_star_file_data)
+
+        if self.columns is not None and 'particles' in particles_star_file_data:
+            # Keeping only the requested columns (of the cache or of the whole file), the result is the same as parsing
+            # only these columns
+            particles = particles_star_file_data['particles']
+            particles_star_file_data['particles'] = particles[[label for label in particles.columns
+                                                               if label in self.columns]]
+            if self.blocks is None:
+                self.blocks = scan_star_file(path)
+            self.sources['particles'] = self.blocks['particles']
+
+        self.particles_dataframe = particles_star_file_data.get('particles')
+        if self.compact and self.particles_dataframe is not None:
+            compact_dtypes(self.particles_dataframe)
+        self.optics_dataframe = particles_star_file_data.get('optics')
+        if self.optics_dataframe is not None:
+            self.pixel_size = self.optics_dataframe['rlnImagePixelSize'].iloc[0]
+
+    def read_star_delta(self, path, stream=False):
+        """
+        Reads the base file of a delta file and applies the delta to its particles. The rows keep their numbers in the
+        original STAR file, so path, blocks and sources refer to it and its columns that were not loaded are copied
+        from it when writing.
+
+        :param path: path of the delta file
+        :param stream: if True only the optics data block is read, the delta is applied to every chunk of iter_particles
+        """
+        self.delta = StarDelta.load(path)
+        self.delta.check_base()
+        base_file = ParticlesStarfile(self.delta.base_path, stream=stream, use_cache=self.use_cache,
+                                      columns=self.columns, data_blocks=self.data_blocks, workers=self.workers,
+                                      compact=self.compact)
+        self.path = base_file.path
+        self.blocks = base_file.blocks
+        self.sources = base_file.sources
+        self.optics_dataframe = base_file.optics_dataframe
+        self.pixel_size = base_file.pixel_size
+        # The chunks of iter_particles come from the base file (a delta of a delta is applied after its base delta)
+        self._base_file = base_file
+
+        if base_file.particles_dataframe is not None:
+            self.particles_dataframe = self.delta.apply(base_file.particles_dataframe)
+
+    @property
+    def microtubule_index(self):
+        """
+        MicrotubuleIndex of particles_dataframe as it was loaded, built on first use and saved in the cache with the
+        file. It is not valid anymore once rows are removed from particles_dataframe (see MicrotubuleIndex.select_rows)
+
+        :return: MicrotubuleIndex
+        """
+        if self._microtubule_index is None:
+            arrays = star_cache.load_arrays(self.arrays_path, 'microtubule_index') if self.use_cache else None
+            if arrays is not None and int(arrays['number_of_rows']) == len(self.particles_dataframe):
+                self._microtubule_index = MicrotubuleIndex.from_arrays(arrays)
+            else:
+                self._microtubule_index = MicrotubuleIndex.from_dataframe(self.particles_dataframe)
+                if self.use_cache:
+                    star_cache.store_arrays(self.arrays_path, 'microtubule_index', self._microtubule_index.to_arrays())
+        return self._microtubule_index
+
+    @property
+    def class_counts(self):
+        """
+        ClassCountMatrix of the rlnClassNumber column of particles_dataframe as it was loaded, built on first use and
+        saved in the cache with the file
+
+        :return: ClassCountMatrix
+        """
+        if self._class_counts is None:
+            microtubule_index = self.microtubule_index
+            arrays = star_cache.load_arrays(self.arrays_path, 'class_counts') if self.use_cache else None
+            if arrays is not None and np.array_equal(arrays['sizes'], microtubule_index.sizes):
+                self._class_counts = ClassCountMatrix.from_arrays(arrays)
+            else:
+                self._class_counts = ClassCountMatrix.from_index(self.particles_dataframe['rlnClassNumber'].to_numpy(),
+                                                                 microtubule_index)
+                if self.use_cache:
+                    star_cache.store_arrays(self.arrays_path, 'class_counts', self._class_counts.to_arrays())
+        return self._class_counts
+
+    @property
+    def microtubule_offsets(self):
+        """
+        MicrotubuleOffsets of the particles data block, to read single MTs from the file without loading all of it.
+        Found on first use and saved in the cache with the file.
+
+        :return: MicrotubuleOffsets
+        """
+        if self.delta is not None:
+            raise ValueError(f"{self.arrays_path} is a delta file, its MTs can't be read from the STAR file directly")
+        if self._microtubule_offsets is None:
+            if self.blocks is None:
+                self.blocks = scan_star_file(self.path)
+            self._microtubule_offsets = MicrotubuleOffsets.load_or_build(self.blocks['particles'], self.use_cache)
+        return self._microtubule_offsets
+
+    def read_optics_only(self, path):
+        """
+        Reads the optics data block and finds where the particles data block is located without parsing it
+
+        :param path: path of the particles STAR file
+        """
+        self.blocks = scan_star_file(path)
+        self.optics_dataframe = read_loop_block(path, self.blocks['optics'])
         self.pixel_size = self.optics_dataframe['rlnImagePixelSize'].iloc[0]
 
+    def iter_particles(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Reads the particles data block in chunks of complete MTs, so a whole data set can be processed with a bounded
+        amount of memory
+
+        :param chunk_size: approximate number of segments in each chunk, a chunk grows to hold a whole MT
+        :return: generator of pandas.DataFrame chunks of the particles data block
+        """
+        if self.delta is not None:
+            return (self.delta.apply_to_chunk(chunk) for chunk in self._base_file.iter_particles(chunk_size))
+        if self.blocks is None:
+            self.blocks = scan_star_file(self.path)
+        chunks = iter_microtubule_chunks(self.path, self.blocks['particles'], chunk_size, self.columns)
+        if self.compact:
+            chunks = (compact_dtypes(chunk) for chunk in chunks)
+        return chunks
+
+
+def materialize_star_delta(delta_path, output_path):
+    """
+    Writes the complete STAR file described by a delta file, e.g. to use it in RELION. Only the columns that identify
+    the MTs are parsed, the changed columns come from the delta and the other ones are copied as text.
+
+    :param delta_path: path of the delta file
+    :param output_path: path of the STAR file, compressed if it ends with .gz or .zst
+    """
+    file = ParticlesStarfile(delta_path, columns=MICROTUBULE_LABELS)
+    new_particles_star_file_data = {'optics': file.optics_dataframe, 'particles': file.particles_dataframe}
+    write_star_file(new_particles_star_file_data, output_path, file.sources)
+    print(f"STAR file of {os.path.basename(delta_path)} saved as: {output_path}")
+
 
 def groupby_micrograph_and_helical_id(particles_dataframe):
-    return particles_dataframe.groupby(['rlnMicrographName', 'rlnHelicalTubeID'])
+    # observed=True so a categorical rlnMicrographName doesn't add empty groups
+    return particles_dataframe.groupby(['rlnMicrographName', 'rlnHelicalTubeID'], observed=True)
 
 
-def filter_microtubules_by_length(particles_dataframe, cutoff):
+def filter_microtubules_by_length(particles_dataframe, cutoff, microtubule_index=None):
     """
     Removes MTs in which the number of segments is lower than the cutoff
 
     :param particles_dataframe: data block from data star file
     :param cutoff: minimal number of segments to include
+    :param microtubule_index: MicrotubuleIndex of particles_dataframe, built if not given
     :return: data where MTs with number of segments lower than in the cutoff are excluded
     """
-    # Group the DataFrame by micrograph name and helical tube ID
-    grouped = particles_dataframe.groupby_micrograph_and_helical_id()
+    if microtubule_index is None:
+        microtubule_index = MicrotubuleIndex.from_dataframe(particles_dataframe)
 
     # Filter out microtubules with lengths below the cutoff
-    filtered_data = particles_dataframe.particles_dataframe[grouped.size() >= cutoff]
+    filtered_data = particles_dataframe[microtubule_index.row_mask(microtubule_index.sizes >= cutoff)]
 
-    # Write the updated DataFrame to a new STAR file
     return filtered_data
 
 
@@ -62,18 +268,16 @@ def mt_segment_histogram(particles_dataframe):
 
     :return: matplotlib histogram fig
     """
-    micrographs = particles_dataframe.particles_dataframe['rlnMicrographName'].unique()
-
-    mt_segments = []
-    for micrograph in micrographs:
-        mask = particles_dataframe.particles_dataframe['rlnMicrographName'] == micrograph
-        micrograph_star = particles_dataframe.particles_dataframe.loc[mask]
-        number_of_MTs = micrograph_star['rlnHelicalTubeID'].max()
-        for mt in range(1, number_of_MTs + 1):
-            mask_mt_number = micrograph_star['rlnHelicalTubeID'] == mt
-            mt_star = micrograph_star.loc[mask_mt_number]
-            number_of_segments_per_mt = mt_star.shape[0]
-            mt_segments.append(number_of_segments_per_mt)
+    microtubule_index = particles_dataframe.microtubule_index
+    sizes = microtubule_index.sizes
+    tube_ids = microtubule_index.group_tubes
+
+    # Every micrograph has the MTs 1, 2... up to its largest tube ID, the missing ones have 0 segments
+    largest_tube_ids = np.zeros(len(microtubule_index.micrographs), dtype=np.int64)
+    np.maximum.at(largest_tube_ids, microtubule_index.group_micrographs, tube_ids)
+    counted = tube_ids >= 1
+    missing_mts = int(largest_tube_ids.sum() - counted.sum())
+    mt_segments = np.concatenate([sizes[counted], np.zeros(missing_mts, dtype=sizes.dtype)])
 
     # Create a Matplotlib figure and axes
     fig, ax = plt.subplots()
@@ -0,0 +1,105 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+The values of all the microtubules (MTs) of a data set packed in one array, MT after MT, with the offset of every MT.
+Computations that would loop over the MTs in Python (e.g. fitting a line to every MT) are done on the whole array at
+once with the kernels of grouped_kernels.py.
+
+"""
+import numpy as np
+
+from .grouped_kernels import group_numbers, grouped_count, grouped_linear_fit
+
+
+class RaggedArray:
+    """
+    Ragged array of the values of every MT, the values of MT g are values[offsets[g]:offsets[g + 1]]:
+
+        ragged = RaggedArray.from_index(particles_dataframe['rlnAngleRot'].to_numpy(), microtubule_index)
+        for group in range(len(ragged)):
+            angles = ragged[group]
+    """
+
+    def __init__(self, values, offsets):
+        """
+        :param values: numpy array of the values of all the MTs
+        :param offsets: numpy array of the start of every MT in values followed by the length of values
+        """
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_index(cls, column, microtubule_index):
+        """
+        Packs a column of a particles DataFrame by MT
+
+        :param column: numpy array of a column of the DataFrame the index was built from
+        :param microtubule_index: MicrotubuleIndex of the DataFrame
+        :return: RaggedArray with the MTs in the order of the index, the values of each MT in their order in the
+        DataFrame
+        """
+        return cls(column[microtubule_index.order], np.append(microtubule_index.starts, len(microtubule_index.order)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, group):
+        """
+        :param group: number of an MT
+        :return: numpy array (view) of the values of the MT
+        """
+        return self.values[self.offsets[group]:self.offsets[group + 1]]
+
+    def take(self, groups):
+        """
+        :param groups: numpy array of numbers of MTs
+        :return: RaggedArray of the values of these MTs, in the order of groups
+        """
+        sizes = self.sizes[groups]
+        new_offsets = np.append(0, np.cumsum(sizes))
+        positions = np.arange(new_offsets[-1]) + np.repeat(self.offsets[groups] - new_offsets[:-1], sizes)
+        return RaggedArray(self.values[positions], new_offsets)
+
+    @property
+    def sizes(self):
+        """
+        :return: numpy array of the number of values of every MT
+        """
+        return np.diff(self.offsets)
+
+    def group_numbers(self):
+        """
+        :return: numpy array of the number of the MT of every value
+        """
+        return group_numbers(self.offsets)
+
+    def positions(self):
+        """
+        :return: numpy array of the position of every value in its MT (0, 1, 2...)
+        """
+        return np.arange(len(self.values)) - np.repeat(self.offsets[:-1], self.sizes)
+
+    def fit_lines(self, mask, values=None):
+        """
+        Fits a line to the masked values of every MT and evaluates it at all the positions of the MT, as
+        MethodBase.fit_clusters does for a single MT: the masked values are fit against 1, 2, 3... and the line is
+        evaluated at 0, 1, 2...
+        The least squares line is found in closed form, so the fit values may differ from np.linalg.lstsq in the last
+        bits.
+
+        :param mask: boolean numpy array with a value for every value, True for the values to fit
+        :param values: numpy array of the values to fit, in the layout of this array (the values of this array if None)
+        :return: numpy array of the fit values of every MT, NaN for MTs without masked values
+        """
+        values = self.values if values is None else values
+        counts = grouped_count(self.offsets, mask)
+        masked_offsets = np.append(0, np.cumsum(counts))
+
+        # x of the masked values is 1, 2, 3... in every MT
+        x = np.arange(1, masked_offsets[-1] + 1) - np.repeat(masked_offsets[:-1], counts)
+        slope, intercept = grouped_linear_fit(x.astype(float), values[mask], masked_offsets)
+
+        groups = self.group_numbers()
+        return intercept[groups] + slope[groups] * self.positions()
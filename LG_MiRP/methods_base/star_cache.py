@@ -0,0 +1,358 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Cache of parsed STAR files.
+Every parsed STAR file is saved as a directory of .npy files (one per column) so the next time the same file is opened
+the columns are memory-mapped instead of parsing the text again.
+An entry is identified by the path, size and modification time of the STAR file, so an entry of a file that was
+changed is never used. When the cache grows above its size limit the least recently used entries are deleted.
+Other arrays computed from a STAR file (e.g. the microtubule index) can be saved next to its entry with store_arrays,
+and compressed STAR files are decompressed once to a plain copy next to their entry.
+
+The cache directory and size limit can be set with the LG_MIRP_CACHE_DIR and LG_MIRP_CACHE_SIZE (in bytes)
+environment variables, setting LG_MIRP_CACHE_SIZE to 0 disables the cache.
+
+"""
+import os
+import json
+import atexit
+import shutil
+import hashlib
+import tempfile
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .star_compression import decompress_file
+
+# Changing this invalidates all existing cache entries
+CACHE_FORMAT_VERSION = 1
+
+CACHE_DIRECTORY = os.environ.get('LG_MIRP_CACHE_DIR',
+                                 os.path.join(os.path.expanduser('~'), '.cache', 'LG_MiRP', 'star'))
+CACHE_SIZE_LIMIT = int(os.environ.get('LG_MIRP_CACHE_SIZE', 4 * 1024 ** 3))
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class StarCache:
+    """
+    Binary columnar cache of parsed STAR files
+    """
+
+    def __init__(self, directory=CACHE_DIRECTORY, size_limit=CACHE_SIZE_LIMIT):
+        """
+        :param directory: directory in which the cache entries are saved
+        :param size_limit: maximal size of the cache in bytes, 0 disables the cache
+        """
+        self.directory = directory
+        self.size_limit = size_limit
+
+    @property
+    def enabled(self):
+        return self.size_limit > 0
+
+    def entry_path(self, path):
+        """
+        Finds the cache entry directory of a STAR file according to its path, size and modification time
+
+        :param path: path of the STAR file
+        :return: path of the cache entry directory
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = f'{CACHE_FORMAT_VERSION}|{path}|{stat.st_size}|{stat.st_mtime_ns}'
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def load(self, path, data_blocks=None):
+        """
+        Loads a parsed STAR file from the cache, the columns are memory-mapped (copy-on-write, so the returned
+        DataFrames can be changed freely)
+
+        :param path: path of the STAR file
+        :param data_blocks: names of the data blocks to load, None for all the blocks
+        :return: dictionary of block name: pandas.DataFrame (or dict for simple blocks), None if not in the cache
+        """
+        if not self.enabled:
+            return None
+
+        entry = self.entry_path(path)
+        manifest_path = os.path.join(entry, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+
+            data = {}
+            for block_name, block in manifest['blocks'].items():
+                if data_blocks is not None and block_name not in data_blocks:
+                    continue
+                if block['type'] == 'simple':
+                    data[block_name] = block['values']
+                else:
+                    data[block_name] = self._load_loop_block(entry, block)
+
+            # Marking the entry as recently used
+            os.utime(manifest_path)
+        except (OSError, ValueError, KeyError):
+            # Missing or broken entry
+            return None
+
+        return data
+
+    def store(self, path, data):
+        """
+        Saves a parsed STAR file to the cache, then deletes old entries if the cache is too big.
+        Failing to save an entry is never an error, the file is just parsed again next time.
+
+        :param path: path of the STAR file
+        :param data: dictionary of block name: pandas.DataFrame (or dict for simple blocks)
+        """
+        if not self.enabled:
+            return
+
+        entry = self.entry_path(path)
+        if os.path.isdir(entry):
+            return
+
+        # The entry is written to a temporary directory and renamed when complete, so a half written entry is
+        # never used
+        temporary_entry = f'{entry}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(temporary_entry, exist_ok=True)
+            manifest = {'source': os.path.abspath(path), 'blocks': {}}
+            for block_index, (block_name, block) in enumerate(data.items()):
+                if isinstance(block, pd.DataFrame):
+                    manifest['blocks'][block_name] = self._store_loop_block(temporary_entry, block_index, block)
+                else:
+                    manifest['blocks'][block_name] = {'type': 'simple', 'values': block}
+
+            with open(os.path.join(temporary_entry, MANIFEST_NAME), 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+
+            os.rename(temporary_entry, entry)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Could not cache {path}: {e}")
+            shutil.rmtree(temporary_entry, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def load_arrays(self, path, name):
+        """
+        Loads arrays saved with store_arrays
+
+        :param path: path of the STAR file the arrays were computed from
+        :param name: name of the arrays, e.g. 'microtubule_index'
+        :return: dictionary of name: numpy array, None if not in the cache
+        """
+        if not self.enabled:
+            return None
+
+        arrays_path = f'{self.entry_path(path)}.{name}.npz'
+        try:
+            with np.load(arrays_path) as arrays_file:
+                arrays = dict(arrays_file)
+            # Marking the arrays as recently used
+            os.utime(arrays_path)
+        except (OSError, ValueError):
+            return None
+
+        return arrays
+
+    def store_arrays(self, path, name, arrays):
+        """
+        Saves arrays computed from a STAR file, they are used as long as the STAR file is not changed
+
+        :param path: path of the STAR file the arrays were computed from
+        :param name: name of the arrays, e.g. 'microtubule_index'
+        :param arrays: dictionary of name: numpy array
+        """
+        if not self.enabled:
+            return
+
+        arrays_path = f'{self.entry_path(path)}.{name}.npz'
+        temporary_path = f'{arrays_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary_path, 'wb') as arrays_file:
+                np.savez(arrays_file, **arrays)
+            os.replace(temporary_path, arrays_path)
+        except OSError as e:
+            print(f"Could not cache {name} of {path}: {e}")
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+
+        self.evict()
+
+    def plain_copy(self, path):
+        """
+        Decompressed copy of a compressed STAR file, kept in the cache so the file is decompressed only once.
+        When the cache is disabled the copy is a temporary file deleted when the program ends.
+
+        :param path: path of the .star.gz or .star.zst file
+        :return: path of the decompressed copy
+        """
+        if not self.enabled:
+            descriptor, copy_path = tempfile.mkstemp(prefix='LG_MiRP_', suffix='.star')
+            os.close(descriptor)
+            atexit.register(_remove_file, copy_path)
+            decompress_file(path, copy_path)
+            return copy_path
+
+        copy_path = f'{self.entry_path(path)}.star'
+        try:
+            # Marking the copy as recently used by its access time, changing its modification time would change the
+            # cache entry of the copy itself
+            os.utime(copy_path, ns=(time.time_ns(), os.stat(copy_path).st_mtime_ns))
+            return copy_path
+        except FileNotFoundError:
+            # Not decompressed yet, or just evicted by another process
+            pass
+
+        temporary_path = f'{copy_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            decompress_file(path, temporary_path)
+            os.replace(temporary_path, copy_path)
+        finally:
+            _remove_file(temporary_path)
+
+        self.evict(keep=copy_path)
+        return copy_path
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries until the cache is smaller than the size limit.
+        Other threads and processes may use (or evict) the same cache at the same time, so entries that disappear or
+        can't be read or deleted are skipped, eviction never fails.
+
+        :param keep: path of an entry that is never deleted (e.g. one that is about to be used)
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        entries = []
+        total_size = 0
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            entry = os.path.join(self.directory, name)
+            try:
+                last_used, size = self._entry_usage(entry)
+            except OSError:
+                # Removed by another process, or a directory that is not an entry
+                continue
+            entries.append((last_used, size, entry))
+            total_size += size
+
+        # Oldest first
+        for _, size, entry in sorted(entries):
+            if total_size <= self.size_limit:
+                break
+            if entry == keep:
+                continue
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry)
+                except OSError:
+                    pass
+            total_size -= size
+
+    @staticmethod
+    def _entry_usage(entry):
+        """
+        :param entry: path of a cache entry directory or of a file in the cache directory
+        :return: the time the entry was last used and its size in bytes, raises OSError if it is not a complete entry
+        """
+        if os.path.isfile(entry):
+            # Arrays saved with store_arrays and plain copies of compressed files
+            stat = os.stat(entry)
+            return max(stat.st_atime, stat.st_mtime), stat.st_size
+
+        # Entries without a manifest are incomplete
+        last_used = os.path.getmtime(os.path.join(entry, MANIFEST_NAME))
+        return last_used, sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+
+    def clear(self):
+        """
+        Deletes all the cache entries
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def _store_loop_block(entry, block_index, dataframe):
+        """
+        Saves the columns of a loop block, numerical columns as they are and string columns as codes and categories
+
+        :param entry: cache entry directory
+        :param block_index: number of the block in the file, used in the file names
+        :param dataframe: the data block
+        :return: description of the block for the manifest
+        """
+        columns = []
+        for column_index, column_name in enumerate(dataframe.columns):
+            series = dataframe[column_name]
+            file_name = f'{block_index}_{column_index}'
+
+            if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+                np.save(os.path.join(entry, f'{file_name}.npy'), series.to_numpy())
+                columns.append({'name': column_name, 'kind': 'numeric', 'file': file_name})
+
+            elif pd.api.types.infer_dtype(series, skipna=True) in ('string', 'empty'):
+                codes, categories = pd.factorize(series)
+                categories = np.char.encode(np.asarray(categories, dtype=str), 'utf-8')
+                np.save(os.path.join(entry, f'{file_name}.npy'), codes.astype(np.int32))
+                np.save(os.path.join(entry, f'{file_name}.categories.npy'), categories)
+                columns.append({'name': column_name, 'kind': 'string', 'file': file_name})
+
+            else:
+                raise TypeError(f'unsupported column {column_name} of type {series.dtype}')
+
+        return {'type': 'loop', 'rows': len(dataframe), 'columns': columns}
+
+    @staticmethod
+    def _load_loop_block(entry, block):
+        """
+        Loads the columns of a loop block saved by _store_loop_block
+
+        :param entry: cache entry directory
+        :param block: description of the block from the manifest
+        :return: pandas.DataFrame of the block
+        """
+        columns = {}
+        for column in block['columns']:
+            values = np.load(os.path.join(entry, f"{column['file']}.npy"), mmap_mode='c').view(np.ndarray)
+            if column['kind'] == 'string':
+                categories = np.load(os.path.join(entry, f"{column['file']}.categories.npy"))
+                categories = np.char.decode(categories, 'utf-8').astype(object)
+                strings = np.empty(len(values), dtype=object)
+                present = values >= 0
+                strings[present] = categories[values[present]]
+                strings[~present] = np.nan
+                values = strings
+            columns[column['name']] = values
+
+        return pd.DataFrame(columns, index=pd.RangeIndex(block['rows']), copy=False)
+
+
+def _remove_file(path):
+    """
+    Deletes a file if it exists
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Cache used by ParticlesStarfile
+star_cache = StarCache()
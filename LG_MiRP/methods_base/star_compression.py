@@ -0,0 +1,185 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Compressed STAR files (.star.gz and .star.zst).
+A compressed STAR file is decompressed once to a plain copy in the cache (see StarCache.plain_copy), so everything that
+reads STAR files by byte ranges works on it as it is. Compressed files are written with several threads, gzip as
+independent members compressed in parallel (a valid gzip file for any reader) and zstd with its own threads.
+Reading and writing .zst files needs the zstandard package.
+
+"""
+import io
+import os
+import gzip
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Compression: file extension
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Extension of the delta files written instead of a STAR file (see star_delta.py)
+DELTA_EXTENSION = '.delta.npz'
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Size of the pieces of text compressed by each thread
+GZIP_BLOCK_SIZE = 4 * 1024 ** 2
+
+
+def compression_of(path):
+    """
+    :param path: path of a STAR file
+    :return: 'gzip', 'zstd' or None according to the file extension
+    """
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def strip_star_extension(file_name):
+    """
+    Removes the extension of a STAR file name, 'run_it001_data.star.gz' -> 'run_it001_data'
+
+    :param file_name: name of a STAR file, compressed or not, or of a delta file
+    :return: the name without .star and the compression extension (or the delta extension)
+    """
+    if file_name.endswith(DELTA_EXTENSION):
+        return file_name[:-len(DELTA_EXTENSION)]
+    compression = compression_of(file_name)
+    if compression:
+        file_name = file_name[:-len(COMPRESSION_EXTENSIONS[compression])]
+    if file_name.endswith('.star'):
+        file_name = file_name[:-len('.star')]
+    return file_name
+
+
+def star_file_name(name, compression=None, delta=False):
+    """
+    :param name: name of the STAR file without an extension
+    :param compression: None, 'gzip' or 'zstd'
+    :param delta: if True the name of a delta file instead (the compression is ignored)
+    :return: the file name with the .star extension and the extension of the compression
+    """
+    if delta:
+        return f'{name}{DELTA_EXTENSION}'
+    if compression is not None and compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"Unknown compression {compression}, use one of {list(COMPRESSION_EXTENSIONS)}")
+    return f"{name}.star{COMPRESSION_EXTENSIONS.get(compression, '')}"
+
+
+def decompress_file(path, destination):
+    """
+    Decompresses a .gz or .zst file
+
+    :param path: path of the compressed file
+    :param destination: path of the decompressed file
+    """
+    compression = compression_of(path)
+    with open(path, 'rb') as compressed_file, open(destination, 'wb') as plain_file:
+        if compression == 'gzip':
+            with gzip.GzipFile(fileobj=compressed_file) as reader:
+                shutil.copyfileobj(reader, plain_file, 1 << 20)
+        elif compression == 'zstd':
+            with _zstandard().ZstdDecompressor().stream_reader(compressed_file) as reader:
+                shutil.copyfileobj(reader, plain_file, 1 << 20)
+        else:
+            raise ValueError(f'{path} is not a compressed STAR file')
+
+
+def open_text_writer(descriptor, compression=None):
+    """
+    Opens a text file for writing, compressing the text if needed
+
+    :param descriptor: file descriptor (or path) of the output file
+    :param compression: None, 'gzip' or 'zstd'
+    :return: text file object
+    """
+    # newline='\n' since RELION can't read STAR files with windows line endings
+    if compression is None:
+        return open(descriptor, 'w', buffering=1 << 20, newline='\n')
+
+    raw_file = open(descriptor, 'wb')
+    if compression == 'gzip':
+        binary_file = ParallelGzipWriter(raw_file)
+    elif compression == 'zstd':
+        binary_file = _zstandard().ZstdCompressor(level=ZSTD_LEVEL, threads=-1).stream_writer(raw_file)
+    else:
+        raw_file.close()
+        raise ValueError(f"Unknown compression {compression}, use one of {list(COMPRESSION_EXTENSIONS)}")
+
+    return io.TextIOWrapper(binary_file, encoding='utf-8', newline='\n')
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Writes a gzip file made of independent members, each one compressed on a separate thread
+    """
+
+    def __init__(self, file, level=GZIP_LEVEL, block_size=GZIP_BLOCK_SIZE, threads=None):
+        """
+        :param file: binary file object of the output file, closed with the writer
+        :param level: gzip compression level
+        :param block_size: number of bytes in each member
+        :param threads: number of compression threads (number of CPUs if None)
+        """
+        super().__init__()
+        self._file = file
+        self._level = level
+        self._block_size = block_size
+        self._threads = threads or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._members = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._compress(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _compress(self, block):
+        """
+        Compresses a block on the thread pool and writes the members that are ready, in order
+        """
+        self._pending.append(self._pool.submit(gzip.compress, block, self._level, mtime=0))
+        self._members += 1
+        # Limiting the number of blocks in memory
+        while len(self._pending) > 2 * self._threads:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._members:
+                self._compress(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown()
+            self._file.close()
+            super().close()
+
+
+def _zstandard():
+    """
+    Imports the optional zstandard package
+
+    :return: the zstandard module
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("The zstandard package is needed for .zst STAR files (pip install zstandard)")
+    return zstandard
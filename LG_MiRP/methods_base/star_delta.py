@@ -0,0 +1,205 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Delta files of particles STAR files.
+Smoothing, reset and correction change only a few columns of the particles (and may drop some MTs), so instead of a
+complete copy of the STAR file they can write a small delta file: the numbers of the rows that are kept, the changed
+columns and a reference to the base file the rows come from, with the SHA-256 hash of its content.
+ParticlesStarfile opens a delta file like a STAR file, it reads the base file (which can be a delta file itself) and
+applies the delta to it in memory. The full STAR file is written only when it is needed, e.g. for RELION, with
+materialize_star_delta (see particles_starfile.py) or the materialize_star command.
+
+The rows are the row numbers in the particles data block of the original STAR file, the same numbers as the index of a
+DataFrame loaded by ParticlesStarfile, so the other columns are still copied from it as text when writing.
+Only the particles data block is stored, the other data blocks (optics) are always read from the base file.
+
+"""
+import os
+import hashlib
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .star_cache import star_cache
+from .star_compression import DELTA_EXTENSION
+
+# Changing this makes existing delta files unreadable
+DELTA_FORMAT_VERSION = 1
+
+# Prefix of the names of the changed columns in the delta file
+COLUMN_PREFIX = 'column_'
+
+# Size of the pieces of the base file read at once when hashing it
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def is_star_delta(path):
+    """
+    :param path: path of a particles file
+    :return: True if it is a delta file
+    """
+    return path.endswith(DELTA_EXTENSION)
+
+
+def file_hash(path):
+    """
+    SHA-256 hash of the content of a file, saved in the cache so a file is hashed only once while it is not changed
+
+    :param path: path of the file
+    :return: the hash as a hexadecimal string
+    """
+    arrays = star_cache.load_arrays(path, 'sha256')
+    if arrays is not None:
+        return str(arrays['digest'])
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    star_cache.store_arrays(path, 'sha256', {'digest': np.array(digest)})
+    return digest
+
+
+def write_star_delta(particles_dataframe, labels, path, base_path):
+    """
+    Writes a delta file instead of a complete STAR file
+
+    :param particles_dataframe: particles pandas.DataFrame loaded by ParticlesStarfile from base_path and changed
+    (rows can be removed)
+    :param labels: labels of the changed columns
+    :param path: path of the delta file, ending with DELTA_EXTENSION
+    :param base_path: path of the file the DataFrame was loaded from
+    """
+    StarDelta.from_dataframe(particles_dataframe, labels, base_path).save(path)
+
+
+class StarDelta:
+    """
+    Changed columns of the particles of a base file:
+
+        delta = StarDelta.from_dataframe(particles_dataframe, ['rlnAngleRot'], 'run_it001_data.star')
+        delta.save('run_it001_data_smoothened_angles.delta.npz')
+        particles_dataframe = StarDelta.load('run_it001_data_smoothened_angles.delta.npz').apply(base_dataframe)
+    """
+
+    def __init__(self, base_path, base_hash, rows, columns):
+        """
+        :param base_path: path of the base file (STAR file, compressed STAR file or delta file)
+        :param base_hash: SHA-256 hash of the base file when the delta was made
+        :param rows: numpy array of the row numbers of the kept rows, in their order in the delta
+        :param columns: dictionary of label: numpy array of the values of the changed column in every kept row
+        """
+        self.base_path = base_path
+        self.base_hash = base_hash
+        self.rows = rows
+        self.columns = columns
+        # Hash index of the rows, to find the kept rows of a chunk of the base file
+        self.row_index = pd.Index(rows)
+
+    @classmethod
+    def from_dataframe(cls, dataframe, labels, base_path):
+        """
+        :param dataframe: particles pandas.DataFrame loaded (and changed) from the base file, with the row numbers as
+        index
+        :param labels: labels of the changed columns
+        :param base_path: path of the file the DataFrame was loaded from
+        :return: StarDelta
+        """
+        columns = {}
+        for label in labels:
+            values = dataframe[label].to_numpy()
+            # Text is saved as unicode, so the delta file is read without pickle
+            columns[label] = values if values.dtype.kind in 'biuf' else values.astype(str)
+        return cls(base_path, file_hash(base_path), dataframe.index.to_numpy(dtype=np.int64), columns)
+
+    @property
+    def labels(self):
+        return list(self.columns)
+
+    def save(self, path):
+        """
+        Writes the delta file, to a temporary file that is renamed when complete
+
+        :param path: path of the delta file, ending with DELTA_EXTENSION
+        """
+        if not is_star_delta(path):
+            raise ValueError(f'The name of a delta file has to end with {DELTA_EXTENSION}, got {path}')
+
+        # The base file is referred to relative to the delta file, so a project directory can be moved
+        base_path = os.path.abspath(self.base_path)
+        try:
+            base_path = os.path.relpath(base_path, os.path.dirname(os.path.abspath(path)))
+        except ValueError:
+            # Different drives on windows
+            pass
+
+        arrays = {'format_version': np.array(DELTA_FORMAT_VERSION),
+                  'base_path': np.array(base_path),
+                  'base_hash': np.array(self.base_hash),
+                  'rows': self.rows}
+        arrays.update({f'{COLUMN_PREFIX}{label}': values for label, values in self.columns.items()})
+
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary_path, 'wb') as delta_file:
+                np.savez(delta_file, **arrays)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: path of the delta file
+        :return: StarDelta with the path of the base file relative to the current directory
+        """
+        with np.load(path) as arrays:
+            if int(arrays['format_version']) != DELTA_FORMAT_VERSION:
+                raise ValueError(f'{path} was written by another version of LG_MiRP and can not be read')
+            base_path = str(arrays['base_path'])
+            if not os.path.isabs(base_path):
+                base_path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(path)), base_path))
+            columns = {name[len(COLUMN_PREFIX):]: arrays[name]
+                       for name in arrays.files if name.startswith(COLUMN_PREFIX)}
+            return cls(base_path, str(arrays['base_hash']), arrays['rows'], columns)
+
+    def check_base(self):
+        """
+        Raises ValueError if the base file is missing or was changed since the delta was made
+        """
+        if not os.path.isfile(self.base_path):
+            raise ValueError(f'The base file of the delta, {self.base_path}, does not exist')
+        if file_hash(self.base_path) != self.base_hash:
+            raise ValueError(f'{self.base_path} was changed since the delta was made, the delta does not apply to it')
+
+    def apply(self, dataframe):
+        """
+        :param dataframe: particles pandas.DataFrame of the base file, with the row numbers as index
+        :return: pandas.DataFrame of the kept rows in the order of the delta, with the changed columns
+        """
+        positions = dataframe.index.get_indexer(self.rows)
+        if (positions < 0).any():
+            raise ValueError(f'Row {self.rows[np.argmax(positions < 0)]} of the delta is not in {self.base_path}')
+
+        dataframe = dataframe.iloc[positions]
+        for label, values in self.columns.items():
+            dataframe[label] = values
+        return dataframe
+
+    def apply_to_chunk(self, chunk):
+        """
+        :param chunk: pandas.DataFrame of consecutive rows of the base file (e.g. from iter_microtubule_chunks)
+        :return: pandas.DataFrame of the kept rows of the chunk in their order in the chunk, with the changed columns
+        """
+        positions = self.row_index.get_indexer(chunk.index)
+        kept = positions >= 0
+        chunk = chunk[kept]
+        for label, values in self.columns.items():
+            chunk[label] = values[positions[kept]]
+        return chunk
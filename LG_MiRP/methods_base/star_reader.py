@@ -0,0 +1,437 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Low level reading of STAR files without loading the whole file at once.
+The file is scanned once to find the data blocks, their column labels and the byte range of the rows of every loop
+block, then a loop block can be parsed with pandas either whole or in chunks of complete microtubules.
+Only the requested data blocks and columns can be parsed, the columns that were not parsed are later copied as the
+original text from the file when writing (see star_writer.py).
+A large loop block can be split into byte ranges at line boundaries and parsed on several processes.
+
+"""
+import io
+import os
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Default number of rows per chunk when streaming the particles data block
+DEFAULT_CHUNK_SIZE = 100000
+
+# Blocks smaller than this (in bytes) are always parsed in a single process, starting processes isn't worth it
+MIN_PARALLEL_BLOCK_SIZE = 32 * 1024 ** 2
+
+
+class StarBlock:
+    """
+    Description of a single data block in a STAR file (data_optics, data_particles...)
+    Loop blocks keep the column labels and the byte range of their rows, simple blocks keep their key-value pairs
+    """
+
+    def __init__(self, path, name):
+        """
+        :param path: path of the STAR file containing the block
+        :param name: name of the data block without the "data_" prefix
+        """
+        self.path = path
+        self.name = name
+        self.is_loop = False
+        self.labels = []
+        self.values = {}
+        self.data_start = None
+        self.data_end = None
+
+
+def scan_star_file(path):
+    """
+    Scans a STAR file and finds all its data blocks without parsing the rows of the loop blocks
+
+    :param path: path of the STAR file
+    :return: dictionary of block name: StarBlock in the order they appear in the file
+    """
+    blocks = {}
+
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return blocks
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as star_map:
+            block = None
+            position = 0
+
+            while position < size:
+                # Getting the next line and the position of the line after it
+                line_end = star_map.find(b'\n', position)
+                if line_end == -1:
+                    line_end = size
+                line = star_map[position:line_end].strip()
+                next_position = line_end + 1
+
+                if not line or line.startswith(b'#'):
+                    pass
+
+                elif line.startswith(b'data_'):
+                    block = StarBlock(path, line[5:].decode())
+                    blocks[block.name] = block
+
+                elif block is None:
+                    pass
+
+                elif line.startswith(b'loop_'):
+                    block.is_loop = True
+
+                elif line.startswith(b'_'):
+                    if block.is_loop:
+                        # '_rlnAngleRot #20' -> 'rlnAngleRot'
+                        block.labels.append(line.split()[0][1:].decode())
+                    else:
+                        # '_rlnImagePixelSize 1.05' -> {'rlnImagePixelSize': 1.05}
+                        key, _, value = line.decode().partition(' ')
+                        block.values[key[1:]] = numericise(value.strip())
+
+                elif block.is_loop and block.data_start is None:
+                    # First row of the loop, the rows end at the next data block or at the end of the file
+                    block.data_start = position
+                    next_block = star_map.find(b'\ndata_', position)
+                    block.data_end = size if next_block == -1 else next_block + 1
+                    next_position = block.data_end
+
+                position = next_position
+
+    # Loop blocks without rows
+    for block in blocks.values():
+        if block.is_loop and block.data_start is None:
+            block.data_start = block.data_end = size
+
+    return blocks
+
+
+def read_star_file(path, data_blocks=None, columns=None, blocks=None, workers=1):
+    """
+    Parses a STAR file, loop blocks as pandas.DataFrame and simple blocks as dict (like starfile.read)
+
+    :param path: path of the STAR file
+    :param data_blocks: names of the data blocks to parse (e.g. ['optics']), None for all the blocks
+    :param columns: dictionary of block name: labels of the columns to parse, blocks that are not in the dictionary
+    are parsed completely
+    :param blocks: the result of scan_star_file if the file was already scanned
+    :param workers: number of processes used to parse a large loop block
+    :return: dictionary of block name: pandas.DataFrame or dict
+    """
+    columns = columns or {}
+    if blocks is None:
+        blocks = scan_star_file(path)
+
+    data = {}
+    for block_name, block in blocks.items():
+        if data_blocks is not None and block_name not in data_blocks:
+            continue
+        if block.is_loop:
+            data[block_name] = read_loop_block(path, block, columns.get(block_name), workers)
+        else:
+            data[block_name] = block.values
+    return data
+
+
+def numericise(value):
+    """
+    Converts a value of a simple data block to int or float when possible
+
+    :param value: string value
+    :return: int, float or the original string
+    """
+    for conversion in (int, float):
+        try:
+            return conversion(value)
+        except ValueError:
+            pass
+    return value.strip('"')
+
+
+class _ByteRangeReader(io.RawIOBase):
+    """
+    Read-only file object limited to a byte range of a file, used to feed the rows of a single loop block to pandas
+    """
+
+    def __init__(self, path, start, end):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        read = self._file.readinto(memoryview(buffer)[:size])
+        self._remaining -= read
+        return read
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def open_block_rows(path, block):
+    """
+    Opens the rows of a loop block as a buffered binary file object
+
+    :param path: path of the STAR file
+    :param block: StarBlock from scan_star_file
+    :return: binary file object containing only the rows of the block
+    """
+    return io.BufferedReader(_ByteRangeReader(path, block.data_start, block.data_end), buffer_size=1 << 20)
+
+
+def read_csv_options(block, columns=None, keep_text=False):
+    """
+    pandas.read_csv options used to parse the rows of a loop block, same conventions as the starfile library
+
+    :param block: StarBlock from scan_star_file
+    :param columns: labels of the columns to parse (None for all)
+    :param keep_text: if True all the columns are read, but the ones that are not in columns are kept as text instead
+    of being skipped
+    :return: dictionary of keyword arguments for pandas.read_csv
+    """
+    options = dict(sep=r'\s+',
+                   header=None,
+                   names=block.labels,
+                   comment='#',
+                   keep_default_na=False,
+                   na_values=['nan', 'NaN', '<NA>'],
+                   engine='c')
+
+    if columns is not None:
+        if keep_text:
+            options['dtype'] = {label: str for label in block.labels if label not in columns}
+        else:
+            options['usecols'] = [label for label in block.labels if label in columns]
+
+    return options
+
+
+def read_loop_block(path, block, columns=None, workers=1):
+    """
+    Parses all the rows of a loop block
+
+    :param path: path of the STAR file
+    :param block: StarBlock from scan_star_file
+    :param columns: labels of the columns to parse, the other columns are skipped (None for all)
+    :param workers: number of processes used to parse the block, a block smaller than MIN_PARALLEL_BLOCK_SIZE is
+    always parsed in a single process
+    :return: pandas.DataFrame of the block
+    """
+    if block.data_start == block.data_end:
+        labels = block.labels if columns is None else [label for label in block.labels if label in columns]
+        return pd.DataFrame(columns=labels)
+
+    if workers > 1 and block.data_end - block.data_start >= MIN_PARALLEL_BLOCK_SIZE:
+        dataframe = _read_loop_block_in_parallel(path, block, columns, workers)
+        if dataframe is not None:
+            return dataframe
+
+    return _read_byte_range(path, block, block.data_start, block.data_end, columns)
+
+
+def _read_byte_range(path, block, start, end, columns):
+    """
+    Parses the rows of a loop block in a byte range of the file
+
+    :param path: path of the STAR file
+    :param block: StarBlock from scan_star_file
+    :param start: first byte of the range (the start of a line)
+    :param end: end of the range (the start of a line or the end of the block)
+    :param columns: labels of the columns to parse (None for all)
+    :return: pandas.DataFrame of the rows
+    """
+    rows = io.BufferedReader(_ByteRangeReader(path, start, end), buffer_size=1 << 20)
+    with rows:
+        try:
+            return pd.read_csv(rows, **read_csv_options(block, columns))
+        except pd.errors.EmptyDataError:
+            # A range containing only empty lines
+            return None
+
+
+def _read_loop_block_in_parallel(path, block, columns, workers):
+    """
+    Splits the rows of a loop block into byte ranges at line boundaries and parses them on a process pool
+
+    :param path: path of the STAR file
+    :param block: StarBlock from scan_star_file
+    :param columns: labels of the columns to parse (None for all)
+    :param workers: number of processes
+    :return: pandas.DataFrame of the block, None if the ranges were parsed to different column types (e.g. a column
+    that has text only in some of the rows) and the block has to be parsed whole
+    """
+    boundaries = split_at_lines(path, block.data_start, block.data_end, workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(_read_byte_range, [path] * workers, [block] * workers, boundaries[:-1],
+                              boundaries[1:], [columns] * workers))
+    parts = [part for part in parts if part is not None]
+
+    # Each range is parsed on its own, so the type of a column may differ between the ranges
+    for label in parts[0].columns:
+        is_text = {part[label].dtype.kind not in 'biuf' for part in parts}
+        if len(is_text) > 1:
+            return None
+
+    return pd.concat(parts, ignore_index=True)
+
+
+def split_at_lines(path, start, end, number_of_ranges):
+    """
+    Splits a byte range of a file into ranges of about the same size that start at the beginning of a line
+
+    :param path: path of the file
+    :param start: start of the byte range (the start of a line)
+    :param end: end of the byte range
+    :param number_of_ranges: number of ranges
+    :return: list of number_of_ranges + 1 boundaries, from start to end
+    """
+    boundaries = [start]
+    with open(path, 'rb') as file:
+        for i in range(1, number_of_ranges):
+            position = max(start + (end - start) * i // number_of_ranges, boundaries[-1])
+            file.seek(position)
+            # Moving to the start of the next line
+            file.readline()
+            boundaries.append(min(file.tell(), end))
+    boundaries.append(end)
+    return boundaries
+
+
+def read_text_columns(block, columns):
+    """
+    Reads columns of a loop block as the original text, without converting them to numbers
+
+    :param block: StarBlock from scan_star_file
+    :param columns: labels of the columns to read
+    :return: pandas.DataFrame of strings
+    """
+    options = read_csv_options(block, columns)
+    options['dtype'] = str
+    with open_block_rows(block.path, block) as rows:
+        return pd.read_csv(rows, **options)
+
+
+def iter_text_columns(block, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads columns of a loop block as the original text in chunks of chunk_size rows
+
+    :param block: StarBlock from scan_star_file
+    :param columns: labels of the columns to read
+    :param chunk_size: number of rows in each chunk
+    :return: generator of pandas.DataFrame chunks of strings
+    """
+    if block.data_start == block.data_end:
+        return
+
+    options = read_csv_options(block, columns)
+    options['dtype'] = str
+    with open_block_rows(block.path, block) as rows:
+        with pd.read_csv(rows, chunksize=chunk_size, **options) as reader:
+            for chunk in reader:
+                yield chunk
+
+
+def iter_loop_block(path, block, chunk_size=DEFAULT_CHUNK_SIZE, columns=None):
+    """
+    Parses the rows of a loop block in chunks of chunk_size rows, the index continues from chunk to chunk as if the
+    block was read whole
+
+    :param path: path of the STAR file
+    :param block: StarBlock from scan_star_file
+    :param chunk_size: number of rows in each chunk
+    :param columns: labels of the columns to convert to numbers, the other columns are kept as text (None for all)
+    :return: generator of pandas.DataFrame chunks
+    """
+    if block.data_start == block.data_end:
+        return
+
+    with open_block_rows(path, block) as rows:
+        with pd.read_csv(rows, chunksize=chunk_size, **read_csv_options(block, columns, keep_text=True)) as reader:
+            for chunk in reader:
+                yield chunk
+
+
+def iter_microtubule_chunks(path, block, chunk_size=DEFAULT_CHUNK_SIZE, columns=None,
+                            group_labels=('rlnMicrographName', 'rlnHelicalTubeID')):
+    """
+    Parses the rows of a loop block in chunks of about chunk_size rows without splitting a microtubule
+    (rlnMicrographName, rlnHelicalTubeID group) between chunks.
+    The segments of each MT are expected to be consecutive in the file, as RELION writes them.
+
+    :param path: path of the STAR file
+    :param block: StarBlock from scan_star_file
+    :param chunk_size: approximate number of rows in each chunk (a chunk grows to hold a whole MT)
+    :param columns: labels of the columns to convert to numbers, the other columns are kept as text (None for all)
+    :param group_labels: the columns that identify a single MT
+    :return: generator of pandas.DataFrame chunks containing only complete MTs
+    """
+    group_labels = list(group_labels)
+    finished_groups = set()
+    pending = None
+
+    for chunk in iter_loop_block(path, block, chunk_size, columns):
+        if pending is not None:
+            chunk = pd.concat([pending, chunk])
+
+        # The rows at the end of the chunk that belong to the same MT as the last row are held back, since the MT
+        # may continue in the next chunk
+        group_starts = _group_starts(chunk, group_labels)
+        last_group_start = group_starts[-1]
+        if last_group_start == 0:
+            pending = chunk
+            continue
+
+        complete = chunk.iloc[:last_group_start]
+        pending = chunk.iloc[last_group_start:]
+
+        _check_groups_are_consecutive(complete, group_starts[:-1], group_labels, finished_groups)
+        yield complete
+
+    if pending is not None and not pending.empty:
+        _check_groups_are_consecutive(pending, [0], group_labels, finished_groups)
+        yield pending
+
+
+def _group_starts(dataframe, group_labels):
+    """
+    Finds the rows in which a new MT starts
+
+    :param dataframe: chunk of the particles data block
+    :param group_labels: the columns that identify a single MT
+    :return: numpy array of the positions of the first row of every run of consecutive rows of the same MT
+    """
+    changed = np.zeros(len(dataframe), dtype=bool)
+    changed[0] = True
+    for label in group_labels:
+        values = dataframe[label].to_numpy()
+        changed[1:] |= values[1:] != values[:-1]
+    return np.flatnonzero(changed)
+
+
+def _check_groups_are_consecutive(dataframe, group_starts, group_labels, finished_groups):
+    """
+    Makes sure that an MT doesn't appear again after its segments were already passed on in an earlier chunk
+
+    :param dataframe: chunk of the particles data block
+    :param group_starts: positions of the first row of every MT in the chunk
+    :param group_labels: the columns that identify a single MT
+    :param finished_groups: set of the MTs that were already passed on, updated in place
+    """
+    keys = dataframe[group_labels].iloc[group_starts].itertuples(index=False, name=None)
+    for key in keys:
+        if key in finished_groups:
+            raise ValueError(f"The segments of MT {key[1]} in {key[0]} are not consecutive in the STAR file, "
+                             f"it can't be read in chunks. Read the file without streaming instead.")
+        finished_groups.add(key)
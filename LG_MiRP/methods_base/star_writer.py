@@ -0,0 +1,466 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Writing of STAR files.
+The rows of a loop block are formatted column by column (each column is converted to text in one go) and written in
+large buffered pieces. The file is written to a temporary file in the output directory and renamed only when it is
+complete, so a crashed or cancelled run never leaves a half written STAR file behind.
+The layout is the same as the one of the starfile library (tab separated, floats with 6 decimals).
+Columns of a loop block that were not loaded (see ParticlesStarfile columns) are copied as the original text from the
+source STAR file, matched to the rows by the DataFrame index.
+A path ending with .gz or .zst is written compressed (see star_compression.py).
+A loop block can also be split between several STAR files by the value of a column in a single pass, every row is
+formatted once and routed to the file of its value.
+Columns of a loop block can be set to a value or copied from other columns without parsing the rows, the lines are
+read in large blocks and written back with only these fields replaced (see rewrite_loop_block).
+
+"""
+import io
+import os
+import datetime
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from .star_reader import iter_text_columns, read_text_columns, read_loop_block, open_block_rows, read_csv_options
+from .star_compression import compression_of, open_text_writer
+
+FLOAT_FORMAT = '{:.6f}'
+NA_REPRESENTATION = '<NA>'
+SEPARATOR = '\t'
+
+# Number of rows formatted and written at once
+ROWS_PER_WRITE = 100000
+
+# Size (in bytes) of the pieces of text rewritten at once by rewrite_loop_block
+REWRITE_BLOCK_SIZE = 16 * 1024 ** 2
+
+# Number of random names tried for the temporary file before giving up
+TEMPORARY_NAME_ATTEMPTS = 100
+
+
+def write_star_file(data, path, sources=None):
+    """
+    Writes data blocks to a STAR file
+
+    :param data: dictionary of block name: pandas.DataFrame (loop block) or dict (simple block),
+    e.g. {'optics': optics_dataframe, 'particles': particles_dataframe}
+    :param path: path of the output STAR file
+    :param sources: dictionary of block name: StarBlock the block was loaded from, its columns that are missing from
+    the DataFrame are copied from the source file (e.g. ParticlesStarfile.sources)
+    """
+    sources = sources or {}
+    with StarFileWriter(path) as writer:
+        for block_name, block in data.items():
+            if isinstance(block, pd.DataFrame):
+                writer.write_loop_block(block_name, block, sources.get(block_name))
+            else:
+                writer.write_simple_block(block_name, block)
+
+
+def write_partitioned_star_files(data, block_name, label, paths, sources=None):
+    """
+    Splits a loop block between several STAR files according to the value of a column, in a single pass over the rows.
+    The other data blocks are written to all the files.
+
+    :param data: dictionary of block name: pandas.DataFrame (loop block) or dict (simple block)
+    :param block_name: name of the loop block to split, e.g. 'particles'
+    :param label: the column the block is split by, e.g. 'rlnClassNumber'
+    :param paths: dictionary of value: path of the STAR file for the rows with this value, every value of the column
+    must have a path
+    :param sources: dictionary of block name: StarBlock the block was loaded from (see write_star_file)
+    :return: dictionary of value: number of rows written to its file
+    """
+    sources = sources or {}
+    values = list(paths)
+    counts = dict.fromkeys(values, 0)
+
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(StarFileWriter(paths[value])) for value in values]
+
+        for name, block in data.items():
+            if name == block_name:
+                labels, pieces = loop_block_rows(block, sources.get(name))
+                for writer in writers:
+                    writer.start_loop_block(name, labels)
+
+                for piece in pieces:
+                    for start in range(0, len(piece), ROWS_PER_WRITE):
+                        rows = piece.iloc[start:start + ROWS_PER_WRITE]
+
+                        # Position of the value of every row in values, rows of the same value are grouped together
+                        codes = pd.Index(values).get_indexer(rows[label])
+                        if (codes < 0).any():
+                            raise ValueError(f'No output file for {label} = {rows[label].iloc[np.argmax(codes < 0)]}')
+                        order = np.argsort(codes, kind='stable')
+                        bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+
+                        lines = format_lines(rows[labels])
+                        for i, writer in enumerate(writers):
+                            selected = order[bounds[i]:bounds[i + 1]]
+                            if len(selected):
+                                writer.write_text(''.join(lines[j] + '\n' for j in selected))
+                                counts[values[i]] += len(selected)
+
+                for writer in writers:
+                    writer.end_loop_block()
+
+            elif isinstance(block, pd.DataFrame):
+                for writer in writers:
+                    writer.write_loop_block(name, block, sources.get(name))
+            else:
+                for writer in writers:
+                    writer.write_simple_block(name, block)
+
+    return counts
+
+
+def rewrite_loop_block(blocks, block_name, path, values=None, copies=None):
+    """
+    Writes a copy of a STAR file in which columns of one loop block are set to a value or copied from other columns.
+    The rows of the block are read as text in blocks of REWRITE_BLOCK_SIZE bytes and only the changed fields of every
+    line are replaced, nothing is converted to numbers, so a file of any size is rewritten with a bounded amount of
+    memory and the other columns keep their original text.
+    The other data blocks are written as they are. Changed columns that are not in the block are added at the end, the
+    ones of values first.
+
+    :param blocks: dictionary of block name: StarBlock of the source file (from scan_star_file)
+    :param block_name: name of the loop block to change, e.g. 'particles'
+    :param path: path of the output STAR file, compressed if it ends with .gz or .zst
+    :param values: dictionary of label: value set in all the rows, e.g. {'rlnAngleRot': 0.0}
+    :param copies: dictionary of label: label of the column it is copied from, e.g. {'rlnAnglePsi': 'rlnAnglePsiPrior'}
+    :return: number of rows written to the changed block
+    """
+    values = values or {}
+    copies = copies or {}
+    number_of_rows = 0
+
+    with StarFileWriter(path) as writer:
+        for name, block in blocks.items():
+            if not block.is_loop:
+                writer.write_simple_block(name, block.values)
+            elif name != block_name:
+                writer.write_loop_block(name, read_loop_block(block.path, block))
+            else:
+                missing = [label for label in copies.values() if label not in block.labels]
+                if missing:
+                    raise ValueError(f'There is no {", ".join(missing)} in data_{block_name} of {block.path}')
+                labels = block.labels + [label for label in [*values, *copies] if label not in block.labels]
+                # Every value is formatted once, as it would be written in a column
+                texts = {label: quote(value) for label, value in values.items()}
+
+                writer.start_loop_block(name, labels)
+                with open_block_rows(block.path, block) as rows:
+                    while True:
+                        # Whole lines only, the block is completed to the end of its last line
+                        text = (rows.read(REWRITE_BLOCK_SIZE) + rows.readline()).decode()
+                        if not text:
+                            break
+                        lines = _replace_fields(text, block, labels, texts, copies)
+                        writer.write_text(''.join(line + '\n' for line in lines))
+                        number_of_rows += len(lines)
+                writer.end_loop_block()
+
+    return number_of_rows
+
+
+def _replace_fields(text, block, labels, texts, copies):
+    """
+    Replaces the changed fields in the lines of a loop block
+
+    :param text: complete lines of the rows of the block
+    :param block: StarBlock of the rows
+    :param labels: the labels of the output columns, the labels of the block followed by the new columns
+    :param texts: dictionary of label: text set in all the rows
+    :param copies: dictionary of label: label of the column it is copied from
+    :return: list of the new lines, without new lines
+    """
+    # Quoted values and comments are left to pandas, as are rows with a missing value (written as NA)
+    if '"' not in text and '#' not in text:
+        number_of_fields = len(block.labels)
+        new_fields = [''] * (len(labels) - number_of_fields)
+        replaced = [(labels.index(label), value) for label, value in texts.items()]
+        copied = [(labels.index(label), labels.index(source_label)) for label, source_label in copies.items()]
+
+        lines = []
+        for line in text.splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) != number_of_fields:
+                break
+            fields += new_fields
+            for position, value in replaced:
+                fields[position] = value
+            for position, source_position in copied:
+                fields[position] = fields[source_position]
+            lines.append(SEPARATOR.join(fields))
+        else:
+            return lines
+
+    rows = pd.read_csv(io.StringIO(text), dtype=str, **read_csv_options(block))
+    for label, value in texts.items():
+        rows[label] = value
+    for label, source_label in copies.items():
+        rows[label] = rows[source_label]
+    return format_lines(rows[labels])
+
+
+def create_temporary_file(path):
+    """
+    Creates a new temporary file next to an output file, with the permissions of a file created with open() (0o666
+    limited by the umask, which the kernel applies)
+
+    :param path: path of the output file
+    :return: file descriptor and path of the temporary file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    for _ in range(TEMPORARY_NAME_ATTEMPTS):
+        temporary_path = os.path.join(directory, f'.{os.path.basename(path)}.{os.urandom(6).hex()}.tmp')
+        try:
+            # O_BINARY so windows doesn't change the line endings
+            flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+            return os.open(temporary_path, flags, 0o666), temporary_path
+        except FileExistsError:
+            continue
+    raise FileExistsError(f'Could not create a temporary file for {path}')
+
+
+class StarFileWriter:
+    """
+    Writes a STAR file block by block, the rows of a loop block can be written in several chunks.
+    Used as a context manager, the file appears at its path only when the context exits without an error:
+
+        with StarFileWriter(path) as writer:
+            writer.write_loop_block('optics', optics_dataframe)
+            writer.start_loop_block('particles', labels)
+            for chunk in chunks:
+                writer.write_rows(chunk)
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the output STAR file, compressed if it ends with .gz or .zst
+        """
+        self.path = path
+        self.temporary_path = None
+        self.file = None
+        self.labels = None
+
+    def __enter__(self):
+        descriptor, self.temporary_path = create_temporary_file(self.path)
+        self.file = open_text_writer(descriptor, compression_of(self.path))
+        self.file.write(f"# Created by LG_MiRP at {datetime.datetime.now().strftime('%H:%M:%S on %d/%m/%Y')}\n\n\n")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.labels is not None:
+            self.end_loop_block()
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.temporary_path, self.path)
+        else:
+            os.remove(self.temporary_path)
+        return False
+
+    def write_simple_block(self, block_name, values):
+        """
+        Writes a simple data block of key-value pairs
+
+        :param block_name: name of the block without the "data_" prefix
+        :param values: dictionary of label: value
+        """
+        self.file.write(f'data_{block_name}\n\n')
+        for label, value in values.items():
+            self.file.write(f'_{label}\t\t\t{quote(value)}\n')
+        self.file.write('\n\n')
+
+    def write_loop_block(self, block_name, dataframe, source=None):
+        """
+        Writes a whole loop block
+
+        :param block_name: name of the block without the "data_" prefix
+        :param dataframe: pandas.DataFrame of the block
+        :param source: StarBlock the DataFrame was loaded from, its columns that are missing from the DataFrame are
+        copied from the source file. The columns keep the order of the source file, new columns are added at the end.
+        """
+        labels, pieces = loop_block_rows(dataframe, source)
+        self.start_loop_block(block_name, labels)
+        for rows in pieces:
+            self.write_rows(rows)
+        self.end_loop_block()
+
+    def start_loop_block(self, block_name, labels):
+        """
+        Writes the header of a loop block, the rows are then written with write_rows
+
+        :param block_name: name of the block without the "data_" prefix
+        :param labels: the column labels of the block
+        """
+        if self.labels is not None:
+            self.end_loop_block()
+        self.labels = list(labels)
+        self.file.write(f'data_{block_name}\n\nloop_\n')
+        self.file.write(''.join(f'_{label} #{number}\n' for number, label in enumerate(self.labels, 1)))
+
+    def write_rows(self, dataframe):
+        """
+        Writes rows of the current loop block
+
+        :param dataframe: pandas.DataFrame with the columns of the block
+        """
+        dataframe = dataframe[self.labels]
+        for start in range(0, len(dataframe), ROWS_PER_WRITE):
+            self.file.write(format_rows(dataframe.iloc[start:start + ROWS_PER_WRITE]))
+
+    def write_text(self, text):
+        """
+        Writes already formatted rows of the current loop block
+
+        :param text: the rows, each row ending with a new line
+        """
+        self.file.write(text)
+
+    def end_loop_block(self):
+        """
+        Ends the current loop block
+        """
+        self.file.write('\n\n')
+        self.labels = None
+
+
+def loop_block_rows(dataframe, source=None):
+    """
+    Finds the columns of a loop block and its rows with all the columns
+
+    :param dataframe: pandas.DataFrame of the block
+    :param source: StarBlock the DataFrame was loaded from, its columns that are missing from the DataFrame are
+    copied from the source file. The columns keep the order of the source file, new columns are added at the end.
+    :return: list of the labels and iterable of pandas.DataFrame pieces of the rows
+    """
+    missing = [] if source is None else [label for label in source.labels if label not in dataframe.columns]
+    if not missing:
+        return list(dataframe.columns), [dataframe]
+
+    labels = source.labels + [label for label in dataframe.columns if label not in source.labels]
+    return labels, merge_source_columns(dataframe, source, missing)
+
+
+def merge_source_columns(dataframe, source, labels):
+    """
+    Adds columns that were not loaded to the rows of a DataFrame, the text of each row is taken from the row of the
+    source file with the same number as the DataFrame index.
+    When the index is sorted (rows were only removed or changed) the source file is read in chunks alongside the
+    DataFrame, otherwise the columns are read whole.
+
+    :param dataframe: pandas.DataFrame loaded from the source block, with the row numbers as index
+    :param source: StarBlock of the source file
+    :param labels: the columns to copy from the source file
+    :return: generator of pandas.DataFrame pieces of the rows with all the columns
+    """
+    if dataframe.empty:
+        return
+
+    if not dataframe.index.is_monotonic_increasing:
+        text = read_text_columns(source, labels)
+        yield _join_columns(dataframe, text.loc[dataframe.index])
+        return
+
+    index = dataframe.index.to_numpy()
+    position = 0
+    for text in iter_text_columns(source, labels, ROWS_PER_WRITE):
+        # The rows of the DataFrame that come from this chunk of the source file
+        stop = np.searchsorted(index, text.index[-1], side='right')
+        if stop > position:
+            rows = dataframe.iloc[position:stop]
+            yield _join_columns(rows, text.loc[rows.index])
+            position = stop
+        if position == len(index):
+            break
+
+    if position < len(index):
+        raise ValueError(f'{source.path} has fewer rows than the data written from it, the file changed since it was '
+                         f'loaded')
+
+
+def _join_columns(dataframe, text):
+    """
+    Joins two DataFrames with the same rows side by side, ignoring their index
+
+    :param dataframe: pandas.DataFrame
+    :param text: pandas.DataFrame with the same number of rows
+    :return: pandas.DataFrame with the columns of both
+    """
+    return pd.concat([dataframe.reset_index(drop=True), text.reset_index(drop=True)], axis=1)
+
+
+def format_rows(dataframe):
+    """
+    Formats the rows of a loop block as text
+
+    :param dataframe: pandas.DataFrame of rows
+    :return: the rows as a single string, each row ending with a new line
+    """
+    if dataframe.empty:
+        return ''
+
+    return '\n'.join(format_lines(dataframe)) + '\n'
+
+
+def format_lines(dataframe):
+    """
+    Formats the rows of a loop block as text
+
+    :param dataframe: pandas.DataFrame of rows
+    :return: list of the rows as strings, without new lines
+    """
+    columns = [format_column(dataframe.iloc[:, i]) for i in range(dataframe.shape[1])]
+    return list(map(SEPARATOR.join, zip(*columns)))
+
+
+def format_column(series):
+    """
+    Converts a whole column to a list of strings
+
+    :param series: pandas.Series of a single column
+    :return: list of the formatted values
+    """
+    dtype = series.dtype
+
+    if isinstance(dtype, np.dtype) and dtype.kind == 'f':
+        values = series.to_numpy()
+        formatted = list(map(FLOAT_FORMAT.format, values.tolist()))
+        for i in np.flatnonzero(np.isnan(values)):
+            formatted[i] = NA_REPRESENTATION
+
+    elif isinstance(dtype, np.dtype) and dtype.kind in 'biu':
+        formatted = list(map(str, series.to_numpy().tolist()))
+
+    elif isinstance(dtype, pd.CategoricalDtype):
+        # Formatting every category once (e.g. micrograph names)
+        categories = np.array(format_column(pd.Series(dtype.categories)) + [NA_REPRESENTATION], dtype=object)
+        formatted = categories[series.cat.codes.to_numpy()].tolist()
+
+    else:
+        formatted = [NA_REPRESENTATION if pd.isna(value) else quote(value) for value in series.tolist()]
+
+    return formatted
+
+
+def quote(value):
+    """
+    Quotes strings that contain spaces or are empty, as the starfile library does
+
+    :param value: a single value
+    :return: the value as a string
+    """
+    if isinstance(value, str):
+        if ' ' in value or not value:
+            return f'"{value}"'
+        return value
+    if isinstance(value, float):
+        return FLOAT_FORMAT.format(value)
+    return str(value)
@@ -3,7 +3,7 @@ Setup file for LG_MiRP
 
 Author: Alina Levitin
 Date: 10/03/24
-Updated: 02/07/24
+Updated: 18/10/26
 """
 import setuptools
 
@@ -32,6 +32,7 @@ setuptools.setup(
             'high_resolution_reconstruction=6_high_resolution_reconstruction.high_resolution_reconstruction:main',
             'pf_refinement=7_protofilament_refinement.pf_refinement:main',
             'utils=utils.utils:main',
+            'materialize_star=utils.materialize_star:main',
         ],
     }
 )
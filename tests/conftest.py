@@ -0,0 +1,67 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Fixtures of the tests: a small particles STAR file with MTs of different lengths and a cache directory per test.
+
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from LG_MiRP.methods_base.star_cache import star_cache
+from LG_MiRP.methods_base.star_writer import write_star_file
+
+
+def make_particles_dataframe(micrographs=20, seed=0):
+    """
+    :param micrographs: number of micrographs, each with 1 to 4 MTs of 3 to 40 segments
+    :param seed: seed of the random values
+    :return: particles pandas.DataFrame with the angles and shifts of noisy lines along every MT
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for micrograph in range(micrographs):
+        micrograph_name = f'MotionCorr/job002/Movies/mic_{micrograph:05d}_DW.mrc'
+        for tube_id in range(1, rng.integers(1, 5) + 1):
+            rot, rot_slope, shift_slope = rng.uniform(-180, 180), rng.uniform(-2, 2), rng.uniform(-0.5, 0.5)
+            for segment in range(rng.integers(3, 41)):
+                noisy = rng.random() < 0.3
+                rows.append({
+                    'rlnCoordinateX': round(rng.uniform(0, 4000), 6),
+                    'rlnCoordinateY': round(rng.uniform(0, 4000), 6),
+                    'rlnHelicalTubeID': tube_id,
+                    'rlnImageName': f'{len(rows) + 1:06d}@Extract/job007/Movies/mic_{micrograph:05d}_DW.mrcs',
+                    'rlnMicrographName': micrograph_name,
+                    'rlnOpticsGroup': 1,
+                    'rlnAngleRot': round((rot + rot_slope * segment + rng.uniform(-180, 180) * noisy + 180) % 360
+                                         - 180, 6),
+                    'rlnAngleTilt': round(rng.uniform(85, 95), 6),
+                    'rlnAnglePsi': round(rng.uniform(-180, 180), 6),
+                    'rlnOriginXAngst': round(rng.normal(0, 3), 6),
+                    'rlnOriginYAngst': round(rng.choice([0.0, 1.4, -2.8]) + shift_slope * segment, 6),
+                    'rlnClassNumber': int(rng.integers(1, 15)),
+                })
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture(autouse=True)
+def cache_directory(tmp_path, monkeypatch):
+    """
+    Every test gets its own empty STAR cache
+    """
+    monkeypatch.setattr(star_cache, 'directory', str(tmp_path / 'cache'))
+
+
+@pytest.fixture
+def particles_star_file(tmp_path):
+    """
+    :return: path of a particles STAR file with optics and particles data blocks
+    """
+    optics_dataframe = pd.DataFrame({'rlnOpticsGroupName': ['opticsGroup1'], 'rlnOpticsGroup': [1],
+                                     'rlnImagePixelSize': [4.2], 'rlnImageSize': [100],
+                                     'rlnImageDimensionality': [2]})
+    path = tmp_path / 'run_it001_data.star'
+    write_star_file({'optics': optics_dataframe, 'particles': make_particles_dataframe()}, str(path))
+    return str(path)
@@ -0,0 +1,63 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Tests of SmoothAnglesOrShifts
+
+"""
+import os
+
+import pytest
+
+from LG_MiRP.methods.angles_and_shifts_smoothing import SmoothAnglesOrShifts
+from LG_MiRP.methods_base.particles_starfile import ParticlesStarfile
+
+
+class Value:
+    """
+    Stands for the tkinter variables the methods get from the GUI
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def smooth(star_file, output_path, method, **kwargs):
+    """
+    :return: path of the output file of SmoothAnglesOrShifts
+    """
+    os.makedirs(output_path, exist_ok=True)
+    smoothing = SmoothAnglesOrShifts(Value(star_file), Value(str(output_path)), Value(method), **kwargs)
+    smoothing.smooth_angles_or_shifts()
+    return os.path.join(str(output_path), smoothing.output_file_name())
+
+
+def star_file_text(path):
+    """
+    :return: the lines of a STAR file without the first line (with the time it was written)
+    """
+    with open(path) as star_file:
+        return star_file.readlines()[1:]
+
+
+@pytest.mark.parametrize('method', ['angles', 'shifts', 'joint'])
+def test_chunks_apply_the_cutoff(particles_star_file, tmp_path, method):
+    whole = smooth(particles_star_file, tmp_path / 'whole', method, cutoff=10)
+    chunks = smooth(particles_star_file, tmp_path / 'chunks', method, cutoff=10, chunk_size=50)
+
+    assert star_file_text(chunks) == star_file_text(whole)
+    microtubule_index = ParticlesStarfile(chunks, use_cache=False).microtubule_index
+    assert len(microtubule_index) and (microtubule_index.sizes >= 10).all()
+
+
+def test_chunks_apply_the_cutoff_to_delta_files(particles_star_file, tmp_path):
+    whole = smooth(particles_star_file, tmp_path / 'whole', 'shifts', cutoff=10, delta=True)
+    chunks = smooth(particles_star_file, tmp_path / 'chunks', 'shifts', cutoff=10, chunk_size=50, delta=True)
+
+    whole_dataframe = ParticlesStarfile(whole, use_cache=False).particles_dataframe
+    chunks_dataframe = ParticlesStarfile(chunks, use_cache=False).particles_dataframe
+    assert chunks_dataframe.equals(whole_dataframe)
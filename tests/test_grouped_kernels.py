@@ -0,0 +1,52 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Tests of the statistics of every MT computed at once
+
+"""
+import numpy as np
+
+from LG_MiRP.methods_base.grouped_kernels import grouped_histogram_bins, grouped_percentiles
+
+
+def ragged_values(seed=0):
+    """
+    :return: list of the values of MTs of different sizes, with ties, equal values and outliers
+    """
+    rng = np.random.default_rng(seed)
+    groups = []
+    for size in rng.integers(1, 80, 500).tolist() + [300, 1000]:
+        kind = len(groups) % 5
+        if kind == 0:
+            values = rng.normal(0, 3, size)
+        elif kind == 1:
+            values = np.round(rng.normal(0, 3, size), 1)
+        elif kind == 2:
+            values = np.full(size, rng.normal())
+        elif kind == 3:
+            values = np.append(np.zeros(size - 1), rng.normal(0, 100))
+        else:
+            values = rng.normal(0, 3, size) - np.arange(1, size + 1) * rng.choice(np.arange(-8, 8, 0.25))
+        groups.append(values)
+    return groups
+
+
+def test_grouped_percentiles_match_numpy():
+    groups = ragged_values()
+    offsets = np.append(0, np.cumsum([len(values) for values in groups]))
+    percentiles = grouped_percentiles(np.concatenate(groups), offsets, [75, 25])
+
+    for group, values in enumerate(groups):
+        assert np.array_equal(percentiles[group], np.percentile(values, [75, 25]))
+
+
+def test_grouped_histogram_bins_match_numpy():
+    groups = ragged_values()
+    offsets = np.append(0, np.cumsum([len(values) for values in groups]))
+    bins = grouped_histogram_bins(np.concatenate(groups), offsets)
+
+    for group, values in enumerate(groups):
+        expected = np.digitize(values, np.histogram(values, bins='auto')[1])
+        assert np.array_equal(bins[offsets[group]:offsets[group + 1]], expected)
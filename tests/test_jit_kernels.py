@@ -0,0 +1,61 @@
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Tests of the numba kernels: they are compiled in a first process and loaded from numba's cache in a second one, and
+both have to give exactly the results of the NumPy implementation.
+
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('numba')
+
+# Compares the kernels with the NumPy implementation of MethodBase in a new process
+COMPARE_BACKENDS = '''
+import numpy as np
+
+from LG_MiRP.methods_base import jit_kernels, method_base
+from LG_MiRP.methods_base.method_base import MethodBase
+from LG_MiRP.methods_base.ragged_array import RaggedArray
+
+assert jit_kernels.JIT_AVAILABLE
+
+rng = np.random.default_rng(0)
+sizes = np.array([1, 2, 7, 8, 9, 40, 128, 129, 300, 1000, 5000])
+shifts = RaggedArray(rng.normal(0, 3, sizes.sum()), np.concatenate([[0], np.cumsum(sizes)]))
+flattening_factors = np.arange(-8, 8, 0.25)
+angles = rng.uniform(-180, 180, 200)
+flattened_shifts = rng.normal(0, 3, 500)
+bins = np.histogram(flattened_shifts, bins='auto')[1]
+
+
+def results():
+    return (MethodBase.flatness_scores_batched(shifts, flattening_factors),
+            MethodBase.cluster_shallow_slopes(angles, 8),
+            MethodBase.cluster_numpy_bins(flattened_shifts, bins))
+
+
+jit_scores, jit_angle_clusters, jit_bins = results()
+method_base.JIT_AVAILABLE = False
+numpy_scores, numpy_angle_clusters, numpy_bins = results()
+
+assert np.array_equal(jit_scores, numpy_scores)
+assert jit_angle_clusters == numpy_angle_clusters
+assert jit_bins == numpy_bins
+'''
+
+
+def test_cached_kernels_match_numpy(tmp_path):
+    environment = dict(os.environ, NUMBA_CACHE_DIR=str(tmp_path / 'numba'), LG_MIRP_JIT='1')
+
+    # The first process compiles the kernels and saves them, the second one loads them from the cache
+    for run in ['compiled', 'cached']:
+        process = subprocess.run([sys.executable, '-c', COMPARE_BACKENDS], env=environment, capture_output=True,
+                                 text=True)
+        assert process.returncode == 0, f'{run} kernels: {process.stderr}'
+        assert os.listdir(tmp_path / 'numba')
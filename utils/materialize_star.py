@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Author: Alina Levitin
+Date: 18/10/26
+Updated: 18/10/26
+
+Command to write the complete STAR file of a delta file (.delta.npz), e.g. before handing it off to RELION
+The delta files are described in LG_MiRP/methods_base/star_delta
+
+    materialize_star run_it001_data_smoothened_angles.delta.npz [output.star]
+
+"""
+import os
+import argparse
+
+from LG_MiRP import materialize_star_delta, strip_star_extension
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes the complete STAR file of a delta file')
+    parser.add_argument('delta_file', help='the delta file (.delta.npz)')
+    parser.add_argument('output_file', nargs='?',
+                        help='the output STAR file (.star, .star.gz or .star.zst), next to the delta file if not given')
+    args = parser.parse_args()
+
+    output_file = args.output_file or f'{strip_star_extension(args.delta_file)}.star'
+    if os.path.exists(output_file):
+        parser.error(f'{output_file} already exists')
+    materialize_star_delta(args.delta_file, output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,25 @@
 """
 Author: Alina Levitin
 Date: 03/06/24
-Updated: 09/06/24
+Updated: 18/10/26
 
 Command to bring up Utils GUI
 The GUI is located in LG_MiRP/gui/method_menu_gui
 
-The Frame is located in LG_MiRP/gui/segment_average_gui
-The method of segment averaging is located in LG_MiRP/methods/segment_average_generator
+The Frames are located in LG_MiRP/gui/segment_average_gui and LG_MiRP/gui/cutoff_sweep_gui
+The methods of segment averaging and of the cutoff sweep are located in LG_MiRP/methods/segment_average_generator and
+LG_MiRP/methods/cutoff_sweep
 
 """
 
-from LG_MiRP import MethodMenuGui, SegmentAverageFrame
+from LG_MiRP import MethodMenuGui, SegmentAverageFrame, CutoffSweepFrame
 
 
 def main():
     # Generating the gui
     gui = MethodMenuGui('Utils')
     gui.add_frame(SegmentAverageFrame, 'Segment average generator')
+    gui.add_frame(CutoffSweepFrame, 'Cutoff sweep')
     gui.mainloop()
 
 